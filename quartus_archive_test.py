@@ -1,70 +1,41 @@
 #!/usr/bin/env python3
 
+import argparse
 import datetime
-import http.client
+import functools
+import hashlib
 import logging
 import os
-import pickle
 import re
 import sys
+import threading
 import time
 from http.cookiejar import CookieJar
-from multiprocessing import Pool
-from typing import Optional
+from typing import Callable, Optional
 
 import lxml.html
 import mechanize
-import packaging.version
 import requests
-import tenacity
-from attrs import define
+from attrs import define, field
 from lxml import etree
 from rich import print
 
+from quartus_metrics import add_metrics_args, metrics, metrics_args
+from quartus_model import CrawledPage, DistInfo, Download, PageState, Version, byte_size
+from quartus_throttle import (
+    Throttled,
+    ThrottledAdapter,
+    is_throttled,
+    parse_retry_after,
+    throttle,
+    throttled_map,
+)
+
 landing_url = "https://www.intel.com/content/www/us/en/products/details/fpga/development-tools/quartus-prime/resource.html"
 
 mechanize._urllib2_fork.HTTPRedirectHandler.max_redirections = 10
-logger = logging.getLogger("mechanize")
-logger.addHandler(logging.StreamHandler(sys.stdout))
-logger.setLevel(logging.DEBUG)
-http.client.HTTPConnection.debuglevel = 5
-
-
-def static_vars(**kwargs):
-    def decorate(func):
-        for k in kwargs:
-            setattr(func, k, kwargs[k])
-        return func
-
-    return decorate
-
-
-class Version(packaging.version.Version):
-    def __repr__(self) -> str:
-        return f"Version('{self}')"
-
-
-@define
-class DistInfo:
-    edition: str
-    operating_system: str
-    dl_page_urls: tuple[Version, str]
-
-
-@define
-class Download:
-    filename: str
-    dist_url: str
-    cdn_url: Optional[str]
-    sha1: str
-    version: Version
-    ident: int
-    updated_date: datetime.date
-    listed_size: int
-    operating_system: str
-    edition: str
-    package: str
-    tab: str
+# per url detail, --verbose turns it on
+log = logging.getLogger("quartus")
 
 
 static_dist_infos = [
@@ -418,28 +389,34 @@ static_dist_infos = [
     ),
 ]
 
-retry_kwargs = {
-    "stop": tenacity.stop_after_attempt(5),
-    "wait": tenacity.wait_exponential(min=15, max=60),
-}
+user_agent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.1 Safari/605.1.15"
+proxies = {"http": "http://localhost:8888", "https": "http://localhost:8888"}
+ca_file: Optional[str] = "charles.pem"
 
 
-def init() -> tuple[mechanize.Browser, requests.Session]:
-    br = mechanize.Browser()
-    br.set_handle_robots(False)
-    br.set_header(
-        "User-Agent",
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.1 Safari/605.1.15",
-    )
+def init_session() -> requests.Session:
+    # no response cache on this path: it only follows the eula and cdn redirects, which
+    # set cookies and hand out expiring links. Crawled pages are cached in fetch_page.
     session = requests.Session()
-
-    proxies = {"http": "http://localhost:8888", "https": "http://localhost:8888"}
-    br.set_proxies(proxies)
-    br.set_ca_data("charles.pem")
     session.proxies = proxies
-    session.verify = "charles.pem"
+    if ca_file is not None:
+        session.verify = ca_file
+    adapter = ThrottledAdapter(throttle)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-    return br, session
+
+def init(cookiejar: Optional[CookieJar] = None) -> tuple[mechanize.Browser, requests.Session]:
+    br = mechanize.Browser()
+    br.set_handle_robots(False)
+    if cookiejar is not None:
+        br.set_cookiejar(cookiejar)
+    br.set_header("User-Agent", user_agent)
+    br.set_proxies(proxies)
+    if ca_file is not None:
+        br.set_ca_data(ca_file)
+    return br, init_session()
 
 
 def login(br):
@@ -453,7 +430,6 @@ def login(br):
     assert len(html.xpath("//span[@id='logged-in-scenario']")) == 1
 
 
-# @tenacity.retry(**retry_kwargs)
 def get_dist_link_info(dl_page_url: str, br: mechanize.Browser) -> list[DistInfo]:
     print(f"opening dl link url {dl_page_url}")
     br.open(dl_page_url)
@@ -502,40 +478,38 @@ def xp_contains(attrib: str, val: str) -> str:
     return f"contains(concat(' ',normalize-space(@{attrib}),' '),' {val} ')"
 
 
-def byte_size(size_str: str) -> int:
-    sz, unit = size_str.split()
-    sz = float(sz)
-    unit = unit.lower()
-    if unit == "kb":
-        sz *= 1024
-    elif unit == "mb":
-        sz *= 1024 * 1024
-    elif unit == "gb":
-        sz *= 1024 * 1024 * 1024
-    return int(sz)
-
-
-@static_vars(cookies=None)
-@tenacity.retry(**retry_kwargs)
-def get_cdn_url(session, url: str) -> str:
-    f = get_cdn_url
-    if f.cookies is None:
-        expired = True
-    else:
-        expired = False
-        for c in f.cookies:
-            expired |= c.is_expired(time.time() - 60)
-    if expired:
-        r = session.head(url, allow_redirects=True)
-        f.cookies = CookieJar()
-        for c in r.cookies:
-            f.cookies.set_cookie(c)
-
-    print(f"get_cdn_url: {url}")
+@define
+class CdnCookies:
+    jar: CookieJar = field(factory=CookieJar)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def expired(self) -> bool:
+        # refresh a minute early so in-flight resolutions don't race the expiry
+        deadline = time.time() + 60
+        return len(self.jar) == 0 or any(c.is_expired(deadline) for c in self.jar)
+
+    def get(self, session, url: str) -> CookieJar:
+        with self.lock:
+            if self.expired():
+                r = session.head(url, allow_redirects=True)
+                jar = CookieJar()
+                for c in r.cookies:
+                    jar.set_cookie(c)
+                self.jar = jar
+            return self.jar
+
+
+def get_cdn_url(session, url: str, cdn_cookies: CdnCookies) -> str:
+    # retried by the caller through throttled_map, the session's adapter has already told
+    # the host limiters about any 429/5xx/homepage bounce along the way
+    cookies = cdn_cookies.get(session, url)
+    log.debug("get_cdn_url: %s", url)
     url_eula = url.replace("getContent", "acceptEula")
-    session.get(url_eula, cookies=f.cookies, allow_redirects=True)
-    r = session.head(url, cookies=f.cookies, allow_redirects=True)
-    print(f"url: {url} cdn url: {r.url}")
+    session.get(url_eula, cookies=cookies, allow_redirects=True)
+    r = session.head(url, cookies=cookies, allow_redirects=True)
+    log.debug("url: %s cdn url: %s", url, r.url)
+    if is_throttled(r.status_code, r.url):
+        raise Throttled(f"{url} throttled: {r.status_code} {r.url}")
     assert "downloads.intel.com/akdlm" in r.url
     return r.url
 
@@ -587,32 +561,257 @@ def get_download_no_cdn_url(dl_div, operating_system, edition) -> Download:
     )
 
 
-def get_download(dl: Download, session) -> Download:
-    dl.cdn_url = get_cdn_url(session, dl.dist_url)
+def get_download(dl: Download, session, cdn_cookies: CdnCookies) -> Download:
+    dl.cdn_url = get_cdn_url(session, dl.dist_url, cdn_cookies)
     return dl
 
 
-# @tenacity.retry(**retry_kwargs)
-def get_downloads_no_cdn_url(dl_page_url: str, br, session) -> list[Download]:
-    print(f"get_downloads: {dl_page_url}")
-    dls = []
-    br.open(dl_page_url + "?foobar=1")  # ? prevents infinite redirect
-    html = lxml.html.fromstring(br.response().get_data().decode("utf-8"))
-    if "Pro" in br.title():
+def page_title(html) -> str:
+    return " ".join(html.findtext(".//title", "").split())
+
+
+def page_fingerprint(html) -> str:
+    # only hash the kit listings, the rest of the page has per-request noise
+    sha1 = hashlib.sha1()
+    for div in xp_kits(html):
+        sha1.update(etree.tostring(div))
+    return sha1.hexdigest()
+
+
+def page_request_url(dl_page_url: str) -> str:
+    return dl_page_url + "?foobar=1"  # ? prevents infinite redirect
+
+
+def conditional_headers(prev: Optional[PageState]) -> dict[str, str]:
+    headers = {}
+    if prev is not None and prev.etag is not None:
+        headers["If-None-Match"] = prev.etag
+    if prev is not None and prev.last_modified is not None:
+        headers["If-Modified-Since"] = prev.last_modified
+    return headers
+
+
+def cached_page(dl_page_url: str, cache=None) -> Optional[tuple[bytes, PageState]]:
+    if cache is None:
+        return None
+    cached = cache.get("GET", page_request_url(dl_page_url))
+    if cached is None:
+        return None
+    etag, last_modified = cached.headers.get("ETag"), cached.headers.get("Last-Modified")
+    return cached.body, PageState(dl_page_url, etag, last_modified)
+
+
+def cache_page(data: bytes, state: PageState, cache=None) -> None:
+    if cache is None:
+        return
+    validators = {"ETag": state.etag, "Last-Modified": state.last_modified}
+    validators = {k: v for k, v in validators.items() if v is not None}
+    cache.put("GET", page_request_url(state.url), None, 200, validators, data)
+
+
+def fetch_page(
+    dl_page_url: str, br, prev: Optional[PageState], cache=None
+) -> tuple[Optional[bytes], PageState]:
+    url = page_request_url(dl_page_url)
+    if (cached := cached_page(dl_page_url, cache)) is not None:
+        return cached
+    req = mechanize.Request(url, headers=conditional_headers(prev))
+    limiter = throttle.for_url(url)
+    with limiter.request():
+        start = time.perf_counter()
+        try:
+            br.open(req)
+        except mechanize.HTTPError as e:
+            metrics.request(limiter.host, e.code, time.perf_counter() - start)
+            if limiter.report(e.code, None, e.headers.get("Retry-After")):
+                retry_after = parse_retry_after(e.headers.get("Retry-After"))
+                raise Throttled(f"{url} throttled: {e.code}", retry_after)
+            if e.code == 304:
+                return None, prev
+            raise
+        except mechanize.URLError:
+            metrics.request(limiter.host, "error", time.perf_counter() - start)
+            limiter.backoff()
+            raise
+        metrics.request(limiter.host, br.response().code, time.perf_counter() - start)
+        if limiter.report(br.response().code, br.geturl()):
+            raise Throttled(f"{url} redirected to {br.geturl()}")
+    info = br.response().info()
+    state = PageState(dl_page_url, info.get("ETag"), info.get("Last-Modified"))
+    data = br.response().get_data()
+    cache_page(data, state, cache)
+    return data, state
+
+
+def title_edition_os(title: str) -> tuple[str, str]:
+    if "Pro" in title:
         edition = "pro"
-    elif "Standard" in br.title():
+    elif "Standard" in title:
         edition = "standard"
-    elif "Lite" in br.title():
+    elif "Lite" in title:
         edition = "lite"
-    dl_divs = html.xpath(
-        f".//div[{xp_contains('class', 'kit-detail-detailed-package__downloads')}]"
-    )
     # mpfr windows pro 22.2 doesn't list OS
-    if "Windows" in br.title():
+    if "Windows" in title:
         operating_system = "windows"
-    elif "Linux" in br.title():
+    elif "Linux" in title:
         operating_system = "linux"
-    return list(map(lambda div: get_download_no_cdn_url(div, operating_system, edition), dl_divs))
+    return edition, operating_system
+
+
+# compiled once, parse_downloads_no_cdn_url walks the page top down with these so the kit
+# tab and package headers are looked up once per container instead of once per download
+xp_kits = etree.XPath(f"//div[{xp_contains('class', 'kit-detail-internals-kits')}]")
+xp_kit_tabs = etree.XPath(
+    f".//div[{xp_contains('class', 'kit-detail-internals-kits__tabs')}][1]//button"
+)
+xp_kit_packages = etree.XPath(f".//div[{xp_contains('class', 'kit-detail-internals-kits__kit')}]")
+xp_package_header = etree.XPath("(.//h3)[1]")
+xp_package_downloads = etree.XPath(
+    f".//div[{xp_contains('class', 'kit-detail-detailed-package__downloads')}]"
+)
+xp_download_button = etree.XPath("(.//button[@data-direct-path or @data-href])[1]")
+xp_download_details = etree.XPath(
+    f".//li[{xp_contains('class', 'kit-detail-detailed-package__list-detail')}]"
+)
+whitespace_re = re.compile(r"\s+")
+html_parser = lxml.html.HTMLParser(encoding="utf-8")
+
+
+def parse_html(data: bytes):
+    # straight from bytes, decoding to str first only for lxml to re-encode it is slower
+    return lxml.html.document_fromstring(data, parser=html_parser)
+
+
+@functools.lru_cache(maxsize=None)
+def parse_version(ver_str: str) -> Version:
+    return Version(ver_str)
+
+
+@functools.lru_cache(maxsize=None)
+def parse_date(date_str: str) -> datetime.date:
+    m, d, y = map(int, date_str.split("/"))
+    return datetime.date(y, m, d)
+
+
+def parse_download_details(dl_div) -> tuple[str, str, dict[str, str]]:
+    dl_butt = xp_download_button(dl_div)[0]
+    dl_str, fname = dl_butt.text_content().split()
+    assert dl_str == "Download"
+    details = {}
+    for li in xp_download_details(dl_div):
+        key, _, val = whitespace_re.sub(" ", li.text_content()).strip().partition(": ")
+        details[key] = val
+    return fname, dl_butt.attrib["data-href"], details
+
+
+def parse_downloads_no_cdn_url(html) -> list[Download]:
+    edition, operating_system = title_edition_os(page_title(html))
+    dls = []
+    for kits_div in xp_kits(html):
+        tabs = [button.text for button in xp_kit_tabs(kits_div)]
+        for package_div in xp_kit_packages(kits_div):
+            tab = tabs[int(package_div.attrib["id"].split("-")[-1])]
+            package = xp_package_header(package_div)[0].text
+            for dl_div in xp_package_downloads(package_div):
+                fname, dist_url, details = parse_download_details(dl_div)
+                sha1_str = details["sha1"].lower()
+                assert len(sha1_str) == 40
+                dls.append(
+                    Download(
+                        fname,
+                        dist_url,
+                        None,
+                        sha1_str,
+                        parse_version(details["Version"]),
+                        int(details["ID"]),
+                        parse_date(details["Last Updated"]),
+                        byte_size(details["Size"].replace(",", "")),
+                        operating_system,
+                        edition,
+                        package,
+                        tab,
+                    )
+                )
+    return dls
+
+
+def crawl_page(dl_page_url: str, br, prev: Optional[PageState] = None, cache=None) -> CrawledPage:
+    # conditional fetch, then only parse the downloads if the kit listings changed
+    log.debug("get_downloads: %s", dl_page_url)
+    data, state = fetch_page(dl_page_url, br, prev, cache)
+    return crawled_page(data, state, prev)
+
+
+def crawled_page(data: Optional[bytes], state: PageState, prev: Optional[PageState]) -> CrawledPage:
+    if data is None:
+        return CrawledPage(state, None)
+    html = parse_html(data)
+    state.fingerprint = page_fingerprint(html)
+    if prev is not None and prev.fingerprint == state.fingerprint:
+        return CrawledPage(state, None)
+    return CrawledPage(state, parse_downloads_no_cdn_url(html))
+
+
+def get_downloads_no_cdn_url(dl_page_url: str, br, session) -> list[Download]:
+    return crawl_page(dl_page_url, br).downloads
+
+
+def crawl_downloads_no_cdn_url(
+    dist_infos: list[DistInfo],
+    cookiejar: CookieJar,
+    jobs: int = 8,
+    prev_states: Optional[dict[str, PageState]] = None,
+    cache=None,
+) -> list[CrawledPage]:
+    # mechanize.Browser isn't thread safe, so each worker gets its own browser
+    # sharing the logged-in (internally locked) cookie jar. Offline, pages that aren't
+    # cached are left out.
+    from quartus_cache import CacheMiss
+
+    tls = threading.local()
+    prev_states = prev_states or {}
+    offline = cache is not None and cache.offline
+
+    def crawl(dist_url: str) -> CrawledPage:
+        if not hasattr(tls, "br"):
+            tls.br = None if offline else init(cookiejar)[0]
+        return crawl_page(dist_url, tls.br, prev_states.get(dist_url), cache)
+
+    dist_urls = [url for dist_info in dist_infos for _, url in dist_info.dl_page_urls]
+    pages = {}
+    for dist_url, page, exc in throttled_map(crawl, dist_urls, jobs, permanent=(CacheMiss,)):
+        if isinstance(exc, CacheMiss):
+            continue
+        if exc is not None:
+            raise exc
+        pages[dist_url] = page
+    return [pages[url] for url in dist_urls if url in pages]
+
+
+def resolve_cdn_urls(
+    dls: list[Download],
+    catalog,
+    jobs: int = 16,
+    session_factory: Callable[[], requests.Session] = init_session,
+) -> list[Download]:
+    # fills in cdn_url in place and saves each resolved Download to the catalog as it
+    # completes so an interrupted run keeps everything resolved so far
+    cdn_cookies = CdnCookies()
+    tls = threading.local()
+
+    def resolve(dl: Download) -> Download:
+        if not hasattr(tls, "session"):
+            tls.session = session_factory()
+        return get_download(dl, tls.session, cdn_cookies)
+
+    resolved = []
+    for dl, _, exc in throttled_map(resolve, [dl for dl in dls if dl.cdn_url is None], jobs):
+        if exc is not None:
+            print(f"failed to resolve {dl.dist_url}: {exc!r}")
+            continue
+        catalog.resolved([dl])
+        resolved.append(dl)
+    return resolved
 
 
 def get_dist_downloads(dist: DistInfo, br, session, pool) -> dict[Version, Download]:
@@ -622,9 +821,31 @@ def get_dist_downloads(dist: DistInfo, br, session, pool) -> dict[Version, Downl
     return dls
 
 
-def main(pool):
-    br, session = init()
-    login(br)
+def main(
+    crawl: bool,
+    full: bool,
+    resolve: bool,
+    catalog_path: str,
+    crawl_jobs: int,
+    resolve_jobs: int,
+    cache_dir: Optional[str],
+    cache_ttl: float,
+    offline: bool,
+    use_async: bool = False,
+    plan_path: Optional[str] = None,
+):
+    from quartus_cache import ResponseCache
+    from quartus_catalog import Catalog
+    from quartus_cdn import expiry_margin
+
+    cache = None
+    if cache_dir is not None:
+        cache = ResponseCache(cache_dir, ttl=cache_ttl, offline=offline)
+
+    cookiejar = mechanize.CookieJar()
+    if not offline:
+        br, session = init(cookiejar)
+        login(br)
 
     # dist_infos = get_dist_infos(br)
     dist_infos = static_dist_infos
@@ -632,32 +853,104 @@ def main(pool):
     with open("dist_infos.txt", "w") as f:
         print(dist_infos, file=f)
 
-    num_dist_vers = sum(len(di.dl_page_urls) for di in dist_infos)
-
-    if True:
-        dls_no_cdn_url = []
-        for dist_info in dist_infos:
-            for ver, dist_url in dist_info.dl_page_urls:
-                dls_no_cdn_url += get_downloads_no_cdn_url(dist_url, br, session)
-                # pass
-
-        with open("downloads_no_cdn_url.txt", "w") as f:
-            print(dls_no_cdn_url, file=f)
-        pickle.dump(dls_no_cdn_url, open("downloads_no_cdn_url.pickle", "wb"))
-    else:
-        dls_no_cdn_url = pickle.load(open("downloads_no_cdn_url.pickle", "rb"))
-    print(dls_no_cdn_url)
-
-    if True:
-        dls = pool.starmap()
-
-    # dist = next(i for i in dist_infos if i.edition == "pro" and i.operating_system == "windows")
-    # dls_no_cdn_url = get_downloads_no_cdn_url("https://www.intel.com/content/www/us/en/software-kit/661713/intel-quartus-prime-pro-edition-design-software-version-19-2-for-windows.html", br, session)
-    # print(dls_no_cdn_url)
-    # with open("downloads_no_cdn_url.txt", "w") as f:
-    #     print(dls_no_cdn_url, file=f)
+    with Catalog(catalog_path) as catalog:
+        if crawl:
+            metrics.stage = "crawl"
+            prev_states = {} if full or offline else catalog.page_states()
+            crawl_fn = crawl_downloads_no_cdn_url
+            if use_async:
+                from quartus_async import crawl_downloads_no_cdn_url as crawl_fn
+            pages = crawl_fn(dist_infos, cookiejar, crawl_jobs, prev_states, cache)
+            if offline:
+                # the cache may be stale or partial, so a replay only exercises the parsers
+                num_dls = sum(len(page.downloads) for page in pages if page.downloads is not None)
+                print(f"replayed {len(pages)} cached pages, {num_dls} downloads, catalog untouched")
+            else:
+                changes = {}
+                for page in pages:
+                    for change, n in catalog.apply_page(page).items():
+                        changes[change] = changes.get(change, 0) + n
+                num_parsed = sum(page.downloads is not None for page in pages)
+                print(f"crawled {len(pages)} pages, {num_parsed} changed: {changes}")
+            if cache is not None:
+                print(f"page cache: {cache.hits} hits, {cache.misses} misses")
+
+        if resolve and not offline:
+            metrics.stage = "resolve"
+            expired = catalog.expire_cdn_urls(expiry_margin)
+            if expired:
+                print(f"dropped {expired} cdn urls close to expiry")
+            if plan_path is not None:
+                from quartus_plan import Plan, to_resolve
+
+                plan = Plan.load(plan_path)
+                dls_no_cdn_url = to_resolve(plan, plan.downloads(catalog))
+            else:
+                dls_no_cdn_url = catalog.query(resolved=False)
+            resolve_fn = resolve_cdn_urls
+            if use_async:
+                from quartus_async import resolve_cdn_urls as resolve_fn
+            dls = resolve_fn(dls_no_cdn_url, catalog, resolve_jobs)
+            print(f"resolved {len(dls)} of {len(dls_no_cdn_url)} cdn urls")
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Quartus installer archiver")
+    parser.add_argument("-c", "--catalog", default="quartus.sqlite", help="catalog database")
+    parser.add_argument(
+        "--no-crawl", dest="crawl", action="store_false", help="don't refresh the catalog"
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="re-parse every page even if it hasn't changed"
+    )
+    parser.add_argument(
+        "--no-resolve", dest="resolve", action="store_false", help="don't resolve cdn urls"
+    )
+    parser.add_argument(
+        "--crawl-jobs", type=int, default=8, help="max concurrent download page fetches"
+    )
+    parser.add_argument(
+        "--resolve-jobs", type=int, default=16, help="max concurrent cdn url resolutions"
+    )
+    parser.add_argument("--cache-dir", help="cache crawled pages in this directory")
+    parser.add_argument(
+        "--cache-ttl", type=float, default=24 * 60 * 60, help="seconds a cached page is fresh"
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="replay cached pages through the parsers without touching the network",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="crawl and resolve on one asyncio event loop, jobs then bound requests in flight",
+    )
+    parser.add_argument(
+        "--plan", help="resolve only what this plan still needs to fetch, see quartus_plan"
+    )
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    metrics_args(args)
+    if args.offline and args.cache_dir is None:
+        parser.error("--offline needs --cache-dir")
+    main(
+        args.crawl,
+        args.full,
+        args.resolve,
+        args.catalog,
+        args.crawl_jobs,
+        args.resolve_jobs,
+        args.cache_dir,
+        args.cache_ttl,
+        args.offline,
+        args.use_async,
+        args.plan,
+    )
 
 
 if __name__ == "__main__":
-    pool = Pool(10)
-    main(pool)
+    # other modules import this file by name, share this copy with them
+    sys.modules.setdefault("quartus_archive_test", sys.modules[__name__])
+    cli()
@@ -0,0 +1,486 @@
+import asyncio
+import os
+import ssl
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from http.cookiejar import CookieJar
+from http.cookies import SimpleCookie
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional, TypeVar
+
+import aiohttp
+from attrs import define, field
+from rich import print
+from yarl import URL
+
+import quartus_archive_test as qat
+from quartus_archive_test import (
+    CrawledPage,
+    DistInfo,
+    Download,
+    PageState,
+    cache_page,
+    cached_page,
+    conditional_headers,
+    crawled_page,
+    log,
+    page_request_url,
+)
+from quartus_cdn import LinkExpired, Revalidator
+from quartus_download import (
+    Scheduler,
+    SegmentedDownload,
+    already_have,
+    chunk_size,
+    connect_timeout,
+    pwrite_all,
+    quarantine,
+)
+from quartus_metrics import metrics
+from quartus_model import ChecksumMismatch, archive_path
+from quartus_store import BlobStore
+from quartus_throttle import (
+    HostLimiter,
+    Throttle,
+    Throttled,
+    parse_retry_after,
+    throttle,
+)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def ssl_context() -> Optional[ssl.SSLContext]:
+    if qat.ca_file is None:
+        return None
+    return ssl.create_default_context(cafile=qat.ca_file)
+
+
+def copy_cookies(cookiejar: CookieJar, jar: aiohttp.CookieJar) -> None:
+    # carry a mechanize login over to the aiohttp session
+    for c in cookiejar:
+        morsel = SimpleCookie()
+        morsel[c.name] = c.value
+        morsel[c.name]["domain"] = c.domain
+        morsel[c.name]["path"] = c.path
+        jar.update_cookies(morsel, URL(f"https://{c.domain.lstrip('.')}/"))
+
+
+@define
+class Engine:
+    # one event loop and one aiohttp keep-alive pool for a whole run. concurrency bounds the
+    # requests in flight and the open sockets, the host limiters shared with the threaded
+    # code still decide how many of those each host gets.
+    concurrency: int = 1024
+    stall_timeout: float = 30
+    attempts: int = 5
+    throttle: Throttle = throttle
+    http: Optional[aiohttp.ClientSession] = None
+    sem: Optional[asyncio.Semaphore] = None
+    released: dict[str, asyncio.Event] = field(factory=dict)
+
+    async def __aenter__(self) -> "Engine":
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=0,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+            ssl=ssl_context() or True,
+        )
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=self.stall_timeout)
+        self.http = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            # unsafe lets the jar keep cookies for bare ip hosts, like a local test server
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            headers={"User-Agent": qat.user_agent},
+        )
+        self.sem = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.http.close()
+
+    def proxy(self, url: str) -> Optional[str]:
+        return qat.proxies.get(url.split(":", 1)[0])
+
+    @asynccontextmanager
+    async def slot(self, url: str) -> AsyncIterator[HostLimiter]:
+        limiter = self.throttle.for_url(url)
+        released = self.released.setdefault(limiter.host, asyncio.Event())
+        while not limiter.try_acquire():
+            released.clear()
+            try:
+                # threads sharing the limiter don't set the event, so look again now and then
+                await asyncio.wait_for(released.wait(), 0.1)
+            except asyncio.TimeoutError:
+                pass
+        try:
+            if (delay := limiter.bucket.reserve()) > 0:
+                await asyncio.sleep(delay)
+            yield limiter
+        finally:
+            limiter.release()
+            released.set()
+
+    @asynccontextmanager
+    async def request(
+        self, method: str, url: str, **kwargs
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        # one limiter slot per request and its redirects, judged on where it ended up. Like
+        # ThrottledAdapter the slot is given back once the headers are in, not held while the
+        # caller streams the body
+        async with AsyncExitStack() as stack:
+            async with self.slot(url) as limiter:
+                start = time.perf_counter()
+                try:
+                    r = await stack.enter_async_context(
+                        self.http.request(method, url, proxy=self.proxy(url), **kwargs)
+                    )
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    metrics.request(limiter.host, "error", time.perf_counter() - start)
+                    limiter.backoff()
+                    raise
+                metrics.request(limiter.host, r.status, time.perf_counter() - start)
+                retry_after = r.headers.get("Retry-After")
+                if limiter.report(r.status, str(r.url), retry_after):
+                    raise Throttled(
+                        f"{method} {url} throttled: {r.status} {r.url}",
+                        parse_retry_after(retry_after),
+                    )
+            yield r
+
+    async def map(
+        self,
+        fn: Callable[[T], Awaitable[R]],
+        items: Iterable[T],
+        permanent: tuple[type[BaseException], ...] = (),
+    ) -> AsyncIterator[tuple[T, Optional[R], Optional[BaseException]]]:
+        # every item is a task, one waiting out a retry backoff holds nothing but its frame.
+        # Errors in permanent aren't retried
+        async def run(item: T) -> tuple[T, Optional[R], Optional[BaseException]]:
+            for attempt in range(1, self.attempts + 1):
+                try:
+                    async with self.sem:
+                        return item, await fn(item), None
+                except Exception as e:
+                    if attempt == self.attempts or isinstance(e, permanent):
+                        return item, None, e
+                    metrics.inc("quartus_retries_total")
+                    await asyncio.sleep(self.throttle.retry_delay(attempt, e))
+
+        for task in asyncio.as_completed([run(item) for item in items]):
+            yield await task
+
+    async def fetch_page(
+        self, dl_page_url: str, prev: Optional[PageState], cache=None
+    ) -> tuple[Optional[bytes], PageState]:
+        if (cached := cached_page(dl_page_url, cache)) is not None:
+            return cached
+        url = page_request_url(dl_page_url)
+        async with self.request("GET", url, headers=conditional_headers(prev)) as r:
+            if r.status == 304:
+                return None, prev
+            r.raise_for_status()
+            data = await r.read()
+            state = PageState(dl_page_url, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+        cache_page(data, state, cache)
+        return data, state
+
+    async def crawl_page(
+        self, dl_page_url: str, prev: Optional[PageState] = None, cache=None
+    ) -> CrawledPage:
+        data, state = await self.fetch_page(dl_page_url, prev, cache)
+        # parsing is cpu bound, keep it off the event loop
+        return await asyncio.to_thread(crawled_page, data, state, prev)
+
+    async def crawl(
+        self, dist_infos: list[DistInfo], prev_states: Optional[dict[str, PageState]], cache=None
+    ) -> list[CrawledPage]:
+        from quartus_cache import CacheMiss
+
+        prev_states = prev_states or {}
+        dist_urls = [url for dist_info in dist_infos for _, url in dist_info.dl_page_urls]
+        pages = {}
+        crawl = lambda url: self.crawl_page(url, prev_states.get(url), cache)
+        async for dist_url, page, exc in self.map(crawl, dist_urls, permanent=(CacheMiss,)):
+            # offline, pages that aren't cached are left out
+            if isinstance(exc, CacheMiss):
+                continue
+            if exc is not None:
+                raise exc
+            pages[dist_url] = page
+        return [pages[url] for url in dist_urls if url in pages]
+
+    async def get_cdn_url(self, url: str) -> str:
+        # the session's cookie jar carries the eula acceptance over to getContent
+        log.debug("get_cdn_url: %s", url)
+        async with self.request("GET", url.replace("getContent", "acceptEula")):
+            pass
+        async with self.request("HEAD", url) as r:
+            cdn_url = str(r.url)
+        log.debug("url: %s cdn url: %s", url, cdn_url)
+        assert "downloads.intel.com/akdlm" in cdn_url
+        return cdn_url
+
+    async def resolve(self, dls: list[Download], catalog) -> list[Download]:
+        async def resolve(dl: Download) -> Download:
+            dl.cdn_url = await self.get_cdn_url(dl.dist_url)
+            return dl
+
+        resolved = []
+        async for dl, _, exc in self.map(resolve, [dl for dl in dls if dl.cdn_url is None]):
+            if exc is not None:
+                print(f"failed to resolve {dl.dist_url}: {exc!r}")
+                continue
+            catalog.resolved([dl])
+            resolved.append(dl)
+        return resolved
+
+    async def download(
+        self,
+        dl: Download,
+        root: str,
+        segments: int = 8,
+        store: Optional[BlobStore] = None,
+        resolver: Optional[Revalidator] = None,
+        **kwargs,
+    ) -> str:
+        path = archive_path(root, dl)
+        # linking may have to unpack a stored blob first
+        if await asyncio.to_thread(already_have, dl, path, store):
+            return path
+        if resolver is not None and resolver.stale(dl):
+            await asyncio.to_thread(resolver.resolve, dl)
+        assert dl.cdn_url is not None
+        print(f"downloading {dl.filename} to {path}")
+        start = time.perf_counter()
+        relinked = False
+        while True:
+            used_at = time.time()
+            sd = AsyncSegmentedDownload(
+                dl.cdn_url,
+                path,
+                num_segments=segments,
+                expected_sha1=dl.sha1,
+                engine=self,
+                **kwargs,
+            )
+            try:
+                await sd.run_async()
+                break
+            except ChecksumMismatch as e:
+                print(f"[red]{e}, quarantined to {quarantine(root, sd.part_path)}[/red]")
+                raise
+            except LinkExpired:
+                if resolver is None or relinked:
+                    raise
+                await asyncio.to_thread(resolver.resolve, dl, True)
+                relinked = True
+        if resolver is not None:
+            await asyncio.to_thread(resolver.worked, dl, used_at)
+        sd.observe(time.perf_counter() - start)
+        if store is not None:
+            await asyncio.to_thread(store.ingest, path, dl.sha1)
+        return path
+
+    async def download_all(self, scheduler: Scheduler, dls: list[Download]) -> list[Download]:
+        # Scheduler.run's admission loop with tasks in place of pool threads
+        queue = scheduler.queue(dls)
+        kwargs = scheduler.download_kwargs()
+        done = []
+        running = {}
+        while queue or running:
+            while len(running) < scheduler.jobs and (admitted := scheduler.admit(queue, running)):
+                same, _ = admitted
+                coro = self.download(
+                    same[0],
+                    scheduler.root,
+                    scheduler.segments,
+                    scheduler.store,
+                    scheduler.resolver,
+                    **kwargs,
+                )
+                running[asyncio.create_task(coro)] = admitted
+            if not running:
+                if queue:
+                    await asyncio.sleep(max(0.0, scheduler.window_left()))
+                continue
+            timeout = None
+            if scheduler.window_bytes is not None and queue:
+                timeout = max(0.0, scheduler.window_left())
+            finished, _ = await asyncio.wait(
+                running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in finished:
+                same, charge = running.pop(task)
+                # links the other listings of the file, which can unpack a stored blob
+                if await asyncio.to_thread(scheduler.finished, same, charge, task.exception()):
+                    done += same
+        return done
+
+
+@define
+class AsyncSegmentedDownload(SegmentedDownload):
+    # the same piece planning, journal and prefix hashing with each connection a coroutine.
+    # Bodies are read in chunk_size pieces and each is written, hashed and checkpointed on a
+    # thread, so disk and sha1 work doesn't hold up the other connections.
+    engine: Optional[Engine] = None
+    # writes still running on a thread, a cancelled connection doesn't stop its write
+    writes: set[asyncio.Future] = field(factory=set)
+
+    def write(self, fd: int, offset: int, data: memoryview) -> None:
+        pwrite_all(fd, data, offset)
+        self.wrote(offset, data)
+
+    async def write_async(self, fd: int, offset: int, data: memoryview) -> None:
+        future = asyncio.get_running_loop().run_in_executor(None, self.write, fd, offset, data)
+        self.writes.add(future)
+        future.add_done_callback(self.writes.discard)
+        await asyncio.shield(future)
+
+    async def body_pieces(self, r: aiohttp.ClientResponse) -> AsyncIterator[bytes]:
+        while True:
+            try:
+                yield await r.content.readexactly(chunk_size)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    yield e.partial
+                return
+
+    async def probe_async(self) -> Optional[int]:
+        async with self.engine.request("HEAD", self.url) as r:
+            self.check_status(r.status)
+            r.raise_for_status()
+            if r.headers.get("Accept-Ranges", "none").lower() != "bytes":
+                return None
+            if "Content-Length" not in r.headers:
+                return None
+            return int(r.headers["Content-Length"])
+
+    async def throttle_bandwidth(self, n: int) -> None:
+        if self.bandwidth is not None and (delay := self.bandwidth.reserve(n)) > 0:
+            await asyncio.sleep(delay)
+
+    async def fetch_segment_async(self, fd: int, seg) -> None:
+        attempt = 0
+        while seg.remaining > 0:
+            headers = {"Range": f"bytes={seg.start}-{seg.end - 1}"}
+            start = seg.start
+            try:
+                async with self.engine.request("GET", self.url, headers=headers) as r:
+                    self.check_status(r.status)
+                    r.raise_for_status()
+                    if r.status != 206:
+                        raise ValueError(f"server ignored range request for {self.url}")
+                    async for chunk in self.body_pieces(r):
+                        await self.throttle_bandwidth(len(chunk))
+                        offset, n = self.reserve(seg, len(chunk))
+                        if n:
+                            await self.write_async(fd, offset, memoryview(chunk)[:n])
+                        if n < len(chunk) or seg.remaining == 0:
+                            # segment was shortened by a steal
+                            break
+                    if seg.remaining > 0 and seg.start == start:
+                        # re-requesting a range that came back empty would never end
+                        raise ValueError(f"empty range response from {self.url}")
+                    attempt = 0
+            except (aiohttp.ClientError, asyncio.TimeoutError, Throttled, ValueError) as e:
+                # only a pass that got nowhere counts towards giving up
+                if seg.start > start:
+                    attempt = 0
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                metrics.inc("quartus_retries_total", host=self.host)
+                print(f"segment {seg.start}-{seg.end} of {self.path} failed: {e!r}, retrying")
+                await asyncio.sleep(self.engine.throttle.retry_delay(attempt, e))
+
+    async def worker_async(self, fd: int) -> None:
+        while (seg := self.next_segment()) is not None:
+            await self.fetch_segment_async(fd, seg)
+
+    async def fetch_single_stream_async(self, fd: int) -> None:
+        async with self.engine.request("GET", self.url) as r:
+            self.check_status(r.status)
+            r.raise_for_status()
+            offset = 0
+            async for chunk in self.body_pieces(r):
+                await self.throttle_bandwidth(len(chunk))
+                await self.write_async(fd, offset, memoryview(chunk))
+                offset += len(chunk)
+            self.size = offset
+
+    async def run_async(self) -> str:
+        if self.size is None:
+            self.size = await self.probe_async()
+        fd = self.open()
+        try:
+            if self.size is None:
+                os.ftruncate(fd, 0)
+                await self.fetch_single_stream_async(fd)
+                await asyncio.to_thread(self.verify)
+                await asyncio.to_thread(self.commit, fd)
+                return self.path
+            if await asyncio.to_thread(self.prepare, fd):
+                workers = [
+                    asyncio.create_task(self.worker_async(fd))
+                    for _ in range(min(self.num_segments, len(self.pending)))
+                ]
+                try:
+                    await asyncio.gather(*workers)
+                except BaseException:
+                    for worker in workers:
+                        worker.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+                    raise
+                finally:
+                    await asyncio.gather(*self.writes, return_exceptions=True)
+                    await asyncio.to_thread(self.journal.flush)
+            await asyncio.to_thread(self.finish, fd)
+        finally:
+            await asyncio.gather(*self.writes, return_exceptions=True)
+            os.close(fd)
+        return self.path
+
+
+# drop in replacements for the threaded entry points, each runs its own event loop
+
+
+def crawl_downloads_no_cdn_url(
+    dist_infos: list[DistInfo],
+    cookiejar: Optional[CookieJar],
+    jobs: int = 1024,
+    prev_states: Optional[dict[str, PageState]] = None,
+    cache=None,
+) -> list[CrawledPage]:
+    async def run() -> list[CrawledPage]:
+        async with Engine(jobs) as engine:
+            if cookiejar is not None:
+                copy_cookies(cookiejar, engine.http.cookie_jar)
+            return await engine.crawl(dist_infos, prev_states, cache)
+
+    return asyncio.run(run())
+
+
+def resolve_cdn_urls(dls: list[Download], catalog, jobs: int = 1024) -> list[Download]:
+    async def run() -> list[Download]:
+        async with Engine(jobs) as engine:
+            return await engine.resolve(dls, catalog)
+
+    return asyncio.run(run())
+
+
+def run_scheduler(scheduler: Scheduler, dls: list[Download]) -> list[Download]:
+    async def run() -> list[Download]:
+        async with Engine() as engine:
+            return await engine.download_all(scheduler, dls)
+
+    return asyncio.run(run())
+
+
+def download_all(
+    dls: list[Download], root: str, jobs: int = 2, segments: int = 8, dedup: bool = True, **kwargs
+) -> list[Download]:
+    store = BlobStore(root) if dedup else None
+    return run_scheduler(Scheduler(root, jobs, segments, store=store, kwargs=kwargs), dls)
@@ -0,0 +1,678 @@
+import argparse
+import asyncio
+import contextlib
+import functools
+import hashlib
+import html as html_escape
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+import attrs
+from attrs import define, field
+from rich import print
+
+import quartus_archive_test as qat
+from quartus_archive_test import Download, Version
+from quartus_metrics import add_metrics_args, metrics, metrics_args
+from quartus_model import size_str
+from quartus_throttle import throttle
+
+
+def nav_noise(rng: random.Random, n: int) -> str:
+    # the real pages carry a few hundred KB of menus and scripts around the kit listing
+    items = "".join(
+        f'<li class="nav-item nav-{i}"><a href="/content/www/us/en/{rng.getrandbits(32):x}.html">'
+        f"<span>Menu entry {i}</span></a></li>"
+        for i in range(n)
+    )
+    return f'<nav class="global-nav"><ul>{items}</ul></nav>'
+
+
+def software_kit_page(
+    edition: str, operating_system: str, version: Version, dls: list[Download], noise: int = 2000
+) -> str:
+    # renders downloads the way an Intel software-kit page lists them: tab buttons up top,
+    # one kit container per package, one downloads block per file
+    rng = random.Random(f"{edition}{operating_system}{version}")
+    tabs = list(dict.fromkeys(dl.tab for dl in dls))
+    packages = {}
+    for dl in dls:
+        packages.setdefault((dl.tab, dl.package), []).append(dl)
+    kits = []
+    for (tab, package), pkg_dls in packages.items():
+        blocks = []
+        for dl in pkg_dls:
+            details = {
+                "Size": size_str(dl.listed_size),
+                "Version": str(dl.version),
+                "ID": str(dl.ident),
+                "Last Updated": f"{dl.updated_date.month}/{dl.updated_date.day}/{dl.updated_date.year}",
+                "sha1": dl.sha1.upper(),
+            }
+            lis = "".join(
+                f'<li class="kit-detail-detailed-package__list-detail">'
+                f"<span>{k}:</span>\n  <span>{html_escape.escape(v)}</span></li>"
+                for k, v in details.items()
+            )
+            blocks.append(
+                f'<div class="kit-detail-detailed-package__downloads">'
+                f'<div class="kit-detail-detailed-package__button">'
+                f'<button class="btn" data-href="{html_escape.escape(dl.dist_url)}">'
+                f"Download {html_escape.escape(dl.filename)}</button></div>"
+                f'<ul class="kit-detail-detailed-package__list">{lis}</ul></div>'
+            )
+        kits.append(
+            f'<div class="kit-detail-internals-kits__kit" id="kit-tab-{tabs.index(tab)}">'
+            f'<div class="kit-detail-internals-kits__header"><h3>{html_escape.escape(package)}</h3>'
+            f"</div>{''.join(blocks)}</div>"
+        )
+    tab_buttons = "".join(f'<button role="tab">{html_escape.escape(t)}</button>' for t in tabs)
+    title = (
+        f"Intel® Quartus® Prime {edition.title()} Edition Design Software Version {version} "
+        f"for {'Windows' if operating_system == 'windows' else 'Linux'}*"
+    )
+    return (
+        f"<html><head><title>{title}</title></head><body>{nav_noise(rng, noise)}"
+        f'<div class="kit-detail-internals-kits"><div class="kit-detail-internals-kits__tabs">'
+        f"{tab_buttons}</div>{''.join(kits)}</div>{nav_noise(rng, noise // 4)}</body></html>"
+    )
+
+
+def catalog_pages(dls: list[Download]) -> list[str]:
+    pages = {}
+    for dl in dls:
+        pages.setdefault((dl.edition, dl.operating_system, dl.version), []).append(dl)
+    return [software_kit_page(ed, os_, ver, page_dls) for (ed, os_, ver), page_dls in pages.items()]
+
+
+def parse_per_div(html) -> list[Download]:
+    # the original parser, one set of xpath queries and ancestor walks per download
+    edition, operating_system = qat.title_edition_os(qat.page_title(html))
+    dl_divs = html.xpath(
+        f".//div[{qat.xp_contains('class', 'kit-detail-detailed-package__downloads')}]"
+    )
+    return [qat.get_download_no_cdn_url(div, operating_system, edition) for div in dl_divs]
+
+
+def best_of(rounds: int, fn: Callable[[], int]) -> tuple[float, float, int]:
+    # best wall and cpu seconds over rounds plus whatever count fn returns
+    best_wall = best_cpu = float("inf")
+    for _ in range(rounds):
+        wall, cpu = time.perf_counter(), time.process_time()
+        n = fn()
+        best_wall = min(best_wall, time.perf_counter() - wall)
+        best_cpu = min(best_cpu, time.process_time() - cpu)
+    return best_wall, best_cpu, n
+
+
+def bench_parse(pages: list[bytes], rounds: int = 3) -> dict:
+    results = {}
+    wall, cpu, n = best_of(rounds, lambda: len([qat.parse_html(page) for page in pages]))
+    results["html"] = {"wall_s": wall, "cpu_s": cpu, "bytes_per_s": sum(map(len, pages)) / wall}
+    print(f"parse {'html':12} {wall:8.3f}s wall {cpu:8.3f}s cpu")
+    docs = [qat.parse_html(page) for page in pages]
+    rows = None
+    for name, parse in (
+        ("per_div", parse_per_div),
+        ("single_pass", qat.parse_downloads_no_cdn_url),
+    ):
+        wall, cpu, n = best_of(rounds, lambda: sum(len(parse(doc)) for doc in docs))
+        assert rows is None or rows == n, f"{name} parsed {n} rows, expected {rows}"
+        rows = n
+        results[name] = {"wall_s": wall, "cpu_s": cpu, "rows": n, "rows_per_s": n / wall}
+        print(f"parse {name:12} {wall:8.3f}s wall {cpu:8.3f}s cpu {n / wall:10.0f} rows/s")
+    assert all(parse_per_div(doc) == qat.parse_downloads_no_cdn_url(doc) for doc in docs)
+    return results
+
+
+def load_pages(cache_dir: Optional[str], catalog_path: str) -> list[bytes]:
+    if cache_dir is not None:
+        from quartus_cache import ResponseCache
+
+        cache = ResponseCache(cache_dir)
+        pages = []
+        for path in cache.entries():
+            with open(path + ".body", "rb") as f:
+                pages.append(f.read())
+        return pages
+    return [page.encode() for page in catalog_pages(load_catalog(catalog_path))]
+
+
+def load_catalog(catalog_path: str) -> list[Download]:
+    # fall back to the legacy crawl checked into the repo
+    if os.path.exists(catalog_path):
+        from quartus_catalog import Catalog
+
+        with Catalog(catalog_path) as catalog:
+            if len(catalog):
+                return catalog.query()
+    from quartus_catalog import load_legacy
+
+    return load_legacy(os.path.join(os.path.dirname(__file__), "downloads_no_cdn_url.pickle"))
+
+
+payload_block = random.Random(0).randbytes(1024 * 1024)
+payload_block2 = payload_block * 2
+
+
+def payload(seed: int, offset: int, n: int) -> bytes:
+    # synthetic file contents, the shared random block rotated by a per-file seed
+    start = (offset + seed * 7919) % len(payload_block)
+    n = min(n, len(payload_block))
+    return payload_block2[start : start + n]
+
+
+def payload_sha1(seed: int, size: int) -> str:
+    sha1 = hashlib.sha1()
+    for offset in range(0, size, len(payload_block)):
+        sha1.update(payload(seed, offset, min(len(payload_block), size - offset)))
+    return sha1.hexdigest()
+
+
+@define
+class FakeIntel:
+    # local stand-in for www.intel.com software-kit pages, the cdrdv2 getContent/acceptEula
+    # redirect chain and the downloads.intel.com/akdlm CDN, all on one port
+    pages: dict[str, bytes] = field(factory=dict)
+    # akdlm path -> (seed, size)
+    files: dict[str, tuple[int, int]] = field(factory=dict)
+    latency: float = 0
+    bandwidth: Optional[float] = None
+    failure_rate: float = 0
+    # page and redirect requests per second above which the server pushes back, like intel
+    # does, with a 429 or a bounce to the homepage
+    max_rps: Optional[float] = None
+    window: list[float] = field(factory=list)
+    throttled: int = 0
+    lock: threading.Lock = field(factory=threading.Lock)
+    server: Optional[ThreadingHTTPServer] = None
+    requests_served: int = 0
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), make_fake_intel_handler(self))
+        self.server.daemon_threads = True
+        # clients hanging up mid body is expected, don't print a traceback for it
+        self.server.handle_error = lambda request, client_address: None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_page(self, n: int, html: str) -> str:
+        path = f"/content/www/us/en/software-kit/{n}/bench-page-{n}.html"
+        self.pages[path] = html.encode()
+        return self.base_url + path
+
+    def over_rate(self) -> bool:
+        if self.max_rps is None:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.window = [t for t in self.window if now - t < 1] + [now]
+            over = len(self.window) > self.max_rps
+            self.throttled += over
+            return over
+
+    def add_file(self, filename: str, seed: int, size: int) -> str:
+        path = f"/downloads.intel.com/akdlm/software/bench/{seed}/{filename}"
+        self.files[path] = (seed, size)
+        return self.base_url + path
+
+
+def make_fake_intel_handler(fake: FakeIntel):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args) -> None:
+            pass
+
+        def cookies(self) -> dict[str, str]:
+            cookies = {}
+            for part in self.headers.get("Cookie", "").split(";"):
+                k, _, v = part.strip().partition("=")
+                cookies[k] = v
+            return cookies
+
+        def reply(self, status: int, headers: dict[str, str], body: bytes = b"") -> None:
+            self.send_response(status)
+            headers = {"Content-Length": str(len(body)), **headers}
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Set-Cookie", "bench_session=1; Path=/; Max-Age=3600")
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def redirect(self, location: str, headers: Optional[dict[str, str]] = None) -> None:
+            self.reply(302, {"Location": location, **(headers or {})})
+
+        def do_HEAD(self) -> None:
+            self.do_GET()
+
+        def do_GET(self) -> None:
+            fake.requests_served += 1
+            if fake.latency:
+                time.sleep(fake.latency)
+            path, _, query = self.path.partition("?")
+            if path not in fake.files and fake.over_rate():
+                if fake.throttled % 2:
+                    self.reply(429, {"Retry-After": "1"})
+                else:
+                    self.redirect("/content/www/us/en/homepage.html?ref=throttled")
+            elif path in fake.pages:
+                self.page(fake.pages[path])
+            elif path.startswith("/v1/dl/acceptEula/"):
+                getcontent = self.path.replace("acceptEula", "getContent")
+                self.redirect(getcontent, {"Set-Cookie": "eula=1; Path=/"})
+            elif path.startswith("/v1/dl/getContent/"):
+                if self.cookies().get("eula") != "1":
+                    self.redirect("/content/www/us/en/download/eula.html")
+                    return
+                filename = query.removeprefix("filename=")
+                ident = path.rsplit("/", 1)[-1]
+                self.redirect(f"/downloads.intel.com/akdlm/software/bench/{ident}/{filename}")
+            elif path in fake.files:
+                self.file(*fake.files[path])
+            elif path in (
+                "/content/www/us/en/homepage.html",
+                "/content/www/us/en/download/eula.html",
+            ):
+                self.reply(200, {"Content-Type": "text/html"}, b"<html><title>Home</title></html>")
+            else:
+                self.reply(404, {})
+
+        def page(self, body: bytes) -> None:
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.reply(304, {"ETag": etag})
+                return
+            self.reply(200, {"Content-Type": "text/html; charset=utf-8", "ETag": etag}, body)
+
+        def file(self, seed: int, size: int) -> None:
+            if fake.failure_rate and random.random() < fake.failure_rate / 2:
+                self.reply(503, {"Retry-After": "1"})
+                return
+            start, end = 0, size
+            rng = self.headers.get("Range")
+            if rng is not None:
+                first, _, last = rng.removeprefix("bytes=").partition("-")
+                start, end = int(first), min(int(last) + 1 if last else size, size)
+            self.send_response(206 if rng is not None else 200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Content-Type", "application/x-tar")
+            if rng is not None:
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+            self.end_headers()
+            if self.command == "HEAD":
+                return
+            # drop some connections part way through the body
+            drop_at = None
+            if fake.failure_rate and random.random() < fake.failure_rate / 2:
+                drop_at = random.randrange(start, end)
+            began = time.monotonic()
+            pos = start
+            while pos < end:
+                n = min(256 * 1024, end - pos)
+                if drop_at is not None and pos + n > drop_at:
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                try:
+                    self.wfile.write(payload(seed, pos, n))
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                pos += n
+                if fake.bandwidth:
+                    ahead = (pos - start) / fake.bandwidth - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    return Handler
+
+
+@define
+class StageResult:
+    stage: str
+    items: int
+    wall_s: float
+    cpu_s: float
+    bytes: int = 0
+    latencies: list[float] = field(factory=list)
+
+    def summary(self) -> dict:
+        lat = sorted(self.latencies)
+        pct = lambda p: lat[min(len(lat) - 1, int(p * len(lat)))] if lat else None
+        return {
+            "stage": self.stage,
+            "items": self.items,
+            "wall_s": self.wall_s,
+            "cpu_s": self.cpu_s,
+            "items_per_s": self.items / self.wall_s if self.wall_s else 0,
+            "bytes_per_s": self.bytes / self.wall_s if self.wall_s else 0,
+            "p50_s": pct(0.50),
+            "p99_s": pct(0.99),
+        }
+
+
+def cpu_seconds() -> float:
+    # this process and any worker processes it has reaped
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+@contextlib.contextmanager
+def timed_calls(module, name: str, latencies: list[float]):
+    # wrap module.name for the duration so every call's latency is recorded
+    orig = getattr(module, name)
+
+    @functools.wraps(orig)
+    def sync_wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return orig(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    @functools.wraps(orig)
+    async def async_wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await orig(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    wrapper = async_wrapper if asyncio.iscoroutinefunction(orig) else sync_wrapper
+    setattr(module, name, wrapper)
+    try:
+        yield
+    finally:
+        setattr(module, name, orig)
+
+
+@contextlib.contextmanager
+def stage(name: str, results: list[StageResult]):
+    result = StageResult(name, 0, 0, 0)
+    wall, cpu = time.perf_counter(), cpu_seconds()
+    with metrics.staged(name):
+        yield result
+    result.wall_s = time.perf_counter() - wall
+    result.cpu_s = cpu_seconds() - cpu
+    results.append(result)
+
+
+def bench_pipeline(
+    dls: list[Download],
+    num_pages: int,
+    num_resolve: int,
+    num_files: int,
+    file_size: int,
+    crawl_jobs: int,
+    resolve_jobs: int,
+    download_jobs: int,
+    segments: int,
+    latency: float,
+    bandwidth: Optional[float],
+    failure_rate: float,
+    max_rps: Optional[float],
+    use_async: bool = False,
+) -> list[StageResult]:
+    import quartus_download
+    from quartus_catalog import Catalog
+    from quartus_verify import verify_archive
+
+    # talk to the fake server directly, not through the debugging proxy
+    qat.proxies = {}
+    qat.ca_file = None
+
+    fake = FakeIntel(latency=latency, bandwidth=bandwidth, max_rps=max_rps)
+    base = fake.start()
+    results = []
+    tmp = tempfile.mkdtemp(prefix="quartus_bench_")
+    try:
+        pages = {}
+        for dl in dls:
+            pages.setdefault((dl.edition, dl.operating_system, dl.version), []).append(dl)
+        page_urls = []
+        for n, ((edition, os_, ver), page_dls) in enumerate(list(pages.items())[:num_pages]):
+            local_dls = [
+                attrs.evolve(dl, dist_url=dl.dist_url.replace("https://cdrdv2.intel.com", base))
+                for dl in page_dls
+            ]
+            html = software_kit_page(edition, os_, ver, local_dls)
+            page_urls.append((ver, fake.add_page(n, html)))
+        dist_infos = [qat.DistInfo("bench", "bench", page_urls)]
+
+        # the same entry points either way, latencies come from the per item function
+        engine = qat
+        if use_async:
+            import quartus_async as engine
+
+        latencies = []
+        timed = (engine.Engine, "crawl_page") if use_async else (qat, "crawl_page")
+        with stage("crawl", results) as r, timed_calls(*timed, latencies):
+            crawled = engine.crawl_downloads_no_cdn_url(
+                dist_infos, qat.mechanize.CookieJar(), crawl_jobs
+            )
+            r.items = len(crawled)
+            r.latencies = latencies
+        crawled_dls = [dl for page in crawled for dl in page.downloads]
+
+        latencies = []
+        to_resolve = crawled_dls[:num_resolve]
+        with Catalog(os.path.join(tmp, "bench.sqlite")) as catalog:
+            timed = (engine.Engine, "get_cdn_url") if use_async else (qat, "get_download")
+            with stage("resolve", results) as r, timed_calls(*timed, latencies):
+                resolved = engine.resolve_cdn_urls(to_resolve, catalog, resolve_jobs)
+                r.items = len(resolved)
+                r.latencies = latencies
+
+        fake.failure_rate = failure_rate
+        files = []
+        for i in range(num_files):
+            filename = f"bench-{i}.tar"
+            cdn_url = fake.add_file(filename, i, file_size)
+            dl = attrs.evolve(
+                crawled_dls[i % len(crawled_dls)],
+                filename=filename,
+                dist_url=f"bench://{i}",
+                cdn_url=cdn_url,
+                sha1=payload_sha1(i, file_size),
+                listed_size=file_size,
+            )
+            files.append(dl)
+        root = os.path.join(tmp, "archive")
+        latencies = []
+        timed = (engine.Engine, "download") if use_async else (quartus_download, "download")
+        download_all = engine.download_all if use_async else quartus_download.download_all
+        with stage("download", results) as r, timed_calls(*timed, latencies):
+            done = download_all(
+                files,
+                root,
+                jobs=download_jobs,
+                segments=segments,
+                min_split=1024 * 1024,
+                piece_size=4 * 1024 * 1024,
+            )
+            r.items = len(done)
+            r.bytes = file_size * len(done)
+            r.latencies = latencies
+
+        with stage("verify", results) as r:
+            verified = verify_archive(root, files)
+            r.items = sum(v.status == "ok" for v in verified)
+            r.bytes = sum(v.size or 0 for v in verified if v.sha1 is not None)
+            r.latencies = [v.seconds for v in verified if v.sha1 is not None]
+        print(f"server pushed back {fake.throttled} times, limiters: {throttle.stats()}")
+    finally:
+        fake.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+def print_stages(results: list[StageResult]) -> None:
+    print(
+        f"{'stage':10} {'items':>6} {'wall s':>8} {'cpu s':>8} {'items/s':>9} {'MB/s':>8} {'p50 s':>8} {'p99 s':>8}"
+    )
+    for r in results:
+        s = r.summary()
+        fmt = lambda v: f"{v:8.3f}" if v is not None else f"{'-':>8}"
+        print(
+            f"{s['stage']:10} {s['items']:6} {s['wall_s']:8.3f} {s['cpu_s']:8.3f} "
+            f"{s['items_per_s']:9.1f} {s['bytes_per_s'] / 1e6:8.1f} {fmt(s['p50_s'])} {fmt(s['p99_s'])}"
+        )
+
+
+# never needed to answer a catalog query
+heavy_modules = (
+    "attr",
+    "attrs",
+    "requests",
+    "urllib3",
+    "mechanize",
+    "lxml",
+    "aiohttp",
+    "numpy",
+    "zstandard",
+)
+
+
+def run_ms(argv: list[str], runs: int) -> list[float]:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def bench_startup(dls: list[Download], runs: int, budget_ms: float) -> dict:
+    # cold start of a one file lookup through the cli against bare interpreter startup,
+    # plus which modules the lookup imported
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), "quartus_cli.py")
+    tmp = tempfile.mkdtemp(prefix="quartus_bench_")
+    try:
+        from quartus_catalog import Catalog
+
+        catalog_path = os.path.join(tmp, "quartus.sqlite")
+        with Catalog(catalog_path) as catalog:
+            catalog.upsert(dls)
+        query = [sys.executable, cli, "query", "-c", catalog_path]
+        query += ["-f", dls[-1].filename, "--fields", "sha1"]
+        out = subprocess.run(query, check=True, capture_output=True, text=True).stdout
+        assert dls[-1].sha1 in out.split()
+        trace = subprocess.run(
+            [sys.executable, "-X", "importtime", *query[1:]], check=True, capture_output=True
+        ).stderr.decode()
+        imported = {line.split("|")[-1].strip() for line in trace.splitlines() if "|" in line}
+        loaded = sorted(m for m in imported if m.split(".")[0] in heavy_modules)
+        baseline = run_ms([sys.executable, "-c", "pass"], runs)
+        lookup = run_ms(query, runs)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    # best of runs, the medians move with whatever else the machine is doing
+    overhead = min(lookup) - min(baseline)
+    return {
+        "runs": runs,
+        "interpreter_ms": min(baseline),
+        "query_ms": min(lookup),
+        "query_median_ms": statistics.median(lookup),
+        "overhead_ms": overhead,
+        "budget_ms": budget_ms,
+        "heavy_modules": loaded,
+        "ok": overhead <= budget_ms and not loaded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quartus archiver benchmarks")
+    parser.add_argument(
+        "-c", "--catalog", default="quartus.sqlite", help="catalog to render pages from"
+    )
+    parser.add_argument("-o", "--output", help="also write the results here as json")
+    add_metrics_args(parser)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    parse = sub.add_parser("parse", help="page parsing only, no server")
+    parse.add_argument("--cache-dir", help="benchmark cached crawl pages instead")
+    parse.add_argument("-r", "--rounds", type=int, default=3)
+
+    pipe = sub.add_parser(
+        "pipeline", help="crawl, resolve, download and verify against a fake intel"
+    )
+    pipe.add_argument("--pages", type=int, default=108)
+    pipe.add_argument("--resolve", type=int, default=500, help="downloads to resolve")
+    pipe.add_argument("--files", type=int, default=8, help="synthetic files to download")
+    pipe.add_argument("--file-mb", type=int, default=64)
+    pipe.add_argument("--crawl-jobs", type=int, default=8)
+    pipe.add_argument("--resolve-jobs", type=int, default=16)
+    pipe.add_argument("--download-jobs", type=int, default=2)
+    pipe.add_argument("--segments", type=int, default=8)
+    pipe.add_argument("--latency-ms", type=float, default=20, help="added to every request")
+    pipe.add_argument("--bandwidth-mbps", type=float, help="per connection cap on file bodies")
+    pipe.add_argument("--failure-rate", type=float, default=0, help="file requests that fail")
+    pipe.add_argument("--max-rps", type=float, help="throttle page and redirect requests")
+    pipe.add_argument("--async", dest="use_async", action="store_true", help="use quartus_async")
+
+    start = sub.add_parser("startup", help="cold start of a catalog lookup through the cli")
+    start.add_argument("-r", "--runs", type=int, default=20)
+    start.add_argument(
+        "--budget-ms", type=float, default=50, help="allowed over bare interpreter startup"
+    )
+    args = parser.parse_args()
+    metrics_args(args)
+
+    if args.cmd == "parse":
+        pages = load_pages(args.cache_dir, args.catalog)
+        print(f"{len(pages)} pages, {sum(map(len, pages))} bytes")
+        out = bench_parse(pages, args.rounds)
+    elif args.cmd == "startup":
+        out = bench_startup(load_catalog(args.catalog), args.runs, args.budget_ms)
+        print(out)
+    else:
+        results = bench_pipeline(
+            load_catalog(args.catalog),
+            args.pages,
+            args.resolve,
+            args.files,
+            args.file_mb * 1024 * 1024,
+            args.crawl_jobs,
+            args.resolve_jobs,
+            args.download_jobs,
+            args.segments,
+            args.latency_ms / 1000,
+            args.bandwidth_mbps * 1e6 / 8 if args.bandwidth_mbps else None,
+            args.failure_rate,
+            args.max_rps,
+            args.use_async,
+        )
+        print_stages(results)
+        out = [r.summary() for r in results]
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(out, f, indent=1)
+    if args.cmd == "startup" and not out["ok"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Optional
+
+from attrs import define, field
+from requests.structures import CaseInsensitiveDict
+from rich import print
+
+from quartus_metrics import metrics
+
+cache_dir = "http_cache"
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+@define
+class CachedResponse:
+    url: str
+    status: int
+    headers: dict[str, str]
+    body: bytes
+    stored_at: float
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    # a temp name per process and thread, so writers of the same entry don't share one
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+@define
+class ResponseCache:
+    # responses on disk as <key>.json metadata plus <key>.body, keyed by method, url and the
+    # request headers in vary. The metadata mtime is bumped on every hit for LRU eviction.
+    root: str = cache_dir
+    ttl: float = 24 * 60 * 60
+    max_bytes: int = 1024 * 1024 * 1024
+    offline: bool = False
+    vary: tuple[str, ...] = ("Range", "Accept", "Accept-Language")
+    hits: int = 0
+    misses: int = 0
+    size: Optional[int] = None
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def key(self, method: str, url: str, headers: Optional[dict[str, str]] = None) -> str:
+        headers = CaseInsensitiveDict(headers or {})
+        varied = [(h.lower(), headers[h]) for h in self.vary if h in headers]
+        return hashlib.sha256(json.dumps([method.upper(), url, varied]).encode()).hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def entries(self):
+        if not os.path.isdir(self.root):
+            return
+        for d in os.scandir(self.root):
+            if not d.is_dir():
+                continue
+            for e in os.scandir(d.path):
+                if e.name.endswith(".json"):
+                    yield e.path.removesuffix(".json")
+
+    def get(
+        self, method: str, url: str, headers: Optional[dict[str, str]] = None
+    ) -> Optional[CachedResponse]:
+        path = self.entry_path(self.key(method, url, headers))
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            with open(path + ".body", "rb") as f:
+                cached = CachedResponse(
+                    url, meta["status"], meta["headers"], f.read(), meta["stored_at"]
+                )
+        except (FileNotFoundError, ValueError, KeyError):
+            # a torn or foreign entry is a miss, the next put replaces it
+            cached = None
+        # offline replay serves whatever is there no matter how old
+        if cached is None or (not self.offline and time.time() - cached.stored_at > self.ttl):
+            self.misses += 1
+            metrics.inc("quartus_cache_total", result="miss")
+            if self.offline:
+                raise CacheMiss(f"{method} {url} isn't cached")
+            return None
+        self.hits += 1
+        metrics.inc("quartus_cache_total", result="hit")
+        os.utime(path + ".json")
+        return cached
+
+    def put(
+        self,
+        method: str,
+        url: str,
+        headers: Optional[dict[str, str]],
+        status: int,
+        resp_headers: dict[str, str],
+        body: bytes,
+    ) -> None:
+        path = self.entry_path(self.key(method, url, headers))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {
+            "url": url,
+            "status": status,
+            "headers": dict(resp_headers),
+            "stored_at": time.time(),
+        }
+        # body first so a reader never sees metadata without its body
+        write_atomic(path + ".body", body)
+        write_atomic(path + ".json", json.dumps(meta).encode())
+        with self.lock:
+            if self.size is None:
+                self.size = self.disk_usage()
+            else:
+                self.size += len(body)
+            over = self.size > self.max_bytes
+        if over:
+            self.evict()
+
+    def disk_usage(self) -> int:
+        return sum(os.stat(p + ".body").st_size for p in self.entries())
+
+    def evict(self) -> int:
+        # drop expired entries, then least recently used ones until under max_bytes
+        with self.lock:
+            now = time.time()
+            entries = []
+            for path in self.entries():
+                try:
+                    st_meta = os.stat(path + ".json")
+                    size = os.stat(path + ".body").st_size
+                except FileNotFoundError:
+                    continue
+                entries.append((st_meta.st_mtime, size, path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for mtime, size, path in entries:
+                try:
+                    with open(path + ".json") as f:
+                        expired = now - json.load(f)["stored_at"] > self.ttl
+                except (FileNotFoundError, ValueError, KeyError):
+                    expired = True
+                if not expired and total <= self.max_bytes:
+                    continue
+                for suffix in (".json", ".body"):
+                    try:
+                        os.unlink(path + suffix)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                removed += 1
+            self.size = total
+            return removed
+
+    def clear(self) -> None:
+        with self.lock:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.size = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or trim the http response cache")
+    parser.add_argument("cmd", choices=("stats", "evict", "clear"))
+    parser.add_argument("-d", "--dir", default=cache_dir, help="cache directory")
+    parser.add_argument("--ttl", type=float, default=24 * 60 * 60, help="seconds")
+    parser.add_argument("--max-mb", type=int, default=1024)
+    args = parser.parse_args()
+    cache = ResponseCache(args.dir, ttl=args.ttl, max_bytes=args.max_mb * 1024 * 1024)
+    if args.cmd == "stats":
+        print(f"{sum(1 for _ in cache.entries())} entries, {cache.disk_usage()} bytes")
+    elif args.cmd == "evict":
+        print(f"evicted {cache.evict()} entries")
+    elif args.cmd == "clear":
+        cache.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,514 @@
+import argparse
+import datetime
+import json
+import pickle
+import sqlite3
+import sys
+import time
+from typing import TYPE_CHECKING, Iterable, Optional, Union
+
+from rich import print
+
+# quartus_model and attrs are imported where they're used, `quartus_cli.py query` answers
+# from the rows alone and would otherwise spend most of its startup budget on them
+if TYPE_CHECKING:
+    from quartus_model import CrawledPage, Download, PageState, Version
+    from quartus_table import DownloadTable
+
+catalog_path = "quartus.sqlite"
+schema_version = 4
+
+schema_v1 = """
+CREATE TABLE downloads (
+    dist_url TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    cdn_url TEXT,
+    sha1 TEXT NOT NULL,
+    version TEXT NOT NULL,
+    version_key INTEGER NOT NULL,
+    ident INTEGER NOT NULL,
+    updated_date TEXT NOT NULL,
+    listed_size INTEGER NOT NULL,
+    operating_system TEXT NOT NULL,
+    edition TEXT NOT NULL,
+    package TEXT NOT NULL,
+    tab TEXT NOT NULL
+);
+CREATE INDEX downloads_sha1 ON downloads (sha1);
+CREATE INDEX downloads_ident ON downloads (ident);
+CREATE INDEX downloads_filename ON downloads (filename);
+CREATE INDEX downloads_edition_os_version ON downloads (edition, operating_system, version_key);
+CREATE INDEX downloads_version ON downloads (version_key);
+CREATE INDEX downloads_package ON downloads (package);
+"""
+
+# pages remembers each crawled page's validators and listing fingerprint, changes is a log
+# of what each crawl added, removed or changed
+schema_v2 = """
+ALTER TABLE downloads ADD COLUMN page_url TEXT;
+CREATE INDEX downloads_page_url ON downloads (page_url);
+CREATE TABLE pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    fingerprint TEXT,
+    fetched_at TEXT NOT NULL
+);
+CREATE TABLE changes (
+    id INTEGER PRIMARY KEY,
+    changed_at TEXT NOT NULL,
+    change TEXT NOT NULL,
+    page_url TEXT,
+    dist_url TEXT NOT NULL,
+    old TEXT,
+    new TEXT
+);
+CREATE INDEX changes_changed_at ON changes (changed_at);
+"""
+
+# when each cdn url was resolved and when it stops working, see quartus_cdn. cdn_hosts holds
+# how long a host's unsigned links were seen to last.
+schema_v3 = """
+ALTER TABLE downloads ADD COLUMN cdn_resolved_at REAL;
+ALTER TABLE downloads ADD COLUMN cdn_expires_at REAL;
+CREATE INDEX downloads_cdn_expires_at ON downloads (cdn_expires_at);
+CREATE TABLE cdn_hosts (
+    host TEXT PRIMARY KEY,
+    ttl REAL NOT NULL,
+    learned_at TEXT NOT NULL
+);
+"""
+
+# ages at which a host's unsigned links were refused or still worked, cdn_hosts.ttl is
+# learned from these
+schema_v4 = """
+CREATE TABLE cdn_link_ages (
+    host TEXT NOT NULL,
+    age REAL NOT NULL,
+    refused INTEGER NOT NULL
+);
+CREATE INDEX cdn_link_ages_host ON cdn_link_ages (host);
+"""
+
+migrations = {1: schema_v1, 2: schema_v2, 3: schema_v3, 4: schema_v4}
+
+columns = (
+    "dist_url",
+    "filename",
+    "cdn_url",
+    "sha1",
+    "version",
+    "version_key",
+    "ident",
+    "updated_date",
+    "listed_size",
+    "operating_system",
+    "edition",
+    "package",
+    "tab",
+)
+
+# Download's fields in order, the rows hold them in the same form as download_to_json
+download_fields = (
+    "filename",
+    "dist_url",
+    "cdn_url",
+    "sha1",
+    "version",
+    "ident",
+    "updated_date",
+    "listed_size",
+    "operating_system",
+    "edition",
+    "package",
+    "tab",
+)
+
+# columns that can be filtered on with query()
+filter_columns = {
+    "dist_url",
+    "filename",
+    "sha1",
+    "ident",
+    "operating_system",
+    "edition",
+    "package",
+    "tab",
+    "version",
+}
+
+
+def version_key(ver: "Version") -> int:
+    # sortable integer for a.b.c, every Quartus release number fits in three components
+    major, minor, micro = (tuple(ver.release) + (0, 0, 0))[:3]
+    return (major * 1000 + minor) * 1000 + micro
+
+
+def download_row(dl: "Download") -> tuple:
+    return (
+        dl.dist_url,
+        dl.filename,
+        dl.cdn_url,
+        dl.sha1,
+        str(dl.version),
+        version_key(dl.version),
+        dl.ident,
+        dl.updated_date.isoformat(),
+        dl.listed_size,
+        dl.operating_system,
+        dl.edition,
+        dl.package,
+        dl.tab,
+    )
+
+
+def row_download(row: sqlite3.Row) -> "Download":
+    from quartus_model import Download, Version
+
+    return Download(
+        filename=row["filename"],
+        dist_url=row["dist_url"],
+        cdn_url=row["cdn_url"],
+        sha1=row["sha1"],
+        version=Version(row["version"]),
+        ident=row["ident"],
+        updated_date=datetime.date.fromisoformat(row["updated_date"]),
+        listed_size=row["listed_size"],
+        operating_system=row["operating_system"],
+        edition=row["edition"],
+        package=row["package"],
+        tab=row["tab"],
+    )
+
+
+class Catalog:
+    def __init__(self, path: str = catalog_path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.migrate()
+
+    def migrate(self) -> None:
+        ver = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if ver > schema_version:
+            raise ValueError(f"{self.path} is catalog version {ver}, newer than {schema_version}")
+        for ver in range(ver + 1, schema_version + 1):
+            with self.db:
+                self.db.executescript(migrations[ver])
+                self.db.execute(f"PRAGMA user_version = {ver}")
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self) -> "Catalog":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT count(*) FROM downloads").fetchone()[0]
+
+    def upsert_rows(self, dls: Iterable["Download"], page_url: Optional[str] = None) -> None:
+        # a re-crawl doesn't know the cdn url, so keep any that was already resolved
+        updates = ", ".join(
+            f"{c} = excluded.{c}" for c in columns if c not in ("dist_url", "cdn_url")
+        )
+        self.db.executemany(
+            f"INSERT INTO downloads ({', '.join(columns)}, page_url) "
+            f"VALUES ({', '.join('?' * len(columns))}, ?) "
+            f"ON CONFLICT (dist_url) DO UPDATE SET {updates}, "
+            f"cdn_url = coalesce(excluded.cdn_url, downloads.cdn_url), "
+            f"page_url = coalesce(excluded.page_url, downloads.page_url)",
+            (download_row(dl) + (page_url,) for dl in dls),
+        )
+
+    def upsert(self, dls: Iterable["Download"], page_url: Optional[str] = None) -> None:
+        with self.db:
+            self.upsert_rows(dls, page_url)
+
+    def resolved(self, dls: Iterable["Download"], now: Optional[float] = None) -> None:
+        # save freshly resolved cdn urls along with their expiry
+        from quartus_cdn import cdn_expiry
+
+        dls = list(dls)
+        now = time.time() if now is None else now
+        ttls = self.cdn_ttls()
+        with self.db:
+            self.upsert_rows(dls)
+            self.db.executemany(
+                "UPDATE downloads SET cdn_resolved_at = ?, cdn_expires_at = ? WHERE dist_url = ?",
+                [(now, cdn_expiry(dl.cdn_url, now, ttls), dl.dist_url) for dl in dls],
+            )
+
+    def cdn_ttls(self) -> dict[str, float]:
+        return {row["host"]: row["ttl"] for row in self.db.execute("SELECT * FROM cdn_hosts")}
+
+    def cdn_expiries(self, dist_urls: Optional[list[str]] = None) -> dict[str, float]:
+        sql = "SELECT dist_url, cdn_expires_at FROM downloads WHERE cdn_expires_at IS NOT NULL"
+        args = []
+        if dist_urls is not None:
+            sql += f" AND dist_url IN ({', '.join('?' * len(dist_urls))})"
+            args = dist_urls
+        return {row["dist_url"]: row["cdn_expires_at"] for row in self.db.execute(sql, args)}
+
+    def expire_cdn_urls(self, margin: float, now: Optional[float] = None) -> int:
+        # forget cdn urls that expire within margin so the next resolve pass redoes them
+        now = time.time() if now is None else now
+        with self.db:
+            cur = self.db.execute(
+                "UPDATE downloads SET cdn_url = NULL, cdn_resolved_at = NULL, "
+                "cdn_expires_at = NULL WHERE cdn_expires_at < ?",
+                (now + margin,),
+            )
+        return cur.rowcount
+
+    def learn_cdn_ttl(
+        self, dist_url: str, refused: bool = True, now: Optional[float] = None
+    ) -> Optional[float]:
+        # note how old dist_url's cached link was when the cdn refused it, or took it, and
+        # relearn how long unsigned links from its host last. Every such link is given the
+        # new expiry, or none if there isn't enough to go on.
+        from quartus_cdn import learned_ttl, link_expiry, link_host
+
+        now = time.time() if now is None else now
+        row = self.db.execute(
+            "SELECT cdn_url, cdn_resolved_at FROM downloads WHERE dist_url = ?", (dist_url,)
+        ).fetchone()
+        if row is None or row["cdn_url"] is None or row["cdn_resolved_at"] is None:
+            return None
+        if link_expiry(row["cdn_url"]) is not None:
+            return None
+        host = link_host(row["cdn_url"])
+        age = now - row["cdn_resolved_at"]
+        ages = [
+            (r["age"], bool(r["refused"]))
+            for r in self.db.execute("SELECT * FROM cdn_link_ages WHERE host = ?", (host,))
+        ]
+        old_ttl = self.cdn_ttls().get(host)
+        if not refused and age <= max((a for a, r in ages if not r), default=0):
+            return old_ttl
+        with self.db:
+            if not refused:
+                # a link this old still worked, younger ones refused weren't expired
+                self.db.execute("DELETE FROM cdn_link_ages WHERE host = ? AND age < ?", (host, age))
+                ages = [(a, r) for a, r in ages if a >= age]
+            self.db.execute(
+                "INSERT INTO cdn_link_ages (host, age, refused) VALUES (?, ?, ?)",
+                (host, age, refused),
+            )
+            ttl = learned_ttl(ages + [(age, refused)])
+            if ttl == old_ttl:
+                return ttl
+            if ttl is None:
+                self.db.execute("DELETE FROM cdn_hosts WHERE host = ?", (host,))
+            else:
+                learned_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+                self.db.execute(
+                    "INSERT OR REPLACE INTO cdn_hosts (host, ttl, learned_at) VALUES (?, ?, ?)",
+                    (host, ttl, learned_at),
+                )
+            rows = self.db.execute(
+                "SELECT dist_url, cdn_url, cdn_resolved_at FROM downloads "
+                "WHERE cdn_resolved_at IS NOT NULL"
+            ).fetchall()
+            self.db.executemany(
+                "UPDATE downloads SET cdn_expires_at = ? WHERE dist_url = ?",
+                [
+                    (None if ttl is None else r["cdn_resolved_at"] + ttl, r["dist_url"])
+                    for r in rows
+                    if link_host(r["cdn_url"]) == host and link_expiry(r["cdn_url"]) is None
+                ],
+            )
+        return ttl
+
+    def page_states(self) -> dict[str, "PageState"]:
+        from quartus_model import PageState
+
+        return {
+            row["url"]: PageState(row["url"], row["etag"], row["last_modified"], row["fingerprint"])
+            for row in self.db.execute("SELECT * FROM pages")
+        }
+
+    def apply_page(self, page: "CrawledPage") -> dict[str, int]:
+        # diff a crawled page against what the catalog has for it, log and apply the changes
+        from quartus_model import download_to_json
+
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        url = page.state.url
+        counts = {"added": 0, "removed": 0, "changed": 0}
+        with self.db:
+            if page.downloads is not None:
+                new = {dl.dist_url: dl for dl in page.downloads}
+                rows = self.db.execute(
+                    f"SELECT * FROM downloads WHERE page_url = ? "
+                    f"OR dist_url IN ({', '.join('?' * len(new))})",
+                    [url, *new],
+                )
+                old = {row["dist_url"]: row_download(row) for row in rows}
+                log = []
+                for dist_url in new.keys() - old.keys():
+                    log.append(("added", dist_url, None, download_to_json(new[dist_url])))
+                for dist_url in old.keys() - new.keys():
+                    log.append(("removed", dist_url, download_to_json(old[dist_url]), None))
+                for dist_url in new.keys() & old.keys():
+                    # cdn_url isn't part of the listing
+                    old_row = download_row(old[dist_url])
+                    new_row = download_row(new[dist_url])
+                    if old_row[:2] + old_row[3:] != new_row[:2] + new_row[3:]:
+                        log.append(
+                            (
+                                "changed",
+                                dist_url,
+                                download_to_json(old[dist_url]),
+                                download_to_json(new[dist_url]),
+                            )
+                        )
+                self.db.executemany(
+                    "INSERT INTO changes (changed_at, change, page_url, dist_url, old, new) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(now, change, url, *rest) for change, *rest in log],
+                )
+                self.db.executemany(
+                    "DELETE FROM downloads WHERE dist_url = ?",
+                    [(dist_url,) for change, dist_url, *_ in log if change == "removed"],
+                )
+                self.upsert_rows(new.values(), url)
+                for change, *_ in log:
+                    counts[change] += 1
+            st = page.state
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages (url, etag, last_modified, fingerprint, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (url, st.etag, st.last_modified, st.fingerprint, now),
+            )
+        return counts
+
+    def rows(
+        self,
+        min_version: Optional["Version"] = None,
+        max_version: Optional["Version"] = None,
+        resolved: Optional[bool] = None,
+        **filters: Union[str, int, Iterable],
+    ) -> sqlite3.Cursor:
+        # each filter matches a value or any of a list of values, all filters must match
+        where = []
+        args = []
+        for col, val in filters.items():
+            if col not in filter_columns:
+                raise ValueError(f"can't filter the catalog on '{col}'")
+            if isinstance(val, (str, int)) or not isinstance(val, Iterable):
+                val = [val]
+            if col == "version":
+                from quartus_model import Version
+
+                # 21.1 and 21.1.0 are the same release
+                col, val = "version_key", [version_key(Version(str(v))) for v in val]
+            where.append(f"{col} IN ({', '.join('?' * len(val))})")
+            args += val
+        if min_version is not None:
+            where.append("version_key >= ?")
+            args.append(version_key(min_version))
+        if max_version is not None:
+            where.append("version_key <= ?")
+            args.append(version_key(max_version))
+        if resolved is not None:
+            where.append("cdn_url IS NOT NULL" if resolved else "cdn_url IS NULL")
+        sql = "SELECT * FROM downloads"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY edition, operating_system, version_key DESC, filename"
+        return self.db.execute(sql, args)
+
+    def query(self, **filters) -> list["Download"]:
+        return [row_download(row) for row in self.rows(**filters)]
+
+    def table(self, **filters) -> "DownloadTable":
+        # the same rows held column wise, see quartus_table
+        from quartus_table import DownloadTable
+
+        return DownloadTable.from_rows(self.rows(**filters))
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    # the old pickles were written from the script run as __main__, the classes in them
+    # now live in quartus_model
+    def find_class(self, module: str, name: str):
+        if module in ("__main__", "quartus_archive_test"):
+            module = "quartus_model"
+        return super().find_class(module, name)
+
+
+def load_legacy(path: str) -> list["Download"]:
+    from quartus_model import download_from_json
+
+    if path.endswith(".pickle"):
+        with open(path, "rb") as f:
+            return LegacyUnpickler(f).load()
+    with open(path) as f:
+        return [download_from_json(line) for line in f if line.strip()]
+
+
+def add_query_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-e", "--edition", action="append")
+    parser.add_argument("-o", "--os", dest="operating_system", action="append")
+    parser.add_argument("-p", "--package", action="append")
+    parser.add_argument("-t", "--tab", action="append")
+    parser.add_argument("-v", "--version", action="append")
+    parser.add_argument("--sha1", action="append")
+    parser.add_argument("--ident", type=int, action="append")
+    parser.add_argument("-f", "--filename", action="append")
+    parser.add_argument("--min-version", type=version_arg)
+    parser.add_argument("--max-version", type=version_arg)
+
+
+def version_arg(s: str) -> "Version":
+    from quartus_model import Version
+
+    return Version(s)
+
+
+def query_args(args: argparse.Namespace) -> dict:
+    filters = {k: getattr(args, k) for k in filter_columns if getattr(args, k, None) is not None}
+    return dict(filters, min_version=args.min_version, max_version=args.max_version)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quartus download catalog")
+    parser.add_argument("-c", "--catalog", default=catalog_path)
+    # -c is also accepted after the subcommand, as in `quartus_cli.py query -c ...`
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-c", "--catalog", default=argparse.SUPPRESS)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    imp = sub.add_parser(
+        "import", parents=[common], help="import a legacy pickle or jsonl of downloads"
+    )
+    imp.add_argument("paths", nargs="+")
+    query = sub.add_parser("query", parents=[common], help="print matching downloads")
+    query.add_argument(
+        "--fields", help="comma separated fields to print tab separated instead of json"
+    )
+    add_query_args(query)
+    args = parser.parse_args()
+    fields = args.fields.split(",") if getattr(args, "fields", None) else None
+    if fields is not None and not set(fields) <= set(download_fields):
+        parser.error(f"--fields from {', '.join(download_fields)}")
+
+    with Catalog(args.catalog) as catalog:
+        if args.cmd == "import":
+            for path in args.paths:
+                dls = load_legacy(path)
+                catalog.upsert(dls)
+                print(f"imported {len(dls)} downloads from {path}")
+            print(f"{len(catalog)} downloads in {args.catalog}")
+        elif args.cmd == "query":
+            for row in catalog.rows(**query_args(args)):
+                if fields is None:
+                    sys.stdout.write(json.dumps({f: row[f] for f in download_fields}) + "\n")
+                else:
+                    sys.stdout.write("\t".join(str(row[f]) for f in fields) + "\n")
+
+
+if __name__ == "__main__":
+    main()
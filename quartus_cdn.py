@@ -0,0 +1,138 @@
+import datetime
+import threading
+import time
+from typing import Optional
+from urllib.parse import parse_qsl, urlsplit
+
+from attrs import define, field
+from rich import print
+
+from quartus_catalog import Catalog
+from quartus_metrics import metrics
+from quartus_model import Download
+
+# Resolving a dist_url costs an acceptEula GET and a redirect chase, so the catalog keeps
+# each cdn url with when it was resolved and when it stops working. Signed links carry
+# their expiry in the query string. For unsigned ones 403s on cached links bound how long
+# that host's links last, once there are enough of them. Links close to expiry are dropped
+# before a resolve pass so it picks them up again, and a download re-resolves its link
+# when it turns out stale.
+
+# a link with less than this left is resolved again rather than started on
+expiry_margin = 60 * 60
+
+# a 403 can be cookies, geo or a flaky edge as well as an expired link, so it takes this
+# many refusals of links older than any seen working to learn a host's ttl
+min_refusals = 3
+
+# query parameters of akamai edge auth tokens, exp=<epoch>~acl=...~hmac=...
+token_params = ("__token__", "hdnts", "hdntl", "token")
+
+
+def link_expiry(url: str) -> Optional[float]:
+    # unix time a signed link expires at, None when the url doesn't say
+    query = dict(parse_qsl(urlsplit(url).query))
+    for name in token_params:
+        for part in query.get(name, "").split("~"):
+            if part.startswith("exp=") and part[4:].isdigit():
+                return float(part[4:])
+    # akamai's older <expiry>_<hmac> form
+    gda = query.get("__gda__", "").partition("_")[0]
+    if gda.isdigit():
+        return float(gda)
+    if query.get("Expires", "").isdigit():
+        return float(query["Expires"])
+    if query.get("X-Amz-Expires", "").isdigit() and "X-Amz-Date" in query:
+        signed = datetime.datetime.strptime(query["X-Amz-Date"], "%Y%m%dT%H%M%SZ")
+        signed = signed.replace(tzinfo=datetime.timezone.utc).timestamp()
+        return signed + int(query["X-Amz-Expires"])
+    return None
+
+
+def link_host(url: str) -> str:
+    return urlsplit(url).hostname or ""
+
+
+def cdn_expiry(url: str, resolved_at: float, ttls: dict[str, float]) -> Optional[float]:
+    # the link's own expiry, else what its host's links were seen to last, else unknown
+    expiry = link_expiry(url)
+    if expiry is None and link_host(url) in ttls:
+        expiry = resolved_at + ttls[link_host(url)]
+    return expiry
+
+
+def learned_ttl(ages: list[tuple[float, bool]]) -> Optional[float]:
+    # how long a host's links last from (age, refused) samples of its links, the youngest
+    # refusal past the oldest link that worked. None until there are min_refusals of those,
+    # and refusals under expiry_margin only count with min_refusals of them too.
+    worked = max((age for age, refused in ages if not refused), default=0)
+    refusals = sorted(age for age, refused in ages if refused and age > worked)
+    young = sum(age < expiry_margin for age in refusals)
+    if young < min_refusals:
+        refusals = refusals[young:]
+    if len(refusals) < min_refusals:
+        return None
+    return refusals[0]
+
+
+class LinkExpired(Exception):
+    # the cdn refused a link that used to work
+    pass
+
+
+@define
+class Revalidator:
+    # re-resolves cdn urls for download workers, before a download starts on a link close
+    # to expiry and after the cdn refuses one
+    catalog_path: str
+    margin: float = expiry_margin
+    expires: dict[str, float] = field(factory=dict)
+    cookies: object = None
+    tls: threading.local = field(factory=threading.local)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def load(self) -> "Revalidator":
+        with Catalog(self.catalog_path) as catalog:
+            self.expires = catalog.cdn_expiries()
+        return self
+
+    def stale(self, dl: Download) -> bool:
+        if dl.cdn_url is None:
+            return True
+        expiry = self.expires.get(dl.dist_url)
+        return expiry is not None and expiry - time.time() < self.margin
+
+    def resolve(self, dl: Download, rejected: bool = False) -> str:
+        from quartus_archive_test import CdnCookies, get_cdn_url, init_session
+
+        with self.lock:
+            if self.cookies is None:
+                self.cookies = CdnCookies()
+        if not hasattr(self.tls, "session"):
+            self.tls.session = init_session()
+        reason = "rejected" if rejected else "missing" if dl.cdn_url is None else "expiring"
+        print(f"resolving the cdn url for {dl.filename}, {reason}")
+        cdn_url = get_cdn_url(self.tls.session, dl.dist_url, self.cookies)
+        with Catalog(self.catalog_path) as catalog:
+            if rejected:
+                catalog.learn_cdn_ttl(dl.dist_url)
+            dl.cdn_url = cdn_url
+            catalog.resolved([dl])
+            # a learned ttl moves the expiry of the host's other links too
+            expires = catalog.cdn_expiries()
+        with self.lock:
+            self.expires = expires
+        metrics.inc("quartus_cdn_revalidations_total", reason=reason)
+        return cdn_url
+
+    def worked(self, dl: Download, at: float) -> None:
+        # the cdn took dl's link at unix time at, so younger links it refused weren't expired
+        if dl.cdn_url is None or link_expiry(dl.cdn_url) is not None:
+            return
+        with Catalog(self.catalog_path) as catalog:
+            ttl = catalog.cdn_ttls().get(link_host(dl.cdn_url))
+            if catalog.learn_cdn_ttl(dl.dist_url, refused=False, now=at) == ttl:
+                return
+            expires = catalog.cdn_expiries()
+        with self.lock:
+            self.expires = expires
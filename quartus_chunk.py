@@ -0,0 +1,421 @@
+import argparse
+import base64
+import bisect
+import hashlib
+import itertools
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+import zstandard
+from attrs import asdict, define
+from rich import print
+
+from quartus_catalog import Catalog, add_query_args, catalog_path, query_args
+from quartus_metrics import metrics
+from quartus_model import ChecksumMismatch, archive_path
+from quartus_pack import compress_frame, tar_members
+from quartus_store import BlobStore
+
+# FastCDC style content defined chunking: a gear hash over a 32 byte window picks cut
+# points, with a harder mask before avg_size and an easier one after it so chunk sizes
+# cluster around the average. Boundaries only depend on nearby bytes, so an inserted or
+# changed file shifts the chunks around it and the rest line up with the older release.
+min_size = 256 * 1024
+avg_size = 1024 * 1024
+max_size = 8 * 1024 * 1024
+# hashed a block at a time, small enough that the passes stay in cache
+block_size = 256 * 1024
+level = 3
+# tar headers and padding between members are kept in the recipe instead of as chunks
+literal_max = 64 * 1024
+recipe_version = 1
+
+# fixed forever, changing it moves every boundary and defeats dedup against older chunks
+gear = np.frombuffer(
+    b"".join(hashlib.sha256(b"quartus gear %d" % i).digest()[:4] for i in range(256)), "<u4"
+).astype(np.uint32)
+window = 32
+
+
+def gear_hash(data: np.ndarray) -> np.ndarray:
+    # h[i] = sum(gear[data[i - k]] << k for k in range(32)) mod 2**32, the rolling
+    # h = (h << 1) + gear[byte] built by doubling in five whole array passes instead of a
+    # python loop per byte. data starts with window - 1 bytes of context.
+    h = np.take(gear, data)
+    tmp = np.empty_like(h)
+    for shift in (1, 2, 4, 8, 16):
+        np.left_shift(h[:-shift], shift, out=tmp[:-shift])
+        np.add(h[shift:], tmp[:-shift], out=h[shift:])
+    return h[window - 1 :]
+
+
+def top_mask(bits: int) -> int:
+    # bit k of the hash only depends on the last k + 1 bytes, the top bits see the window
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+def chunks(
+    read: Callable[[int], bytes],
+    length: int,
+    min_size: int = min_size,
+    avg_size: int = avg_size,
+    max_size: int = max_size,
+) -> Iterator[bytes]:
+    # splits the next length bytes from read into chunks. Each region starts from zeroed
+    # context, so a tar member chunks the same whatever archive it sits in.
+    bits = avg_size.bit_length() - 1
+    strict, loose = top_mask(bits + 2), top_mask(bits - 2)
+    buf = bytearray()
+    tail = np.zeros(window - 1, np.uint8)
+    cuts_strict = cuts_loose = np.empty(0, np.int64)
+    start = pos = 0
+    while True:
+        if pos < length:
+            data = read(min(block_size, length - pos))
+            if not data:
+                raise EOFError(f"short read at {pos} of {length}")
+            ctx = np.concatenate([tail, np.frombuffer(data, np.uint8)])
+            h = gear_hash(ctx)
+            tail = ctx[-(window - 1) :]
+            # cut after byte i, positions are relative to the region
+            new_strict = np.flatnonzero((h & strict) == 0) + (pos + 1)
+            new_loose = np.flatnonzero((h & loose) == 0) + (pos + 1)
+            cuts_strict = np.concatenate([cuts_strict[cuts_strict > start], new_strict])
+            cuts_loose = np.concatenate([cuts_loose[cuts_loose > start], new_loose])
+            buf += data
+            pos += len(data)
+        done = pos == length
+        # the first strict candidate past min_size wins, else the first loose one past
+        # avg_size, else max_size. Cut as soon as that is settled by the bytes seen so far.
+        while start < pos:
+            lo, mid, hi = start + min_size, start + avg_size, min(start + max_size, pos)
+            end = None
+            i = np.searchsorted(cuts_strict, lo)
+            if i < len(cuts_strict) and cuts_strict[i] < mid:
+                end = int(cuts_strict[i])
+            elif pos >= mid:
+                j = np.searchsorted(cuts_loose, mid)
+                if j < len(cuts_loose) and cuts_loose[j] < hi:
+                    end = int(cuts_loose[j])
+            if end is None:
+                if not done and pos < start + max_size:
+                    break
+                end = hi
+            yield bytes(buf[: end - start])
+            del buf[: end - start]
+            start = end
+        if done:
+            return
+
+
+@define
+class Recipe:
+    # parts in file order, [size, chunk sha1] or [size, None, base64 bytes] for literals
+    sha1: str
+    size: int
+    parts: list[list]
+    stored_size: int = 0
+    version: int = recipe_version
+
+    def chunk_sha1s(self) -> Iterator[str]:
+        return (p[1] for p in self.parts if p[1] is not None)
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(asdict(self), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "Recipe":
+        with open(path) as f:
+            d = json.load(f)
+        if d["version"] != recipe_version:
+            raise ValueError(f"{path} is recipe version {d['version']}")
+        return cls(**d)
+
+
+def store_chunk(store: BlobStore, data: bytes, level: int) -> tuple[str, int]:
+    # returns the chunk's sha1 and the compressed bytes it added, 0 if already stored
+    sha1 = hashlib.sha1(data).hexdigest()
+    path = store.chunk_path(sha1)
+    if os.path.exists(path):
+        return sha1, 0
+    frame = compress_frame(data, level)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # two threads can race on the same chunk, each writes its own temp name
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(frame)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return sha1, len(frame)
+
+
+def regions(src: str, size: int, is_tar: bool) -> Iterator[tuple[int, bool]]:
+    # (length, chunked) covering src in order, member data is chunked on its own
+    pos = 0
+    members = sorted(tar_members(src), key=lambda m: m.offset) if is_tar else []
+    for m in members:
+        if m.offset > pos:
+            yield m.offset - pos, m.offset - pos > literal_max
+        yield m.size, True
+        pos = m.offset + m.size
+    if size > pos:
+        yield size - pos, size - pos > literal_max
+
+
+def dedup(
+    store: BlobStore,
+    src: str,
+    expected_sha1: Optional[str] = None,
+    is_tar: bool = True,
+    level: int = level,
+    jobs: Optional[int] = None,
+) -> Recipe:
+    # one read of src: chunking and the whole file sha1 on this thread, chunk hashing,
+    # compression and writes on a pool. The recipe is written last, after every chunk it
+    # names is on disk.
+    jobs = jobs or os.cpu_count()
+    sha1 = hashlib.sha1()
+    size = os.path.getsize(src)
+    parts = []
+    stored = 0
+    with open(src, "rb") as f, ThreadPoolExecutor(jobs) as ex:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        pending = deque()
+
+        def read(n: int) -> bytes:
+            data = f.read(n)
+            sha1.update(data)
+            return data
+
+        def drain(n: int) -> None:
+            nonlocal stored
+            while len(pending) > n:
+                part, future = pending.popleft()
+                part[1], added = future.result()
+                stored += added
+
+        for length, chunked in regions(src, size, is_tar):
+            if not chunked:
+                parts.append([length, None, base64.b64encode(read(length)).decode()])
+                continue
+            for data in chunks(read, length):
+                part = [len(data), None]
+                parts.append(part)
+                pending.append((part, ex.submit(store_chunk, store, data, level)))
+                drain(2 * jobs)
+        drain(0)
+    recipe = Recipe(sha1.hexdigest(), size, parts, stored)
+    if expected_sha1 is not None and recipe.sha1 != expected_sha1:
+        # chunks already written are harmless, gc drops them if nothing refers to them
+        raise ChecksumMismatch(f"{src}: sha1 {recipe.sha1} != expected {expected_sha1}")
+    recipe.save(store.recipe_path(recipe.sha1))
+    metrics.inc("quartus_dedup_bytes_total", size)
+    metrics.inc("quartus_dedup_stored_bytes_total", stored)
+    return recipe
+
+
+tls = threading.local()
+
+
+def load_chunk(store: BlobStore, sha1: str, size: int) -> bytes:
+    if not hasattr(tls, "dctx"):
+        tls.dctx = zstandard.ZstdDecompressor()
+    with open(store.chunk_path(sha1), "rb") as f:
+        data = tls.dctx.decompress(f.read(), max_output_size=size)
+    if len(data) != size:
+        raise ChecksumMismatch(f"chunk {sha1}: {len(data)} bytes != {size}")
+    return data
+
+
+def bounded_map(ex: Executor, fn: Callable, items: Iterable, depth: int) -> Iterator:
+    # Executor.map submits everything up front, this keeps depth results in memory
+    pending = deque()
+    for item in items:
+        pending.append(ex.submit(fn, *item))
+        if len(pending) > depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_recipe(store: BlobStore, recipe: Recipe, jobs: Optional[int] = None) -> Iterator[bytes]:
+    jobs = jobs or os.cpu_count()
+
+    def part(size: int, sha1: Optional[str], literal: Optional[str] = None) -> bytes:
+        if sha1 is None:
+            return base64.b64decode(literal)
+        return load_chunk(store, sha1, size)
+
+    with ThreadPoolExecutor(jobs) as ex:
+        yield from bounded_map(ex, part, recipe.parts, 2 * jobs)
+
+
+def iter_range(store: BlobStore, recipe: Recipe, offset: int, size: int) -> Iterator[bytes]:
+    # only the chunks overlapping the range are read
+    starts = list(itertools.accumulate((p[0] for p in recipe.parts), initial=0))
+    end = min(offset + size, recipe.size)
+    i = bisect.bisect_right(starts, offset) - 1
+    while offset < end:
+        length, sha1, *literal = recipe.parts[i]
+        data = base64.b64decode(literal[0]) if sha1 is None else load_chunk(store, sha1, length)
+        lo = offset - starts[i]
+        hi = min(end - starts[i], length)
+        yield data[lo:hi]
+        offset = starts[i] + hi
+        i += 1
+
+
+def assemble(store: BlobStore, sha1: str, dst: str) -> str:
+    # the original file byte for byte, checked against the sha1 recorded at dedup time
+    recipe = Recipe.load(store.recipe_path(sha1))
+    h = hashlib.sha1()
+    with open(dst + ".tmp", "wb") as out:
+        for data in iter_recipe(store, recipe):
+            h.update(data)
+            out.write(data)
+    if h.hexdigest() != recipe.sha1:
+        os.unlink(dst + ".tmp")
+        raise ChecksumMismatch(f"{sha1}: assembled sha1 {h.hexdigest()} != {recipe.sha1}")
+    os.replace(dst + ".tmp", dst)
+    return dst
+
+
+def check(store: BlobStore, sha1: str) -> str:
+    recipe = Recipe.load(store.recipe_path(sha1))
+    h = hashlib.sha1()
+    for data in iter_recipe(store, recipe):
+        h.update(data)
+    if h.hexdigest() != recipe.sha1:
+        raise ChecksumMismatch(f"{sha1}: assembled sha1 {h.hexdigest()} != {recipe.sha1}")
+    return recipe.sha1
+
+
+def recipes(store: BlobStore) -> Iterator[Recipe]:
+    top = os.path.join(store.root, "recipes")
+    if not os.path.isdir(top):
+        return
+    for d in os.scandir(top):
+        for e in os.scandir(d.path):
+            if e.name.endswith(".json"):
+                yield Recipe.load(e.path)
+
+
+def chunk_files(store: BlobStore) -> Iterator[os.DirEntry]:
+    top = os.path.join(store.root, "chunks")
+    if not os.path.isdir(top):
+        return
+    for d in os.scandir(top):
+        yield from os.scandir(d.path)
+
+
+def stats(store: BlobStore) -> dict:
+    logical = chunked = chunk_count = stored = 0
+    referenced = set()
+    n = 0
+    for recipe in recipes(store):
+        n += 1
+        logical += recipe.size
+        for p in recipe.parts:
+            if p[1] is not None:
+                chunked += p[0]
+                referenced.add(p[1])
+    for e in chunk_files(store):
+        if e.name.endswith(".zst"):
+            chunk_count += 1
+            stored += e.stat().st_size
+    return {
+        "recipes": n,
+        "logical_bytes": logical,
+        "chunked_bytes": chunked,
+        "chunks": chunk_count,
+        "referenced_chunks": len(referenced),
+        "stored_bytes": stored,
+        "ratio": stored / logical if logical else 0,
+    }
+
+
+def gc(store: BlobStore) -> int:
+    # removes chunks no recipe names, don't run it alongside a dedup
+    referenced = {sha1 for recipe in recipes(store) for sha1 in recipe.chunk_sha1s()}
+    freed = 0
+    for e in chunk_files(store):
+        if e.name.removesuffix(".zst") not in referenced:
+            freed += e.stat().st_size
+            os.unlink(e.path)
+    return freed
+
+
+def dedup_store(
+    store: BlobStore, root: str, dls: list, drop: bool, level: int, tars_only: bool = True
+) -> None:
+    # chunks every blob once, with drop the blob and its tree links are removed after the
+    # recipe assembles back to the same sha1, BlobStore.link brings them back on demand
+    by_sha1 = {}
+    for dl in dls:
+        if not tars_only or dl.filename.endswith(".tar"):
+            by_sha1.setdefault(dl.sha1, []).append(dl)
+    # oldest first so each release is stored as what changed since the one before it
+    for sha1, same in sorted(by_sha1.items(), key=lambda kv: min(d.version for d in kv[1])):
+        blob = store.blob_path(sha1)
+        if not store.is_chunked(sha1):
+            if not os.path.exists(blob):
+                continue
+            is_tar = same[0].filename.endswith(".tar")
+            recipe = dedup(store, blob, sha1, is_tar, level)
+            new = recipe.stored_size / recipe.size if recipe.size else 0
+            print(f"chunked {same[0].filename}: {len(recipe.parts)} parts, {new:.1%} new")
+        if drop and os.path.exists(blob):
+            check(store, sha1)
+            for dl in same:
+                path = archive_path(root, dl)
+                if os.path.exists(path) and os.path.samefile(path, blob):
+                    os.unlink(path)
+            os.unlink(blob)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deduplicated chunk store across releases")
+    parser.add_argument("root", help="archive root directory")
+    parser.add_argument("-c", "--catalog", default=catalog_path, help="catalog database")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    dd = sub.add_parser("dedup", help="chunk the blobs matching the query")
+    dd.add_argument("--level", type=int, default=level)
+    dd.add_argument("--drop", action="store_true", help="remove the whole blobs")
+    dd.add_argument("--all-files", action="store_true", help="not just tars")
+    add_query_args(dd)
+    rs = sub.add_parser("restore", help="reassemble a blob and relink it")
+    rs.add_argument("sha1")
+    sub.add_parser("stats", help="logical vs stored size")
+    sub.add_parser("gc", help="remove unreferenced chunks")
+    args = parser.parse_args()
+
+    store = BlobStore(args.root)
+    if args.cmd == "dedup":
+        with Catalog(args.catalog) as catalog:
+            dls = catalog.query(**query_args(args))
+        dedup_store(store, args.root, dls, args.drop, args.level, not args.all_files)
+    elif args.cmd == "restore":
+        store.unpack(args.sha1)
+        with Catalog(args.catalog) as catalog:
+            for dl in catalog.query(sha1=args.sha1):
+                store.link(dl.sha1, archive_path(args.root, dl))
+    elif args.cmd == "stats":
+        print(stats(store))
+    elif args.cmd == "gc":
+        print(f"freed {gc(store)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import importlib
+import os
+import sys
+
+# subcommand -> (module, entry point, arguments put in front, help). Only the module behind
+# the subcommand that runs is imported, so a catalog query never loads the network, html
+# or compression stacks. `quartus_bench.py startup` holds this to a time budget.
+commands = {
+    "crawl": (
+        "quartus_archive_test",
+        "cli",
+        ["--no-resolve"],
+        "refresh the catalog from the download pages",
+    ),
+    "resolve": ("quartus_archive_test", "cli", ["--no-crawl"], "resolve cdn urls"),
+    "plan": ("quartus_plan", "main", [], "size up a filtered slice of the catalog"),
+    "download": ("quartus_download", "cli", [], "download resolved installers"),
+    "verify": ("quartus_verify", "cli", [], "check the archive against the catalog"),
+    "query": ("quartus_catalog", "main", ["query"], "print matching downloads"),
+    "import": ("quartus_catalog", "main", ["import"], "import a legacy pickle or jsonl"),
+    "mirror": ("quartus_mirror", "main", [], "serve the archive over http"),
+    "pack": ("quartus_pack", "main", [], "seekable zstd packs of archived tars"),
+    "chunk": ("quartus_chunk", "main", [], "deduplicated chunk store across releases"),
+    "ledger": ("quartus_ledger", "main", [], "split archiving across machines"),
+    "bench": ("quartus_bench", "main", [], "benchmarks"),
+}
+
+
+def usage(prog: str) -> str:
+    width = max(map(len, commands))
+    lines = [f"usage: {prog} <command> [args]", "", "commands:"]
+    lines += [f"  {name:{width}}  {help}" for name, (_, _, _, help) in commands.items()]
+    lines.append(f"\n{prog} <command> -h for a command's arguments")
+    return "\n".join(lines) + "\n"
+
+
+def main() -> None:
+    prog = os.path.basename(sys.argv[0])
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        sys.stderr.write(usage(prog))
+        sys.exit(0 if sys.argv[1:2] in (["-h"], ["--help"]) else 2)
+    cmd = sys.argv[1]
+    module, entry, prefix, _ = commands[cmd]
+    # the command's own argparse sees its arguments and names itself in --help, a module
+    # with subcommands of its own adds the name itself
+    name = prog if prefix[:1] == [cmd] else f"{prog} {cmd}"
+    sys.argv = [name, *prefix, *sys.argv[2:]]
+    try:
+        getattr(importlib.import_module(module), entry)()
+    except BrokenPipeError:
+        # output piped into head and the like, see the signal module docs
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,924 @@
+import argparse
+import bisect
+import errno
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from attrs import define, field
+from rich import print
+
+from quartus_archive_test import init_session
+from quartus_catalog import (
+    Catalog,
+    add_query_args,
+    catalog_path,
+    query_args,
+    version_key,
+)
+from quartus_cdn import LinkExpired, Revalidator
+from quartus_metrics import add_metrics_args, metrics, metrics_args, rate_buckets
+from quartus_model import (
+    ChecksumMismatch,
+    Download,
+    archive_path,
+    is_complete,
+    listed_size_bounds,
+)
+from quartus_store import BlobStore
+from quartus_throttle import TokenBucket, throttle
+
+chunk_size = 1024 * 1024
+connect_timeout = 30
+
+
+@define
+class Journal:
+    # sidecar recording the byte ranges of path that have been written
+    path: str
+    size: int
+    done: list[tuple[int, int]] = field(factory=list)
+    flush_interval: float = 5
+    flush_bytes: int = 256 * 1024 * 1024
+    unflushed: int = 0
+    last_flush: float = field(factory=time.monotonic)
+    # bytes covered by the journal on disk, checkpoints can finish out of order
+    flushed: int = 0
+    # the file being written, synced before each checkpoint so the journal never claims
+    # bytes that a crash could still lose
+    fd: Optional[int] = None
+    flush_lock: threading.Lock = field(factory=threading.Lock)
+
+    @staticmethod
+    def journal_path(path: str) -> str:
+        return path + ".journal"
+
+    @classmethod
+    def load(cls, path: str, size: int) -> "Journal":
+        try:
+            with open(cls.journal_path(path)) as f:
+                j = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return cls(path, size)
+        if j["size"] != size:
+            return cls(path, size)
+        return cls(path, size, [tuple(r) for r in j["done"]])
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return os.path.exists(cls.journal_path(path))
+
+    @classmethod
+    def done_bytes(cls, path: str) -> Optional[int]:
+        # bytes the journal on disk records as written, None if there isn't a readable one
+        try:
+            with open(cls.journal_path(path)) as f:
+                return sum(end - start for start, end in json.load(f)["done"])
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return None
+
+    def add(self, start: int, end: int) -> None:
+        i = bisect.bisect_left(self.done, (start, end))
+        # coalesce with an adjacent or overlapping neighbour on either side
+        if i > 0 and self.done[i - 1][1] >= start:
+            i -= 1
+            start = self.done[i][0]
+            end = max(end, self.done[i][1])
+            del self.done[i]
+        while i < len(self.done) and self.done[i][0] <= end:
+            end = max(end, self.done[i][1])
+            del self.done[i]
+        self.done.insert(i, (start, end))
+        self.unflushed += end - start
+
+    def missing(self) -> list[tuple[int, int]]:
+        gaps = []
+        pos = 0
+        for start, end in self.done:
+            if start > pos:
+                gaps.append((pos, start))
+            pos = max(pos, end)
+        if pos < self.size:
+            gaps.append((pos, self.size))
+        return gaps
+
+    @property
+    def complete(self) -> bool:
+        return self.done == [(0, self.size)]
+
+    def checkpoint(self) -> Optional[list[tuple[int, int]]]:
+        # the ranges to flush when a checkpoint is due, taken under the writers' lock so
+        # the sync and journal write can happen outside it
+        if (
+            self.unflushed < self.flush_bytes
+            and time.monotonic() - self.last_flush < self.flush_interval
+        ):
+            return None
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        return list(self.done)
+
+    def flush(self, done: Optional[list[tuple[int, int]]] = None) -> None:
+        done = list(self.done) if done is None else done
+        jpath = self.journal_path(self.path)
+        with self.flush_lock:
+            covered = sum(end - start for start, end in done)
+            if covered < self.flushed:
+                return
+            self.flushed = covered
+            if self.fd is not None:
+                fdatasync(self.fd)
+            with open(jpath + ".tmp", "w") as f:
+                json.dump({"size": self.size, "done": done}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(jpath + ".tmp", jpath)
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def remove(self) -> None:
+        try:
+            os.unlink(self.journal_path(self.path))
+        except FileNotFoundError:
+            pass
+
+
+@define
+class Segment:
+    # [start, end) still to be fetched, start advances as bytes are reserved for writing
+    start: int
+    end: int
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.start
+
+
+# fsync without the metadata flush where the platform has it
+fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+def preallocate(fd: int, size: int) -> None:
+    # reserve a new file's blocks up front so segments landing all over it don't fragment a
+    # multi-GB file and a full disk fails now rather than hours in. Filesystems that can't
+    # are left sparse.
+    if not hasattr(os, "posix_fallocate") or os.fstat(fd).st_blocks * 512 >= size:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            raise
+
+
+def pwrite_all(fd: int, data: memoryview, offset: int) -> None:
+    while data:
+        n = os.pwrite(fd, data, offset)
+        data = data[n:]
+        offset += n
+
+
+def body_readinto(r: requests.Response) -> Callable[[memoryview], int]:
+    # read the body into the caller's reused buffer through urllib3, which decodes any
+    # Content-Encoding as iter_content would and releases the connection at the end
+    r.raw.decode_content = True
+    return r.raw.readinto
+
+
+# errors from opening a response through requests and from reading its body through
+# urllib3, which requests only translates inside iter_content
+body_errors = (
+    requests.RequestException,
+    urllib3.exceptions.HTTPError,
+    ConnectionError,
+    TimeoutError,
+    ValueError,
+)
+
+
+@define
+class PrefixHasher:
+    # sha1 of the contiguous written prefix of a file, fed straight from the network. Bytes
+    # other connections wrote ahead of the prefix wait in a reorder buffer keyed by offset
+    # until the prefix reaches them. Only what didn't fit in it, or was written by an
+    # earlier run, is read back from disk.
+    fd: int
+    max_buffered: int = 256 * 1024 * 1024
+    sha1: "hashlib._Hash" = field(factory=hashlib.sha1)
+    pos: int = 0
+    reread: int = 0
+    buffered: int = 0
+    ahead: dict[int, bytes] = field(factory=dict)
+    # start -> end of ranges ahead of the prefix that are only on disk
+    on_disk: dict[int, int] = field(factory=dict)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def catch_up(self, end: int) -> None:
+        while self.pos < end:
+            buf = os.pread(self.fd, min(chunk_size, end - self.pos), self.pos)
+            if not buf:
+                raise ValueError(f"short read hashing fd {self.fd} at {self.pos}")
+            self.sha1.update(buf)
+            self.pos += len(buf)
+            self.reread += len(buf)
+
+    def hold(self, offset: int, data: memoryview) -> None:
+        # the furthest pieces make room for nearer ones, what doesn't fit is read back later
+        while self.buffered + len(data) > self.max_buffered and self.ahead:
+            last = max(self.ahead)
+            if last < offset:
+                break
+            evicted = self.ahead.pop(last)
+            self.buffered -= len(evicted)
+            self.on_disk[last] = last + len(evicted)
+        if self.buffered + len(data) <= self.max_buffered:
+            self.ahead[offset] = bytes(data)
+            self.buffered += len(data)
+        else:
+            self.on_disk[offset] = offset + len(data)
+
+    def advance(self) -> None:
+        while True:
+            if (data := self.ahead.pop(self.pos, None)) is not None:
+                self.buffered -= len(data)
+                self.sha1.update(data)
+                self.pos += len(data)
+            elif (end := self.on_disk.pop(self.pos, None)) is not None:
+                self.catch_up(end)
+            else:
+                return
+
+    def feed(self, offset: int, data: memoryview) -> None:
+        # data must already be written, a piece that can't be held is read back from disk
+        with self.lock:
+            if offset > self.pos:
+                self.hold(offset, data)
+                return
+            if offset < self.pos:
+                return
+            self.sha1.update(data)
+            self.pos += len(data)
+            self.advance()
+
+    def finish(self, size: int) -> str:
+        with self.lock:
+            self.advance()
+            self.catch_up(size)
+            self.ahead.clear()
+            self.buffered = 0
+            return self.sha1.hexdigest()
+
+
+@define
+class SegmentedDownload:
+    url: str
+    path: str
+    num_segments: int = 8
+    piece_size: int = 32 * 1024 * 1024
+    min_split: int = 4 * 1024 * 1024
+    stall_timeout: float = 30
+    retries: int = 5
+    session_factory: Callable[[], requests.Session] = init_session
+    # shared by every download under a bandwidth cap, one token per byte
+    bandwidth: Optional[TokenBucket] = None
+    size: Optional[int] = None
+    expected_sha1: Optional[str] = None
+    pending: deque[Segment] = field(factory=deque)
+    segments: list[Segment] = field(factory=list)
+    journal: Optional[Journal] = None
+    hasher: Optional[PrefixHasher] = None
+    bytes_done: int = 0
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    @property
+    def host(self) -> str:
+        return urlsplit(self.url).hostname or ""
+
+    def observe(self, seconds: float) -> None:
+        if metrics.enabled and self.bytes_done:
+            metrics.observe("quartus_file_seconds", seconds)
+            bytes_per_second = self.bytes_done / seconds
+            metrics.observe("quartus_file_bytes_per_second", bytes_per_second, rate_buckets)
+
+    def probe(self, session: requests.Session) -> Optional[int]:
+        r = session.head(self.url, allow_redirects=True, timeout=connect_timeout)
+        self.check_status(r.status_code)
+        r.raise_for_status()
+        if r.headers.get("Accept-Ranges", "none").lower() != "bytes":
+            return None
+        if "Content-Length" not in r.headers:
+            return None
+        return int(r.headers["Content-Length"])
+
+    def check_status(self, status: int) -> None:
+        if status == 403:
+            raise LinkExpired(f"cdn refused {self.url}")
+
+    def split_pieces(self, gaps: list[tuple[int, int]]) -> deque[Segment]:
+        # pieces are handed out in file order so every connection works just ahead of the
+        # hashed prefix and its reorder buffer stays small
+        pieces = deque()
+        for start, end in gaps:
+            for piece_start in range(start, end, self.piece_size):
+                pieces.append(Segment(piece_start, min(piece_start + self.piece_size, end)))
+        return pieces
+
+    def pop_pending(self) -> Optional[Segment]:
+        with self.lock:
+            self.segments = [s for s in self.segments if s.remaining > 0]
+            if not self.pending:
+                return None
+            seg = self.pending.popleft()
+            self.segments.append(seg)
+            return seg
+
+    def next_segment(self) -> Optional[Segment]:
+        # keep new pieces within a window of the hashed prefix that the reorder buffer can
+        # hold, past it help out whichever connection is holding the prefix back
+        window_end = self.hasher.pos + self.num_segments * self.piece_size
+        if self.pending and self.pending[0].start < window_end:
+            return self.pop_pending()
+        return self.steal() or self.pop_pending()
+
+    def steal(self) -> Optional[Segment]:
+        # hand an idle connection the back half of the earliest segment with enough left to
+        # split, a slow or stalled connection is what leaves such a segment behind
+        with self.lock:
+            victims = [s for s in self.segments if s.remaining >= 2 * self.min_split]
+            if not victims:
+                return None
+            victim = min(victims, key=lambda s: s.start)
+            mid = victim.start + victim.remaining // 2
+            seg = Segment(mid, victim.end)
+            victim.end = mid
+            self.segments.append(seg)
+            return seg
+
+    def reserve(self, seg: Segment, n: int) -> tuple[int, int]:
+        with self.lock:
+            n = min(n, seg.remaining)
+            offset = seg.start
+            seg.start += n
+            return offset, n
+
+    def wrote(self, offset: int, data: memoryview) -> None:
+        n = len(data)
+        if metrics.enabled:
+            metrics.inc("quartus_bytes_total", n, host=self.host)
+        checkpoint = None
+        with self.lock:
+            self.bytes_done += n
+            if self.journal is not None:
+                self.journal.add(offset, offset + n)
+                checkpoint = self.journal.checkpoint()
+        if self.hasher is not None:
+            self.hasher.feed(offset, data)
+        if checkpoint is not None:
+            self.flush_journal(checkpoint)
+
+    def flush_journal(self, done: list[tuple[int, int]]) -> None:
+        self.journal.flush(done)
+
+    def fetch_segment(
+        self, session: requests.Session, fd: int, seg: Segment, buf: memoryview
+    ) -> None:
+        attempt = 0
+        while seg.remaining > 0:
+            headers = {"Range": f"bytes={seg.start}-{seg.end - 1}"}
+            start = seg.start
+            try:
+                with session.get(
+                    self.url,
+                    headers=headers,
+                    stream=True,
+                    timeout=(connect_timeout, self.stall_timeout),
+                ) as r:
+                    self.check_status(r.status_code)
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise ValueError(f"server ignored range request for {self.url}")
+                    readinto = body_readinto(r)
+                    while got := readinto(buf):
+                        if self.bandwidth is not None:
+                            self.bandwidth.acquire(got)
+                        offset, n = self.reserve(seg, got)
+                        if n:
+                            pwrite_all(fd, buf[:n], offset)
+                            self.wrote(offset, buf[:n])
+                        if n < got or seg.remaining == 0:
+                            # segment was shortened by a steal
+                            break
+                    if seg.remaining > 0 and seg.start == start:
+                        # re-requesting a range that came back empty would never end
+                        raise ValueError(f"empty range response from {self.url}")
+                    attempt = 0
+            except body_errors as e:
+                # only a pass that got nowhere counts towards giving up
+                if seg.start > start:
+                    attempt = 0
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                metrics.inc("quartus_retries_total", host=self.host)
+                print(f"segment {seg.start}-{seg.end} of {self.path} failed: {e!r}, retrying")
+                # the adapter has already backed off the host's limiter, this just waits
+                # out Retry-After or the jittered backoff before the range is re-requested
+                time.sleep(throttle.retry_delay(attempt, e))
+
+    def worker(self, fd: int) -> None:
+        session = self.session_factory()
+        # each connection reads into the same buffer for the whole download
+        buf = memoryview(bytearray(chunk_size))
+        while (seg := self.next_segment()) is not None:
+            self.fetch_segment(session, fd, seg, buf)
+
+    def fetch_single_stream(self, session: requests.Session, fd: int) -> None:
+        with session.get(self.url, stream=True, timeout=(connect_timeout, self.stall_timeout)) as r:
+            self.check_status(r.status_code)
+            r.raise_for_status()
+            readinto = body_readinto(r)
+            buf = memoryview(bytearray(chunk_size))
+            offset = 0
+            while n := readinto(buf):
+                if self.bandwidth is not None:
+                    self.bandwidth.acquire(n)
+                pwrite_all(fd, buf[:n], offset)
+                self.wrote(offset, buf[:n])
+                offset += n
+            self.size = offset
+
+    def verify(self) -> None:
+        sha1 = self.hasher.finish(self.size)
+        if self.hasher.reread:
+            print(f"{self.path}: read back {self.hasher.reread} of {self.size} bytes to hash")
+        if self.expected_sha1 is not None and sha1 != self.expected_sha1:
+            raise ChecksumMismatch(f"{self.path}: sha1 {sha1} != expected {self.expected_sha1}")
+
+    def run(self) -> str:
+        session = self.session_factory()
+        if self.size is None:
+            self.size = self.probe(session)
+        fd = self.open()
+        try:
+            if self.size is None:
+                os.ftruncate(fd, 0)
+                self.fetch_single_stream(session, fd)
+                self.verify()
+                self.commit(fd)
+                return self.path
+            if self.prepare(fd):
+                try:
+                    with ThreadPoolExecutor(max_workers=self.num_segments) as executor:
+                        futures = [
+                            executor.submit(self.worker, fd)
+                            for _ in range(min(self.num_segments, len(self.pending)))
+                        ]
+                        for future in futures:
+                            future.result()
+                finally:
+                    self.journal.flush()
+            self.finish(fd)
+        finally:
+            os.close(fd)
+        return self.path
+
+    @property
+    def part_path(self) -> str:
+        # written under this name and renamed to path once verified, so a file at path is
+        # always whole
+        return self.path + ".part"
+
+    def open(self) -> int:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if not os.path.exists(self.part_path) and Journal.exists(self.path):
+            # a download interrupted before they were written under part_path
+            os.replace(self.path, self.part_path)
+            os.replace(Journal.journal_path(self.path), Journal.journal_path(self.part_path))
+        fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        # the window of pieces in flight plus the one each connection may run past it
+        self.hasher = PrefixHasher(fd, (self.num_segments + 1) * self.piece_size)
+        return fd
+
+    def prepare(self, fd: int) -> bool:
+        # size the file, pick up the journal and queue the missing pieces, False if none
+        if self.journal is None:
+            self.journal = Journal.load(self.part_path, self.size)
+        self.journal.fd = fd
+        if os.fstat(fd).st_size < self.size and not Journal.exists(self.part_path):
+            # a truncated file without a journal, e.g. a single-stream download that died;
+            # everything up to the truncation point is good
+            prefix = os.fstat(fd).st_size
+            if prefix:
+                self.journal.add(0, prefix)
+        preallocate(fd, self.size)
+        os.ftruncate(fd, self.size)
+        gaps = self.journal.missing()
+        if self.journal.done and self.journal.done[0][0] == 0:
+            # sha1 state can't be saved in the journal, so a resumed prefix is hashed again
+            self.hasher.catch_up(self.journal.done[0][1])
+        for start, end in self.journal.done:
+            if start > self.hasher.pos:
+                self.hasher.on_disk[start] = end
+        if not gaps:
+            return False
+        self.journal.flush()
+        self.pending = self.split_pieces(gaps)
+        return True
+
+    def finish(self, fd: int) -> None:
+        assert self.journal.complete
+        try:
+            self.verify()
+        except ChecksumMismatch:
+            self.journal.remove()
+            raise
+        self.commit(fd)
+        self.journal.remove()
+
+    def commit(self, fd: int) -> None:
+        # durable under the temporary name before the rename makes it the real file
+        os.fsync(fd)
+        os.replace(self.part_path, self.path)
+        dirfd = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+
+def quarantine(root: str, path: str) -> str:
+    qpath = os.path.join(root, "quarantine", os.path.relpath(path, root))
+    os.makedirs(os.path.dirname(qpath), exist_ok=True)
+    os.replace(path, qpath)
+    return qpath
+
+
+def already_have(dl: Download, path: str, store: Optional[BlobStore]) -> bool:
+    if store is not None and store.has(dl.sha1):
+        store.link(dl.sha1, path)
+        print(f"already have {dl.filename} as {dl.sha1}")
+        return True
+    if is_complete(dl, path):
+        print(f"already have {dl.filename}")
+        return True
+    return False
+
+
+def download(
+    dl: Download,
+    root: str,
+    segments: int = 8,
+    store: Optional[BlobStore] = None,
+    resolver: Optional[Revalidator] = None,
+    **kwargs,
+) -> str:
+    path = archive_path(root, dl)
+    if already_have(dl, path, store):
+        return path
+    if resolver is not None and resolver.stale(dl):
+        resolver.resolve(dl)
+    assert dl.cdn_url is not None
+    print(f"downloading {dl.filename} to {path}")
+    start = time.perf_counter()
+    relinked = False
+    while True:
+        used_at = time.time()
+        sd = SegmentedDownload(
+            dl.cdn_url, path, num_segments=segments, expected_sha1=dl.sha1, **kwargs
+        )
+        try:
+            sd.run()
+            break
+        except ChecksumMismatch as e:
+            print(f"[red]{e}, quarantined to {quarantine(root, sd.part_path)}[/red]")
+            raise
+        except LinkExpired:
+            # the journal keeps what was written, so the fresh link resumes from there
+            if resolver is None or relinked:
+                raise
+            resolver.resolve(dl, rejected=True)
+            relinked = True
+    if resolver is not None:
+        resolver.worked(dl, used_at)
+    sd.observe(time.perf_counter() - start)
+    if store is not None:
+        store.ingest(path, dl.sha1)
+    return path
+
+
+# files under this are packed alongside the big ones instead of queueing behind them
+small_file = 256 * 1024 * 1024
+
+# sort keys for --priority, applied in the order given
+priority_rules: dict[str, Callable[[Download], object]] = {
+    "latest": lambda dl: -version_key(dl.version),
+    "oldest": lambda dl: version_key(dl.version),
+    "linux": lambda dl: dl.operating_system != "linux",
+    "windows": lambda dl: dl.operating_system != "windows",
+    "pro": lambda dl: dl.edition != "pro",
+    "standard": lambda dl: dl.edition != "standard",
+    "lite": lambda dl: dl.edition != "lite",
+    "smallest": lambda dl: dl.listed_size,
+    "largest": lambda dl: -dl.listed_size,
+}
+
+
+def priority_key(rules: list[str]) -> Callable[[Download], tuple]:
+    for rule in rules:
+        if rule not in priority_rules:
+            raise ValueError(f"unknown priority rule '{rule}', have {', '.join(priority_rules)}")
+    return lambda dl: tuple(priority_rules[rule](dl) for rule in rules)
+
+
+@define
+class Scheduler:
+    # admits downloads in priority order while the disk has room for their listed size
+    # and the current window's byte budget isn't spent. One slot is kept for small files
+    # whenever any are queued so they trickle through beside the multi-GB ones.
+    root: str
+    jobs: int = 2
+    segments: int = 8
+    priority: list[str] = field(factory=list)
+    # bytes per second across every connection
+    bandwidth: Optional[float] = None
+    window_bytes: Optional[int] = None
+    window_seconds: float = 24 * 60 * 60
+    min_free: int = 1024 * 1024 * 1024
+    small_size: int = small_file
+    store: Optional[BlobStore] = None
+    # re-resolves expiring and refused cdn links, see quartus_cdn
+    resolver: Optional[Revalidator] = None
+    kwargs: dict = field(factory=dict)
+    window_start: float = field(factory=time.monotonic)
+    window_used: int = 0
+    # archive path of each admitted file: the space it was admitted for and what its files
+    # already held then
+    reserved: dict[str, tuple[int, int]] = field(factory=dict)
+
+    def window_room(self) -> Optional[int]:
+        if self.window_bytes is None:
+            return None
+        elapsed = time.monotonic() - self.window_start
+        if elapsed >= self.window_seconds:
+            self.window_start += elapsed // self.window_seconds * self.window_seconds
+            self.window_used = 0
+        return self.window_bytes - self.window_used
+
+    def window_left(self) -> float:
+        return self.window_start + self.window_seconds - time.monotonic()
+
+    def allocated(self, path: str) -> int:
+        # blocks held by a download's part file or the finished file
+        have = 0
+        for p in (path + ".part", path):
+            try:
+                have = max(have, os.stat(p).st_blocks * 512)
+            except FileNotFoundError:
+                pass
+        return have
+
+    def disk_needed(self, dl: Download) -> int:
+        # worst case for the listed size less whatever a previous run already wrote
+        if self.store is not None and self.store.has(dl.sha1):
+            return 0
+        return max(
+            0, listed_size_bounds(dl.listed_size)[1] - self.allocated(archive_path(self.root, dl))
+        )
+
+    def to_transfer(self, dl: Download) -> int:
+        # what the window budget is charged, the listed size less what earlier runs already
+        # fetched. Preallocated blocks say nothing about that, the journal does.
+        if self.store is not None and self.store.has(dl.sha1):
+            return 0
+        path = archive_path(self.root, dl)
+        if is_complete(dl, path):
+            return 0
+        upper = listed_size_bounds(dl.listed_size)[1]
+        for p in (path + ".part", path):
+            if (done := Journal.done_bytes(p)) is not None:
+                return max(0, upper - done)
+        try:
+            # a single-stream download that died, everything it wrote is good
+            return max(0, upper - os.stat(path + ".part").st_size)
+        except FileNotFoundError:
+            return upper
+
+    def reserve(self, dl: Download, need: int) -> None:
+        path = archive_path(self.root, dl)
+        self.reserved[path] = (need, self.allocated(path))
+
+    def unreserve(self, dl: Download) -> None:
+        self.reserved.pop(archive_path(self.root, dl), None)
+
+    def outstanding(self) -> int:
+        # space admitted downloads may still take. Blocks they have preallocated or written
+        # since are already gone from the free space, so they stop counting here.
+        return sum(
+            max(0, need - (self.allocated(path) - had))
+            for path, (need, had) in self.reserved.items()
+        )
+
+    def disk_free(self) -> int:
+        path = self.root
+        while not os.path.exists(path):
+            path = os.path.dirname(os.path.abspath(path))
+        return shutil.disk_usage(path).free - self.min_free - self.outstanding()
+
+    def admit(
+        self, queue: list[list[Download]], running: dict
+    ) -> Optional[tuple[list[Download], int]]:
+        # the first group in priority order that fits, dropping ones that never can
+        num_large = sum(same[0].listed_size >= self.small_size for same, _ in running.values())
+        smalls_queued = any(same[0].listed_size < self.small_size for same in queue)
+        room = self.window_room()
+        i = 0
+        while i < len(queue):
+            dl = queue[i][0]
+            large = dl.listed_size >= self.small_size
+            if large and smalls_queued and num_large >= max(1, self.jobs - 1):
+                i += 1
+                continue
+            need = self.disk_needed(dl)
+            if need > self.disk_free():
+                if not running:
+                    print(f"[red]skipping {dl.filename}, not enough free space[/red]")
+                    del queue[i]
+                else:
+                    i += 1
+                continue
+            charge = self.to_transfer(dl) if room is not None else 0
+            if room is not None and charge > room:
+                if charge > self.window_bytes:
+                    print(f"[red]skipping {dl.filename}, larger than the window budget[/red]")
+                    del queue[i]
+                else:
+                    i += 1
+                continue
+            self.reserve(dl, need)
+            self.window_used += charge
+            return queue.pop(i), charge
+        return None
+
+    def run(self, dls: list[Download]) -> list[Download]:
+        queue = self.queue(dls)
+        kwargs = self.download_kwargs()
+        done = []
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while queue or running:
+                while len(running) < self.jobs and (admitted := self.admit(queue, running)):
+                    same, _ = admitted
+                    future = executor.submit(
+                        download,
+                        same[0],
+                        self.root,
+                        self.segments,
+                        self.store,
+                        self.resolver,
+                        **kwargs,
+                    )
+                    running[future] = admitted
+                if not running:
+                    if queue:
+                        # everything left is waiting on the next window
+                        time.sleep(max(0.0, self.window_left()))
+                    continue
+                timeout = None
+                if self.window_bytes is not None and queue:
+                    timeout = max(0.0, self.window_left())
+                finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    same, charge = running.pop(future)
+                    if self.finished(same, charge, future.exception()):
+                        done += same
+        return done
+
+    def download_kwargs(self) -> dict:
+        kwargs = dict(self.kwargs)
+        if self.bandwidth is not None:
+            kwargs["bandwidth"] = TokenBucket(self.bandwidth, self.bandwidth)
+        return kwargs
+
+    def finished(self, same: list[Download], charge: int, exc: Optional[BaseException]) -> bool:
+        self.unreserve(same[0])
+        if exc is not None:
+            print(f"failed to download {same[0].filename}: {exc!r}")
+            return False
+        for dl in same[1:]:
+            if self.store is not None:
+                self.store.link(dl.sha1, archive_path(self.root, dl))
+        return True
+
+    def queue(self, dls: list[Download]) -> list[list[Download]]:
+        # with a store each distinct sha1 is fetched once and every other listing is linked
+        key = priority_key(self.priority)
+        by_sha1 = {}
+        for dl in dls:
+            by_sha1.setdefault(dl.sha1 if self.store is not None else id(dl), []).append(dl)
+        # a planned group may have only one listing resolved, that one is fetched
+        queue = [
+            sorted(same, key=lambda dl: (dl.cdn_url is None, key(dl))) for same in by_sha1.values()
+        ]
+        queue.sort(key=lambda same: key(same[0]))
+        return queue
+
+
+def download_all(
+    dls: list[Download], root: str, jobs: int = 2, segments: int = 8, dedup: bool = True, **kwargs
+) -> list[Download]:
+    store = BlobStore(root) if dedup else None
+    return Scheduler(root, jobs, segments, store=store, kwargs=kwargs).run(dls)
+
+
+def main(
+    catalog_path: str,
+    scheduler: Scheduler,
+    filters: dict,
+    use_async: bool = False,
+    plan_path: Optional[str] = None,
+):
+    metrics.stage = "download"
+    with Catalog(catalog_path) as catalog:
+        if plan_path is not None:
+            from quartus_plan import Plan, fetchable
+
+            plan = Plan.load(plan_path)
+            dls = fetchable(plan, plan.downloads(catalog, **filters))
+        else:
+            dls = catalog.query(resolved=True, **filters)
+    if use_async:
+        from quartus_async import run_scheduler
+
+        done = run_scheduler(scheduler, dls)
+    else:
+        done = scheduler.run(dls)
+    print(f"downloaded {len(done)} of {len(dls)} files")
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Download resolved Quartus installers")
+    parser.add_argument("root", help="archive root directory")
+    parser.add_argument("-c", "--catalog", default=catalog_path, help="catalog database")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="files downloaded at once")
+    parser.add_argument(
+        "-s", "--segments", type=int, default=8, help="parallel range requests per file"
+    )
+    parser.add_argument(
+        "--no-dedup",
+        dest="dedup",
+        action="store_false",
+        help="store every listing separately instead of once per sha1 under root/blobs",
+    )
+    parser.add_argument(
+        "--priority",
+        default="",
+        help=f"comma separated download order, from {', '.join(priority_rules)}",
+    )
+    parser.add_argument("--max-mbps", type=float, help="bandwidth cap in megabits per second")
+    parser.add_argument("--window-gb", type=float, help="at most this many GB per window")
+    parser.add_argument("--window-hours", type=float, default=24)
+    parser.add_argument("--min-free-gb", type=float, default=1, help="disk space to leave free")
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="run every segment of every file on one asyncio event loop",
+    )
+    parser.add_argument("--plan", help="download only this plan's files, see quartus_plan")
+    parser.add_argument(
+        "--no-revalidate",
+        dest="revalidate",
+        action="store_false",
+        help="don't re-resolve cdn links that are expiring or refused",
+    )
+    add_query_args(parser)
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    metrics_args(args)
+    gb = 1024 * 1024 * 1024
+    scheduler = Scheduler(
+        args.root,
+        args.jobs,
+        args.segments,
+        priority=[rule for rule in args.priority.split(",") if rule],
+        bandwidth=args.max_mbps * 1e6 / 8 if args.max_mbps else None,
+        window_bytes=int(args.window_gb * gb) if args.window_gb else None,
+        window_seconds=args.window_hours * 60 * 60,
+        min_free=int(args.min_free_gb * gb),
+        store=BlobStore(args.root) if args.dedup else None,
+        resolver=Revalidator(args.catalog).load() if args.revalidate else None,
+    )
+    main(args.catalog, scheduler, query_args(args), args.use_async, args.plan)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,474 @@
+import argparse
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+from attrs import define, field
+from rich import print
+
+from quartus_catalog import Catalog, add_query_args, catalog_path, query_args
+from quartus_cdn import Revalidator
+from quartus_download import Scheduler, priority_rules
+from quartus_metrics import add_metrics_args, metrics, metrics_args
+from quartus_model import Download, download_from_json, download_to_json
+from quartus_store import BlobStore
+
+ledger_path = "quartus-ledger.sqlite"
+schema_version = 1
+
+# items are catalog downloads, grouped into shards by a stable key so every listing of a
+# sha1 lands on the same node. Nodes lease a shard at a time, and every item they start
+# carries its own lease, so work held by a node that stops heartbeating goes back to pending.
+schema_v1 = """
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE shards (
+    shard INTEGER PRIMARY KEY,
+    owner TEXT,
+    leased_at REAL,
+    lease_until REAL
+);
+CREATE TABLE items (
+    dist_url TEXT PRIMARY KEY,
+    sha1 TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    download TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX items_shard_state ON items (shard, state);
+CREATE INDEX items_owner ON items (owner);
+CREATE TABLE nodes (
+    node TEXT PRIMARY KEY,
+    started REAL NOT NULL,
+    heartbeat REAL NOT NULL,
+    bytes_done INTEGER NOT NULL DEFAULT 0,
+    files_done INTEGER NOT NULL DEFAULT 0,
+    files_failed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+migrations = {1: schema_v1}
+
+shard_keys = ("sha1", "ident")
+
+
+def shard_of(dl: Download, key: str, shards: int) -> int:
+    # stable across runs and machines, unlike hash()
+    val = dl.sha1 if key == "sha1" else str(dl.ident)
+    return zlib.crc32(val.encode()) % shards
+
+
+class Ledger:
+    # work ledger shared by every node. SQLite on shared storage works as long as the
+    # filesystem's locks do, so it stays in rollback journal mode, WAL needs shared memory
+    # between the writers. Lease times are wall clock, the nodes should run NTP.
+    def __init__(self, path: str = ledger_path, busy_timeout: float = 60):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.isolation_level = None
+        self.lock = threading.Lock()
+        self.migrate()
+
+    def migrate(self) -> None:
+        ver = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if ver > schema_version:
+            raise ValueError(f"{self.path} is ledger version {ver}, newer than {schema_version}")
+        for ver in range(ver + 1, schema_version + 1):
+            with self.transaction():
+                for stmt in migrations[ver].split(";"):
+                    if stmt.strip():
+                        self.db.execute(stmt)
+                self.db.execute(f"PRAGMA user_version = {ver}")
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self) -> "Ledger":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        # IMMEDIATE takes the write lock up front, so two nodes claiming at once queue up
+        # instead of both reading the same free shard
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def query(self, sql: str, args: tuple = ()) -> list[sqlite3.Row]:
+        # the heartbeat thread shares the connection
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def meta(self, key: str) -> Optional[str]:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def add(self, dls: Iterable[Download], shards: int, key: str) -> int:
+        # idempotent, a re-run adds new downloads and refreshes unstarted ones
+        if key not in shard_keys:
+            raise ValueError(f"can't shard on '{key}', have {', '.join(shard_keys)}")
+        with self.transaction() as db:
+            have = self.meta("shards")
+            if have is not None and (int(have), self.meta("key")) != (shards, key):
+                raise ValueError(f"{self.path} is sharded {have} ways on {self.meta('key')}")
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('shards', ?)", (str(shards),))
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('key', ?)", (key,))
+            db.executemany(
+                "INSERT OR IGNORE INTO shards (shard) VALUES (?)", ((s,) for s in range(shards))
+            )
+            before = db.total_changes
+            db.executemany(
+                "INSERT INTO items (dist_url, sha1, shard, size, download) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (dist_url) DO UPDATE SET download = excluded.download "
+                "WHERE items.state = 'pending'",
+                (
+                    (
+                        dl.dist_url,
+                        dl.sha1,
+                        shard_of(dl, key, shards),
+                        dl.listed_size,
+                        download_to_json(dl),
+                    )
+                    for dl in dls
+                ),
+            )
+            return db.total_changes - before
+
+    def expire(self, now: float) -> None:
+        self.db.execute(
+            "UPDATE items SET state = 'pending', owner = NULL, lease_until = NULL "
+            "WHERE state = 'running' AND lease_until < ?",
+            (now,),
+        )
+        self.db.execute(
+            "UPDATE shards SET owner = NULL, leased_at = NULL, lease_until = NULL "
+            "WHERE owner IS NOT NULL AND lease_until < ?",
+            (now,),
+        )
+
+    def claim(self, node: str, lease: float, steal_after: float) -> Optional[int]:
+        # a free shard with pending work, else half of the slowest node's backlog
+        now = time.time()
+        with self.transaction() as db:
+            self.expire(now)
+            db.execute(
+                "INSERT INTO nodes (node, started, heartbeat) VALUES (?, ?, ?) "
+                "ON CONFLICT (node) DO UPDATE SET heartbeat = excluded.heartbeat",
+                (node, now, now),
+            )
+            row = db.execute(
+                "SELECT shard FROM shards s WHERE owner IS NULL AND EXISTS "
+                "(SELECT 1 FROM items i WHERE i.shard = s.shard AND i.state = 'pending') "
+                "ORDER BY shard LIMIT 1"
+            ).fetchone()
+            shard = row[0] if row is not None else self.split(node, now, steal_after)
+            if shard is None:
+                return None
+            db.execute(
+                "UPDATE shards SET owner = ?, leased_at = ?, lease_until = ? WHERE shard = ?",
+                (node, now, now + lease, shard),
+            )
+            return shard
+
+    def split(self, node: str, now: float, steal_after: float) -> Optional[int]:
+        # work stealing for the tail of a run and for slow nodes: the leased shard whose
+        # owner needs longest to get through its unstarted items, at the owner's average
+        # rate so far, loses half of them to a new shard. Halving each time means a
+        # healthy node and a thief don't hand the same items back and forth.
+        rows = self.db.execute(
+            "SELECT s.shard, s.owner, s.leased_at, n.started, n.bytes_done, "
+            "count(DISTINCT i.sha1) AS pending_files, sum(i.size) AS pending_bytes "
+            "FROM shards s JOIN items i ON i.shard = s.shard AND i.state = 'pending' "
+            "JOIN nodes n ON n.node = s.owner "
+            "WHERE s.owner != ? GROUP BY s.shard",
+            (node,),
+        ).fetchall()
+        best, best_eta = None, steal_after
+        for r in rows:
+            # sha1 groups move whole, a shard with one left has nothing to halve
+            if r["pending_files"] < 2 or now - r["leased_at"] < steal_after:
+                continue
+            rate = r["bytes_done"] / max(1.0, now - r["started"])
+            eta = r["pending_bytes"] / rate if rate else float("inf")
+            if eta > best_eta:
+                best, best_eta = r, eta
+        if best is None:
+            return None
+        new = self.db.execute("SELECT max(shard) + 1 FROM shards").fetchone()[0]
+        self.db.execute("INSERT INTO shards (shard) VALUES (?)", (new,))
+        # whole sha1 groups move together, the back half in sha1 order
+        sha1s = [
+            r[0]
+            for r in self.db.execute(
+                "SELECT DISTINCT sha1 FROM items WHERE shard = ? AND state = 'pending' "
+                "ORDER BY sha1",
+                (best["shard"],),
+            )
+        ]
+        moved = sha1s[len(sha1s) // 2 :]
+        self.db.executemany(
+            "UPDATE items SET shard = ? WHERE shard = ? AND sha1 = ? AND state = 'pending'",
+            ((new, best["shard"], sha1) for sha1 in moved),
+        )
+        print(f"took {len(moved)} files of shard {best['shard']} from {best['owner']}")
+        return new
+
+    def items(self, shard: int) -> list[Download]:
+        rows = self.query(
+            "SELECT download FROM items WHERE shard = ? AND state = 'pending'", (shard,)
+        )
+        return [download_from_json(row[0]) for row in rows]
+
+    def start(self, node: str, dls: list[Download], lease: float) -> bool:
+        # False if the items were moved to another shard or taken while queued here
+        now = time.time()
+        with self.transaction() as db:
+            cur = db.executemany(
+                "UPDATE items SET state = 'running', owner = ?, lease_until = ?, updated = ? "
+                "WHERE dist_url = ? AND state = 'pending' AND shard IN "
+                "(SELECT shard FROM shards WHERE owner = ?)",
+                ((node, now + lease, now, dl.dist_url, node) for dl in dls),
+            )
+            if cur.rowcount == len(dls):
+                return True
+            # put back whichever of the group this did claim
+            db.executemany(
+                "UPDATE items SET state = 'pending', owner = NULL, lease_until = NULL "
+                "WHERE dist_url = ? AND owner = ? AND state = 'running'",
+                ((dl.dist_url, node) for dl in dls),
+            )
+            return False
+
+    def finish(
+        self, node: str, dls: list[Download], error: Optional[str], max_attempts: int
+    ) -> None:
+        # the download is written back too, it carries any cdn link the node refreshed
+        now = time.time()
+        with self.transaction() as db:
+            if error is None:
+                db.executemany(
+                    "UPDATE items SET state = 'done', owner = ?, lease_until = NULL, "
+                    "error = NULL, updated = ?, download = ? WHERE dist_url = ?",
+                    ((node, now, download_to_json(dl), dl.dist_url) for dl in dls),
+                )
+                db.execute(
+                    "UPDATE nodes SET bytes_done = bytes_done + ?, files_done = files_done + 1 "
+                    "WHERE node = ?",
+                    (dls[0].listed_size, node),
+                )
+                return
+            # back to pending for another node to try until max_attempts
+            db.executemany(
+                "UPDATE items SET attempts = attempts + 1, error = ?, updated = ?, "
+                "owner = NULL, lease_until = NULL, download = ?, "
+                "state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                "WHERE dist_url = ?",
+                ((error, now, download_to_json(dl), max_attempts, dl.dist_url) for dl in dls),
+            )
+            db.execute("UPDATE nodes SET files_failed = files_failed + 1 WHERE node = ?", (node,))
+
+    def heartbeat(self, node: str, shard: Optional[int], lease: float) -> bool:
+        # renews the shard and every item the node is running, False once the shard is lost
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("UPDATE nodes SET heartbeat = ? WHERE node = ?", (now, node))
+            db.execute(
+                "UPDATE items SET lease_until = ? WHERE owner = ? AND state = 'running'",
+                (now + lease, node),
+            )
+            if shard is None:
+                return True
+            cur = db.execute(
+                "UPDATE shards SET lease_until = ? WHERE shard = ? AND owner = ?",
+                (now + lease, shard, node),
+            )
+            return cur.rowcount == 1
+
+    def release(self, node: str, shard: int) -> None:
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE shards SET owner = NULL, leased_at = NULL, lease_until = NULL "
+                "WHERE shard = ? AND owner = ?",
+                (shard, node),
+            )
+
+    def remaining(self) -> int:
+        return self.query("SELECT count(*) FROM items WHERE state IN ('pending', 'running')")[0][0]
+
+    def reset_failed(self) -> int:
+        with self.transaction() as db:
+            return db.execute(
+                "UPDATE items SET state = 'pending', attempts = 0 WHERE state = 'failed'"
+            ).rowcount
+
+    def status(self) -> dict:
+        now = time.time()
+        items = {
+            row["state"]: {"files": row["files"], "bytes": row["bytes"]}
+            for row in self.query(
+                "SELECT state, count(*) AS files, sum(size) AS bytes FROM items GROUP BY state"
+            )
+        }
+        nodes = {}
+        for row in self.query("SELECT * FROM nodes ORDER BY node"):
+            elapsed = max(1.0, row["heartbeat"] - row["started"])
+            nodes[row["node"]] = {
+                "alive": now - row["heartbeat"] < 600,
+                "files_done": row["files_done"],
+                "files_failed": row["files_failed"],
+                "bytes_done": row["bytes_done"],
+                "bytes_per_second": round(row["bytes_done"] / elapsed),
+            }
+        leased = self.query("SELECT count(*) FROM shards WHERE owner IS NOT NULL")[0][0]
+        return {"items": items, "leased_shards": leased, "nodes": nodes}
+
+
+@define
+class LedgerScheduler(Scheduler):
+    # the usual scheduler over one shard, starting an item only once the ledger agrees
+    # it is still ours and recording every result
+    ledger: Optional[Ledger] = None
+    node: str = ""
+    lease: float = 300
+    max_attempts: int = 3
+    shard: Optional[int] = None
+    stop: threading.Event = field(factory=threading.Event)
+
+    def admit(self, queue: list[list[Download]], running: dict):
+        while (admitted := super().admit(queue, running)) is not None:
+            same, charge = admitted
+            if self.ledger.start(self.node, same, self.lease):
+                return admitted
+            self.unreserve(same[0])
+            self.window_used -= charge
+        return None
+
+    def finished(self, same: list[Download], charge: int, exc: Optional[BaseException]) -> bool:
+        ok = super().finished(same, charge, exc)
+        error = None if ok else repr(exc) if exc is not None else "failed"
+        self.ledger.finish(self.node, same, error, self.max_attempts)
+        return ok
+
+    def heartbeats(self) -> None:
+        while not self.stop.wait(self.lease / 3):
+            if not self.ledger.heartbeat(self.node, self.shard, self.lease):
+                print(f"[yellow]lost the lease on shard {self.shard}[/yellow]")
+
+
+def work(ledger: Ledger, scheduler: LedgerScheduler, steal_after: float, poll: float) -> int:
+    # claims shards until nothing is left anywhere, returns the files this node finished
+    done = 0
+    beat = threading.Thread(target=scheduler.heartbeats, daemon=True)
+    beat.start()
+    try:
+        while True:
+            shard = ledger.claim(scheduler.node, scheduler.lease, steal_after)
+            if shard is None:
+                if ledger.remaining() == 0:
+                    return done
+                # other nodes are busy, their leases may lapse or their backlog grow
+                time.sleep(poll)
+                continue
+            scheduler.shard = shard
+            dls = ledger.items(shard)
+            print(f"{scheduler.node}: shard {shard}, {len(dls)} files")
+            try:
+                done += len(scheduler.run(dls))
+            finally:
+                scheduler.shard = None
+                ledger.release(scheduler.node, shard)
+    finally:
+        scheduler.stop.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split archiving across machines")
+    parser.add_argument("ledger", help="ledger database, on storage every node can reach")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    init = sub.add_parser("init", help="add the resolved downloads matching the query")
+    init.add_argument("-c", "--catalog", default=catalog_path, help="catalog database")
+    init.add_argument("--shards", type=int, default=256)
+    init.add_argument("--key", choices=shard_keys, default="sha1")
+    add_query_args(init)
+    wk = sub.add_parser("work", help="download shards until the ledger is empty")
+    wk.add_argument("root", help="archive root directory")
+    wk.add_argument("-c", "--catalog", default=catalog_path, help="catalog database")
+    wk.add_argument("--node", default=f"{socket.gethostname()}-{os.getpid()}")
+    wk.add_argument("-j", "--jobs", type=int, default=2, help="files downloaded at once")
+    wk.add_argument("-s", "--segments", type=int, default=8)
+    wk.add_argument("--priority", default="", help=f"from {', '.join(priority_rules)}")
+    wk.add_argument("--max-mbps", type=float, help="bandwidth cap in megabits per second")
+    wk.add_argument("--min-free-gb", type=float, default=1)
+    wk.add_argument("--lease", type=float, default=300, help="seconds without a heartbeat")
+    wk.add_argument(
+        "--steal-after",
+        type=float,
+        default=900,
+        help="split a node's shard once its backlog would take longer than this",
+    )
+    wk.add_argument("--poll", type=float, default=30)
+    wk.add_argument(
+        "--no-revalidate",
+        dest="revalidate",
+        action="store_false",
+        help="don't re-resolve cdn links that are expiring or refused",
+    )
+    add_metrics_args(wk)
+    sub.add_parser("status", help="progress by state and node")
+    sub.add_parser("reset-failed", help="give failed items another round")
+    args = parser.parse_args()
+
+    with Ledger(args.ledger) as ledger:
+        if args.cmd == "init":
+            with Catalog(args.catalog) as catalog:
+                dls = catalog.query(resolved=True, **query_args(args))
+            n = ledger.add(dls, args.shards, args.key)
+            print(f"{n} of {len(dls)} downloads added or refreshed")
+        elif args.cmd == "work":
+            metrics_args(args)
+            metrics.stage = "download"
+            scheduler = LedgerScheduler(
+                args.root,
+                args.jobs,
+                args.segments,
+                priority=[rule for rule in args.priority.split(",") if rule],
+                bandwidth=args.max_mbps * 1e6 / 8 if args.max_mbps else None,
+                min_free=int(args.min_free_gb * 1024**3),
+                store=BlobStore(args.root),
+                ledger=ledger,
+                node=args.node,
+                lease=args.lease,
+                resolver=Revalidator(args.catalog).load() if args.revalidate else None,
+            )
+            done = work(ledger, scheduler, args.steal_after, args.poll)
+            print(f"{args.node}: downloaded {done} files")
+        elif args.cmd == "status":
+            print(ledger.status())
+        elif args.cmd == "reset-failed":
+            print(f"{ledger.reset_failed()} items back to pending")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import atexit
+import bisect
+import http.client
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from attrs import define, field
+
+# upper bounds for request and per file timings, seconds
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# per file transfer and hashing rates, bytes per second
+rate_buckets = tuple(10**e * m for e in range(5, 10) for m in (1, 2.5, 5))
+
+
+@define
+class Histogram:
+    bounds: tuple[float, ...]
+    counts: list[int] = field()
+    total: float = 0
+    count: int = 0
+
+    @counts.default
+    def _counts(self) -> list[int]:
+        return [0] * (len(self.bounds) + 1)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+@define
+class Metrics:
+    # counters and histograms keyed by name and sorted label pairs. Disabled, every
+    # recording call returns on its first line, and the per chunk hot paths check
+    # enabled before calling in at all.
+    enabled: bool = False
+    stage: str = ""
+    started: float = field(factory=time.time)
+    counters: dict[tuple, float] = field(factory=dict)
+    histograms: dict[tuple, Histogram] = field(factory=dict)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.started = time.time()
+
+    @contextmanager
+    def staged(self, stage: str) -> Iterator[None]:
+        # stages run one after another, worker threads and tasks pick the label up from here
+        prev, self.stage = self.stage, stage
+        try:
+            yield
+        finally:
+            self.stage = prev
+
+    def key(self, name: str, labels: dict) -> tuple:
+        if "stage" not in labels:
+            labels["stage"] = self.stage
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name: str, n: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(
+        self, name: str, value: float, bounds: tuple[float, ...] = latency_buckets, **labels
+    ) -> None:
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(bounds)
+            self.histograms[key].observe(value)
+
+    def request(self, host: str, status: object, seconds: float) -> None:
+        if not self.enabled:
+            return
+        self.inc("quartus_requests_total", host=host, status=status)
+        self.observe("quartus_request_seconds", seconds, host=host)
+
+    def prometheus(self) -> str:
+        def fmt(labels: tuple, extra: tuple = ()) -> str:
+            pairs = [f'{k}="{v}"' for k, v in labels + extra]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = [f"quartus_uptime_seconds {time.time() - self.started:.3f}"]
+        with self.lock:
+            typed = set()
+            for (name, labels), val in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{fmt(labels)} {val}")
+            for (name, labels), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, n in zip(h.bounds + (float("inf"),), h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{name}_bucket{fmt(labels, (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{fmt(labels)} {h.total}")
+                lines.append(f"{name}_count{fmt(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def jsonl(self) -> str:
+        # one snapshot line per series, rates come from dividing by seconds
+        now = time.time()
+        base = {"time": now, "seconds": now - self.started}
+        lines = []
+        with self.lock:
+            for (name, labels), val in sorted(self.counters.items()):
+                lines.append({**base, "name": name, "labels": dict(labels), "value": val})
+            for (name, labels), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+                lines.append(
+                    {
+                        **base,
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": h.count,
+                        "sum": h.total,
+                        "buckets": dict(zip(map(str, h.bounds + (float("inf"),)), h.counts)),
+                    }
+                )
+        return "".join(json.dumps(line) + "\n" for line in lines)
+
+    def write(self, path: str) -> None:
+        # node_exporter textfile collector wants .prom, anything else gets json lines
+        text = self.prometheus() if path.endswith(".prom") else self.jsonl()
+        if path == "-":
+            sys.stderr.write(text)
+            return
+        with open(path + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+
+metrics = Metrics()
+
+
+def wire_debug() -> None:
+    # every request and response header on stdout, only for chasing protocol problems
+    logger = logging.getLogger("mechanize")
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.DEBUG)
+    http.client.HTTPConnection.debuglevel = 5
+
+
+def add_metrics_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH",
+        help="record metrics and write them here on exit, prometheus text for .prom else jsonl",
+    )
+    parser.add_argument("--verbose", action="store_true", help="log every url fetched")
+    parser.add_argument("--wire-debug", action="store_true", help="dump http traffic to stdout")
+
+
+def metrics_args(args: argparse.Namespace) -> None:
+    if args.verbose:
+        logging.basicConfig(format="%(asctime)s %(name)s %(message)s")
+        logging.getLogger("quartus").setLevel(logging.DEBUG)
+    if args.wire_debug:
+        wire_debug()
+    if args.metrics is not None:
+        metrics.enable()
+        atexit.register(metrics.write, args.metrics)
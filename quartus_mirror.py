@@ -0,0 +1,299 @@
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+from urllib.parse import unquote
+
+from attrs import define, field
+from rich import print
+
+from quartus_catalog import Catalog, catalog_path
+from quartus_metrics import add_metrics_args, metrics, metrics_args
+from quartus_model import Download, archive_path, download_to_json, is_complete
+from quartus_store import BlobStore
+from quartus_table import DownloadTable, DownloadView
+
+log = logging.getLogger("quartus")
+
+chunk_size = 1024 * 1024
+# downloads finishing don't touch the catalog, so catalog.jsonl is rebuilt this often anyway
+refresh_interval = 60
+
+
+@define
+class Source:
+    # where a download's bytes come from: a plain file sent with sendfile, or a pack or
+    # recipe decompressed on the way out
+    kind: str
+    size: int
+    path: str
+    recipe: object = None
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    # a single byte range as [start, end), None to send the whole file. Multiple ranges
+    # and malformed headers get the whole file too, unsatisfiable ones raise ValueError.
+    if header is None or not header.startswith("bytes=") or "," in header:
+        return None
+    first, sep, last = header.removeprefix("bytes=").strip().partition("-")
+    if not sep or not (first or last) or not (first + last).isdigit():
+        return None
+    if not first:
+        start, end = max(0, size - int(last)), size
+    else:
+        start, end = int(first), min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        if last and first and int(last) < int(first):
+            return None
+        raise ValueError(f"range {header} outside {size} bytes")
+    return start, end
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    if header is None:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+@define
+class Mirror:
+    # serves the archive tree by edition/os/version/filename and content addressed under
+    # /sha1/<sha1>, plus the available part of the catalog as /catalog.jsonl. The catalog
+    # is reloaded when the database changes, so a running mirror picks up new downloads.
+    root: str
+    catalog_path: str = catalog_path
+    store: BlobStore = field()
+    # the catalog held column wise, with row numbers by tree path and sha1
+    table: DownloadTable = field(factory=DownloadTable)
+    by_path: dict[str, int] = field(factory=dict)
+    by_sha1: dict[str, int] = field(factory=dict)
+    catalog_jsonl: bytes = b""
+    catalog_etag: str = ""
+    catalog_mtime: float = -1
+    refreshed: float = 0
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    @store.default
+    def _store(self) -> BlobStore:
+        return BlobStore(self.root)
+
+    def refresh(self) -> None:
+        # WAL mode commits land in the -wal file until a checkpoint
+        mtime = max(
+            (
+                os.stat(p).st_mtime
+                for p in (self.catalog_path, self.catalog_path + "-wal")
+                if os.path.exists(p)
+            ),
+            default=0,
+        )
+        with self.lock:
+            if mtime == self.catalog_mtime and time.monotonic() - self.refreshed < refresh_interval:
+                return
+            with Catalog(self.catalog_path) as catalog:
+                table = catalog.table()
+            dls = [table.download(i) for i in range(len(table))]
+            self.by_path = {
+                os.path.relpath(archive_path(self.root, dl), self.root): i
+                for i, dl in enumerate(dls)
+            }
+            self.by_sha1 = {dl.sha1: i for i, dl in enumerate(dls)}
+            lines = [download_to_json(dl) + "\n" for dl in dls if self.available(dl)]
+            self.table = table
+            self.catalog_jsonl = "".join(lines).encode()
+            self.catalog_etag = f'"{hashlib.sha1(self.catalog_jsonl).hexdigest()}"'
+            self.catalog_mtime = mtime
+            self.refreshed = time.monotonic()
+            log.debug("mirror catalog: %d downloads, %d available", len(dls), len(lines))
+
+    def lookup(self, path: str) -> Optional[DownloadView]:
+        self.refresh()
+        path = unquote(path).lstrip("/")
+        # the row numbers and the table they index are swapped together under the lock
+        with self.lock:
+            if path.startswith("sha1/"):
+                i = self.by_sha1.get(path.split("/")[1])
+            else:
+                i = self.by_path.get(os.path.normpath(path))
+            return self.table.view(i) if i is not None else None
+
+    def available(self, dl: Download) -> bool:
+        return self.store.has(dl.sha1) or is_complete(dl, archive_path(self.root, dl))
+
+    def source(self, dl: Download) -> Optional[Source]:
+        # the verified blob, then the tree for archives without a store, then recompressed
+        blob = self.store.blob_path(dl.sha1)
+        if os.path.exists(blob):
+            return Source("blob", os.path.getsize(blob), blob)
+        path = archive_path(self.root, dl)
+        if is_complete(dl, path):
+            return Source("file", os.path.getsize(path), path)
+        if self.store.is_packed(dl.sha1):
+            from quartus_pack import PackIndex, index_path
+
+            pack = self.store.packed_path(dl.sha1)
+            return Source("packed", PackIndex.load(index_path(pack)).size, pack)
+        if self.store.is_chunked(dl.sha1):
+            from quartus_chunk import Recipe
+
+            path = self.store.recipe_path(dl.sha1)
+            recipe = Recipe.load(path)
+            return Source("chunked", recipe.size, path, recipe)
+        return None
+
+    def iter_range(self, src: Source, start: int, end: int) -> Iterator[bytes]:
+        if src.kind == "packed":
+            from quartus_pack import SeekableReader
+
+            with SeekableReader.open(src.path) as reader:
+                yield from reader.iter_range(start, end - start)
+        elif src.kind == "chunked":
+            from quartus_chunk import iter_range
+
+            yield from iter_range(self.store, src.recipe, start, end - start)
+        else:
+            with open(src.path, "rb") as f:
+                f.seek(start)
+                while start < end and (data := f.read(min(chunk_size, end - start))):
+                    start += len(data)
+                    yield data
+
+
+class MirrorServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address) -> None:
+        # clients hanging up mid body is routine, anything else gets a traceback
+        exc = sys.exc_info()[1]
+        if not isinstance(exc, (BrokenPipeError, ConnectionResetError, TimeoutError)):
+            super().handle_error(request, client_address)
+
+
+def make_mirror_handler(mirror: Mirror):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        server_version = "quartus-mirror"
+        # idle keep-alive connections are dropped after this
+        timeout = 60
+
+        def log_message(self, fmt: str, *args) -> None:
+            log.debug("%s %s", self.client_address[0], fmt % args)
+
+        def reply(self, status: int, headers: dict[str, str], body: bytes = b"") -> None:
+            self.send_response(status)
+            headers = {"Content-Length": str(len(body)), **headers}
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+            metrics.inc("quartus_mirror_requests_total", status=status)
+
+        def do_HEAD(self) -> None:
+            self.do_GET()
+
+        def do_GET(self) -> None:
+            path = self.path.partition("?")[0]
+            if path == "/catalog.jsonl":
+                mirror.refresh()
+                self.static(mirror.catalog_jsonl, mirror.catalog_etag, "application/jsonl")
+                return
+            dl = mirror.lookup(path)
+            src = mirror.source(dl) if dl is not None else None
+            if src is None:
+                self.reply(404, {})
+                return
+            self.download(dl, src)
+
+        def static(self, body: bytes, etag: str, content_type: str) -> None:
+            if etag_matches(self.headers.get("If-None-Match"), etag):
+                self.reply(304, {"ETag": etag})
+            else:
+                self.reply(200, {"ETag": etag, "Content-Type": content_type}, body)
+
+        def download(self, dl: DownloadView, src: Source) -> None:
+            etag = f'"{dl.sha1}"'
+            headers = {
+                "ETag": etag,
+                "Accept-Ranges": "bytes",
+                "Content-Type": "application/octet-stream",
+                "Content-Disposition": f'attachment; filename="{dl.filename}"',
+                "X-Checksum-Sha1": dl.sha1,
+            }
+            if etag_matches(self.headers.get("If-None-Match"), etag):
+                self.reply(304, headers)
+                return
+            rng = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            if if_range is not None and if_range.strip() != etag:
+                # the client's partial copy is of something else, start it over
+                rng = None
+            try:
+                span = parse_range(rng, src.size)
+            except ValueError:
+                self.reply(416, {**headers, "Content-Range": f"bytes */{src.size}"})
+                return
+            start, end = span if span is not None else (0, src.size)
+            self.send_response(206 if span is not None else 200)
+            if span is not None:
+                headers["Content-Range"] = f"bytes {start}-{end - 1}/{src.size}"
+            headers["Content-Length"] = str(end - start)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            metrics.inc("quartus_mirror_requests_total", status=206 if span else 200)
+            if self.command == "HEAD":
+                return
+            began = time.perf_counter()
+            if src.kind in ("blob", "file"):
+                # zero copy from the page cache straight to the socket
+                with open(src.path, "rb") as f:
+                    sent = self.connection.sendfile(f, start, end - start)
+            else:
+                sent = 0
+                for data in mirror.iter_range(src, start, end):
+                    self.wfile.write(data)
+                    sent += len(data)
+            metrics.inc("quartus_mirror_bytes_total", sent, source=src.kind)
+            metrics.observe("quartus_mirror_seconds", time.perf_counter() - began)
+            if sent != end - start:
+                # the file changed under us, the client can't trust the rest of this stream
+                self.close_connection = True
+
+    return Handler
+
+
+def serve(mirror: Mirror, host: str, port: int) -> None:
+    mirror.refresh()
+    server = MirrorServer((host, port), make_mirror_handler(mirror))
+    print(f"serving {len(mirror.by_sha1)} downloads from {mirror.root} on http://{host}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP mirror of the archive for local installs")
+    parser.add_argument("root", help="archive root directory")
+    parser.add_argument("-c", "--catalog", default=catalog_path, help="catalog database")
+    parser.add_argument("-b", "--bind", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    metrics_args(args)
+    metrics.stage = "mirror"
+    serve(Mirror(args.root, args.catalog), args.bind, args.port)
+
+
+if __name__ == "__main__":
+    main()
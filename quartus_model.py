@@ -0,0 +1,122 @@
+import datetime
+import json
+import os
+from typing import Optional
+
+import attrs
+import packaging.version
+from attrs import define
+
+# the catalog's data types and archive layout. Kept free of the network and html stacks so
+# catalog queries and verification start quickly, quartus_archive_test re-exports them.
+
+
+class Version(packaging.version.Version):
+    def __repr__(self) -> str:
+        return f"Version('{self}')"
+
+
+@define
+class DistInfo:
+    edition: str
+    operating_system: str
+    dl_page_urls: tuple[Version, str]
+
+
+@define
+class Download:
+    filename: str
+    dist_url: str
+    cdn_url: Optional[str]
+    sha1: str
+    version: Version
+    ident: int
+    updated_date: datetime.date
+    listed_size: int
+    operating_system: str
+    edition: str
+    package: str
+    tab: str
+
+
+def download_to_json(dl: Download) -> str:
+    d = attrs.asdict(dl)
+    d["version"] = str(dl.version)
+    d["updated_date"] = dl.updated_date.isoformat()
+    return json.dumps(d)
+
+
+def download_from_json(s: str) -> Download:
+    d = json.loads(s)
+    d["version"] = Version(d["version"])
+    d["updated_date"] = datetime.date.fromisoformat(d["updated_date"])
+    return Download(**d)
+
+
+@define
+class PageState:
+    url: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    fingerprint: Optional[str] = None
+
+
+@define
+class CrawledPage:
+    state: PageState
+    # None when the page hasn't changed since it was last crawled
+    downloads: Optional[list[Download]]
+
+
+def byte_size(size_str: str) -> int:
+    sz, unit = size_str.split()
+    sz = float(sz)
+    unit = unit.lower()
+    if unit == "kb":
+        sz *= 1024
+    elif unit == "mb":
+        sz *= 1024 * 1024
+    elif unit == "gb":
+        sz *= 1024 * 1024 * 1024
+    elif unit == "tb":
+        sz *= 1024 * 1024 * 1024 * 1024
+    return int(sz)
+
+
+def size_str(size: int) -> str:
+    # the listings' own format, byte_size reads it back
+    for unit, scale in (("TB", 1024**4), ("GB", 1024**3), ("MB", 1024**2), ("KB", 1024)):
+        if size >= scale:
+            return f"{size / scale:,.1f} {unit}"
+    return f"{size} B"
+
+
+def archive_path(root: str, dl: Download) -> str:
+    return os.path.join(root, dl.edition, dl.operating_system, str(dl.version), dl.filename)
+
+
+def listed_size_bounds(listed_size: int) -> tuple[int, int]:
+    # listed sizes are scraped from strings like "78.7 GB", so they're only accurate to
+    # half a tenth of the displayed unit
+    unit = 1
+    while unit * 1024 <= listed_size and unit < 1024**3:
+        unit *= 1024
+    slop = unit // 20 + 1
+    return listed_size - slop, listed_size + slop
+
+
+class ChecksumMismatch(ValueError):
+    pass
+
+
+def is_complete(dl: Download, path: str) -> bool:
+    # judged from the journal and listed_size alone so a full archive can be rescanned
+    # without reading any file contents. The journal is quartus_download's Journal sidecar
+    if os.path.exists(path + ".journal"):
+        return False
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return False
+    lo, hi = listed_size_bounds(dl.listed_size)
+    return lo <= size <= hi
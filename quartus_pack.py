@@ -0,0 +1,359 @@
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import struct
+import sys
+import tarfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterator, Optional
+
+import zstandard
+from attrs import asdict, define, field
+from rich import print
+
+from quartus_catalog import Catalog, add_query_args, catalog_path, query_args
+from quartus_metrics import metrics
+from quartus_model import ChecksumMismatch, archive_path
+from quartus_store import BlobStore
+
+# zstd seekable format, see contrib/seekable_format in the zstd repo: independent frames
+# followed by a skippable frame holding each frame's compressed and decompressed size, so
+# plain zstd -d still reads the file and a reader can seek by frame
+skippable_magic = 0x184D2A5E
+seekable_magic = 0x8F92EAB1
+footer = struct.Struct("<IBI")
+entry = struct.Struct("<II")
+
+frame_size = 4 * 1024 * 1024
+level = 9
+index_version = 1
+
+
+@define
+class Member:
+    name: str
+    offset: int
+    size: int
+    sha1: Optional[str] = None
+
+
+@define
+class PackIndex:
+    # everything needed to reproduce and check the original tar, stored next to the pack
+    sha1: str
+    size: int
+    frame_size: int
+    members: list[Member]
+    compressed_size: int = 0
+    version: int = index_version
+
+    def member(self, name: str) -> Member:
+        for m in self.members:
+            if m.name == name or m.name.removeprefix("./") == name:
+                return m
+        raise KeyError(f"no member {name}")
+
+    def save(self, path: str) -> None:
+        with open(path + ".tmp", "w") as f:
+            json.dump(asdict(self), f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "PackIndex":
+        with open(path) as f:
+            d = json.load(f)
+        if d["version"] != index_version:
+            raise ValueError(f"{path} is pack index version {d['version']}")
+        d["members"] = [Member(**m) for m in d["members"]]
+        return cls(**d)
+
+
+def index_path(pack_path: str) -> str:
+    return pack_path.removesuffix(".zst") + ".index.json"
+
+
+def tar_members(path: str) -> list[Member]:
+    # only reads headers, tarfile seeks over the member data
+    with tarfile.open(path, "r:") as tar:
+        return [Member(ti.name, ti.offset_data, ti.size) for ti in tar if ti.isreg()]
+
+
+@define
+class MemberHasher:
+    # hashes every member from the same sequential pass that compresses the tar
+    members: list[Member]
+    sha1s: list = field(factory=list)
+    next: int = 0
+    active: deque = field(factory=deque)
+
+    def __attrs_post_init__(self) -> None:
+        self.members = sorted(self.members, key=lambda m: m.offset)
+        self.sha1s = [hashlib.sha1() for _ in self.members]
+
+    def feed(self, pos: int, data: memoryview) -> None:
+        end = pos + len(data)
+        while self.next < len(self.members) and self.members[self.next].offset < end:
+            self.active.append(self.next)
+            self.next += 1
+        for i in list(self.active):
+            m = self.members[i]
+            lo, hi = max(pos, m.offset), min(end, m.offset + m.size)
+            if lo < hi:
+                self.sha1s[i].update(data[lo - pos : hi - pos])
+            if m.offset + m.size <= end:
+                self.active.remove(i)
+
+    def finish(self) -> list[Member]:
+        for m, sha1 in zip(self.members, self.sha1s):
+            m.sha1 = sha1.hexdigest()
+        return self.members
+
+
+tls = threading.local()
+
+
+def compress_frame(data: bytes, level: int) -> bytes:
+    # compressors aren't thread safe, one per pool thread
+    if getattr(tls, "level", None) != level:
+        tls.cctx = zstandard.ZstdCompressor(level=level, write_checksum=True)
+        tls.level = level
+    return tls.cctx.compress(data)
+
+
+def seek_table(frames: list[tuple[int, int]]) -> bytes:
+    body = b"".join(entry.pack(c, d) for c, d in frames)
+    body += footer.pack(len(frames), 0, seekable_magic)
+    return struct.pack("<II", skippable_magic, len(body)) + body
+
+
+def pack(
+    src: str,
+    dst: str,
+    expected_sha1: Optional[str] = None,
+    frame_size: int = frame_size,
+    level: int = level,
+    jobs: Optional[int] = None,
+) -> PackIndex:
+    # one read of src: frames are compressed on a pool while the whole file and every tar
+    # member are hashed in order on this thread
+    jobs = jobs or os.cpu_count()
+    hasher = MemberHasher(tar_members(src))
+    sha1 = hashlib.sha1()
+    frames = []
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    with open(src, "rb") as f, open(dst + ".tmp", "wb") as out, ThreadPoolExecutor(jobs) as ex:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        pending = deque()
+        pos = 0
+
+        def drain(n: int) -> None:
+            while len(pending) > n:
+                size, future = pending.popleft()
+                frame = future.result()
+                out.write(frame)
+                frames.append((len(frame), size))
+
+        while data := f.read(frame_size):
+            view = memoryview(data)
+            sha1.update(view)
+            hasher.feed(pos, view)
+            pos += len(data)
+            pending.append((len(data), ex.submit(compress_frame, data, level)))
+            drain(2 * jobs)
+        drain(0)
+        out.write(seek_table(frames))
+        out.flush()
+        os.fsync(out.fileno())
+        compressed_size = out.tell()
+    index = PackIndex(sha1.hexdigest(), pos, frame_size, hasher.finish(), compressed_size)
+    if expected_sha1 is not None and index.sha1 != expected_sha1:
+        os.unlink(dst + ".tmp")
+        raise ChecksumMismatch(f"{src}: sha1 {index.sha1} != expected {expected_sha1}")
+    index.save(index_path(dst))
+    os.replace(dst + ".tmp", dst)
+    metrics.inc("quartus_pack_bytes_total", pos)
+    metrics.inc("quartus_pack_compressed_bytes_total", compressed_size)
+    return index
+
+
+@define
+class SeekableReader:
+    # random access into a seekable zstd file, only the frames overlapping a read are
+    # decompressed
+    f: BinaryIO
+    comp_offsets: list[int] = field(factory=list)
+    offsets: list[int] = field(factory=list)
+    dctx: zstandard.ZstdDecompressor = field(factory=zstandard.ZstdDecompressor)
+
+    @classmethod
+    def open(cls, path: str) -> "SeekableReader":
+        f = open(path, "rb")
+        f.seek(-footer.size, os.SEEK_END)
+        num_frames, descriptor, magic = footer.unpack(f.read(footer.size))
+        if magic != seekable_magic:
+            f.close()
+            raise ValueError(f"{path} isn't a seekable zstd file")
+        entry_size = entry.size + (4 if descriptor & 0x80 else 0)
+        table_size = num_frames * entry_size
+        f.seek(-(footer.size + table_size), os.SEEK_END)
+        table = f.read(table_size)
+        reader = cls(f)
+        comp, decomp = 0, 0
+        for i in range(num_frames):
+            c, d = entry.unpack_from(table, i * entry_size)
+            reader.comp_offsets.append(comp)
+            reader.offsets.append(decomp)
+            comp += c
+            decomp += d
+        reader.comp_offsets.append(comp)
+        reader.offsets.append(decomp)
+        return reader
+
+    def close(self) -> None:
+        self.f.close()
+
+    def __enter__(self) -> "SeekableReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @property
+    def size(self) -> int:
+        return self.offsets[-1]
+
+    def frame(self, i: int) -> bytes:
+        start, end = self.comp_offsets[i], self.comp_offsets[i + 1]
+        self.f.seek(start)
+        size = self.offsets[i + 1] - self.offsets[i]
+        return self.dctx.decompress(self.f.read(end - start), max_output_size=size)
+
+    def iter_range(self, offset: int, size: int) -> Iterator[bytes]:
+        end = min(offset + size, self.size)
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        while offset < end:
+            data = self.frame(i)
+            lo = offset - self.offsets[i]
+            hi = min(end - self.offsets[i], len(data))
+            yield data[lo:hi]
+            offset = self.offsets[i] + hi
+            i += 1
+
+    def read(self, offset: int, size: int) -> bytes:
+        return b"".join(self.iter_range(offset, size))
+
+
+def extract(pack_path: str, name: str, out: BinaryIO) -> Member:
+    # reads only the frames the member spans and checks its sha1 from the index
+    member = PackIndex.load(index_path(pack_path)).member(name)
+    sha1 = hashlib.sha1()
+    with SeekableReader.open(pack_path) as reader:
+        for data in reader.iter_range(member.offset, member.size):
+            sha1.update(data)
+            out.write(data)
+    if member.sha1 is not None and sha1.hexdigest() != member.sha1:
+        raise ChecksumMismatch(f"{pack_path}:{name}: sha1 {sha1.hexdigest()} != {member.sha1}")
+    return member
+
+
+def restore(pack_path: str, dst: str) -> str:
+    # the original tar byte for byte, checked against the sha1 recorded at pack time
+    index = PackIndex.load(index_path(pack_path))
+    sha1 = hashlib.sha1()
+    with SeekableReader.open(pack_path) as reader, open(dst + ".tmp", "wb") as out:
+        for data in reader.iter_range(0, reader.size):
+            sha1.update(data)
+            out.write(data)
+    if sha1.hexdigest() != index.sha1:
+        os.unlink(dst + ".tmp")
+        raise ChecksumMismatch(f"{pack_path}: sha1 {sha1.hexdigest()} != packed {index.sha1}")
+    os.replace(dst + ".tmp", dst)
+    return dst
+
+
+def check(pack_path: str) -> str:
+    index = PackIndex.load(index_path(pack_path))
+    sha1 = hashlib.sha1()
+    with SeekableReader.open(pack_path) as reader:
+        for i in range(len(reader.offsets) - 1):
+            sha1.update(reader.frame(i))
+    if sha1.hexdigest() != index.sha1:
+        raise ChecksumMismatch(f"{pack_path}: sha1 {sha1.hexdigest()} != packed {index.sha1}")
+    return index.sha1
+
+
+def pack_store(
+    store: BlobStore, root: str, dls: list, drop: bool, level: int, frame_size: int
+) -> None:
+    # packs every tar blob once, with drop the blob and its tree links are removed after the
+    # pack reads back to the same sha1, BlobStore.link brings them back on demand
+    by_sha1 = {}
+    for dl in dls:
+        if dl.filename.endswith(".tar"):
+            by_sha1.setdefault(dl.sha1, []).append(dl)
+    for sha1, same in by_sha1.items():
+        blob = store.blob_path(sha1)
+        dst = store.packed_path(sha1)
+        if not os.path.exists(dst):
+            if not os.path.exists(blob):
+                continue
+            index = pack(blob, dst, sha1, frame_size, level)
+            ratio = index.compressed_size / index.size if index.size else 0
+            print(f"packed {same[0].filename}: {len(index.members)} members, {ratio:.1%}")
+        if drop and os.path.exists(blob):
+            check(dst)
+            for dl in same:
+                path = archive_path(root, dl)
+                if os.path.exists(path) and os.path.samefile(path, blob):
+                    os.unlink(path)
+            os.unlink(blob)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seekable zstd packs of archived tars")
+    parser.add_argument("root", help="archive root directory")
+    parser.add_argument("-c", "--catalog", default=catalog_path, help="catalog database")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    pk = sub.add_parser("pack", help="pack the tar blobs matching the query")
+    pk.add_argument("--level", type=int, default=level)
+    pk.add_argument("--frame-mb", type=int, default=frame_size // (1024 * 1024))
+    pk.add_argument("--drop", action="store_true", help="remove the uncompressed blobs")
+    add_query_args(pk)
+    ls = sub.add_parser("list", help="list a packed tar's members")
+    ls.add_argument("sha1")
+    ex = sub.add_parser("extract", help="extract one member")
+    ex.add_argument("sha1")
+    ex.add_argument("member")
+    ex.add_argument("-O", "--out", help="output file, default stdout")
+    rs = sub.add_parser("restore", help="rebuild the original tar and relink it")
+    rs.add_argument("sha1")
+    args = parser.parse_args()
+
+    store = BlobStore(args.root)
+    if args.cmd == "pack":
+        with Catalog(args.catalog) as catalog:
+            dls = catalog.query(**query_args(args))
+        pack_store(store, args.root, dls, args.drop, args.level, args.frame_mb * 1024 * 1024)
+    elif args.cmd == "list":
+        for m in PackIndex.load(index_path(store.packed_path(args.sha1))).members:
+            sys.stdout.write(f"{m.offset:>14} {m.size:>14} {m.sha1} {m.name}\n")
+    elif args.cmd == "extract":
+        if args.out is None:
+            extract(store.packed_path(args.sha1), args.member, sys.stdout.buffer)
+        else:
+            with open(args.out, "wb") as f:
+                extract(store.packed_path(args.sha1), args.member, f)
+    elif args.cmd == "restore":
+        store.unpack(args.sha1)
+        with Catalog(args.catalog) as catalog:
+            for dl in catalog.query(sha1=args.sha1):
+                store.link(dl.sha1, archive_path(args.root, dl))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import argparse
+import fnmatch
+import json
+import os
+import shlex
+from typing import Iterable, Optional
+
+from attrs import asdict, define, field
+from rich import print
+
+from quartus_catalog import Catalog, catalog_path, version_key
+from quartus_model import Download, Version, archive_path, is_complete, size_str
+from quartus_store import BlobStore
+from quartus_table import DownloadTable, and_masks
+
+# A plan is the slice of the catalog a mirror actually wants, picked with an expression like
+#
+#   edition=pro os=linux version=21..22 package=*quartus*software,devices tab!=copyleft*
+#
+# Terms are separated by spaces and all must match. field=a,b matches rows where any of the
+# shell style patterns matches, case insensitively, and field!=a,b rows where none does.
+# A version may also be a range lo..hi with either end left open, a partial version as the
+# upper end covers the whole series so 21..22 includes 22.4. The matching listings are
+# saved by dist_url so resolve and download work through exactly that set.
+
+plan_fields = {"edition", "operating_system", "version", "package", "tab", "filename", "sha1"}
+field_aliases = {"os": "operating_system"}
+
+
+@define
+class Term:
+    field: str
+    patterns: list[str]
+    negate: bool = False
+
+
+def parse_expression(expr: str) -> list[Term]:
+    terms = []
+    for word in shlex.split(expr):
+        name, op, vals = word.partition("=")
+        negate = name.endswith("!")
+        name = field_aliases.get(name.rstrip("!"), name.rstrip("!"))
+        if not op or not vals:
+            raise ValueError(f"'{word}' isn't field=patterns or field!=patterns")
+        if name not in plan_fields:
+            raise ValueError(f"can't plan on '{name}', have {', '.join(sorted(plan_fields))}")
+        terms.append(Term(name, vals.split(","), negate))
+    return terms
+
+
+def version_bound(ver: str, upper: bool) -> Optional[int]:
+    if not ver:
+        return None
+    ver = Version(ver)
+    key = version_key(ver)
+    if upper and len(ver.release) < 3:
+        key += 1000 ** (3 - len(ver.release)) - 1
+    return key
+
+
+def is_glob(pattern: str) -> bool:
+    return any(c in pattern for c in "*?[")
+
+
+def version_str(key: int) -> str:
+    return f"{key // 1000**2}.{key // 1000 % 1000}.{key % 1000}"
+
+
+def version_range(pattern: str) -> tuple[Optional[int], Optional[int]]:
+    lo, _, hi = pattern.partition("..")
+    return version_bound(lo, False), version_bound(hi, True)
+
+
+def pattern_mask(table: DownloadTable, name: str, patterns: list[str]) -> bytes:
+    patterns = [p.lower() for p in patterns]
+
+    def matches(val: object) -> bool:
+        return any(fnmatch.fnmatchcase(str(val).lower(), p) for p in patterns)
+
+    if name == "version":
+        masks = [table.version_range_mask(*version_range(p)) for p in patterns if ".." in p]
+        patterns = [p for p in patterns if ".." not in p]
+        # a plain version matches by version_key like Catalog.query, so 21.1 is 21.1.0, and
+        # a glob also sees the full a.b.c form, so 21.1.* takes in a listing of 21.1
+        keys = {version_key(Version(p)) for p in patterns if not is_glob(p)}
+        patterns = [p for p in patterns if is_glob(p)]
+        masks.append(
+            table.version.mask(
+                c
+                for c, (v, k) in enumerate(zip(table.version.values, table.version_keys))
+                if k in keys or matches(v) or matches(version_str(k))
+            )
+        )
+        return or_masks(masks, len(table))
+    if name in ("filename", "sha1"):
+        return bytes(matches(table.get(i, name)) for i in range(len(table)))
+    col = getattr(table, name)
+    return col.mask(c for c, v in enumerate(col.values) if matches(v))
+
+
+def or_masks(masks: list[bytes], n: int) -> bytes:
+    acc = 0
+    for m in masks:
+        acc |= int.from_bytes(m, "big")
+    return acc.to_bytes(n, "big")
+
+
+def invert(mask: bytes) -> bytes:
+    return mask.translate(bytes([1, 0]) + bytes(254))
+
+
+def select(table: DownloadTable, terms: list[Term]) -> list[int]:
+    masks = []
+    for term in terms:
+        mask = pattern_mask(table, term.field, term.patterns)
+        masks.append(invert(mask) if term.negate else mask)
+    mask = and_masks(masks, len(table))
+    return [i for i, keep in enumerate(mask) if keep]
+
+
+@define
+class Plan:
+    expression: str
+    dist_urls: list[str]
+    # fetched files are checked against this archive, and with dedup only one listing per
+    # sha1 is resolved and downloaded
+    root: Optional[str] = None
+    dedup: bool = True
+
+    def save(self, path: str) -> None:
+        with open(path + ".tmp", "w") as f:
+            json.dump(asdict(self), f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "Plan":
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def downloads(self, catalog: Catalog, **filters) -> list[Download]:
+        if not self.dist_urls:
+            return []
+        return catalog.query(dist_url=self.dist_urls, **filters)
+
+
+def make_plan(
+    catalog: Catalog, expression: str, root: Optional[str] = None, dedup: bool = True
+) -> Plan:
+    table = catalog.table()
+    rows = select(table, parse_expression(expression))
+    return Plan(expression, [table.dist_url[i] for i in rows], root, dedup)
+
+
+def groups(dls: Iterable[Download], dedup: bool) -> list[list[Download]]:
+    # the listings fetched as one file, the same grouping Scheduler.queue uses
+    by_key = {}
+    for dl in dls:
+        by_key.setdefault(dl.sha1 if dedup else dl.dist_url, []).append(dl)
+    return list(by_key.values())
+
+
+def archived(same: list[Download], root: Optional[str], store: Optional[BlobStore]) -> bool:
+    if root is None:
+        return False
+    if store is not None and store.has(same[0].sha1):
+        return True
+    return any(is_complete(dl, archive_path(root, dl)) for dl in same)
+
+
+def wanted(plan: Plan, dls: list[Download]) -> list[list[Download]]:
+    # the groups still to be fetched into plan.root
+    store = BlobStore(plan.root) if plan.root is not None and plan.dedup else None
+    return [same for same in groups(dls, plan.dedup) if not archived(same, plan.root, store)]
+
+
+def to_resolve(plan: Plan, dls: list[Download]) -> list[Download]:
+    # one listing per wanted group that has no cdn url yet, the rest are linked to it
+    return [same[0] for same in wanted(plan, dls) if all(dl.cdn_url is None for dl in same)]
+
+
+def fetchable(plan: Plan, dls: list[Download]) -> list[Download]:
+    # every listing of a group with a resolved one, the scheduler fetches that and links
+    # the others
+    keep = []
+    for same in groups(dls, plan.dedup):
+        if any(dl.cdn_url is not None for dl in same):
+            keep += same
+    return keep
+
+
+def measured_rate(paths: list[str]) -> Optional[float]:
+    # bytes per second over earlier download runs, from their --metrics jsonl
+    total = seconds = 0
+    for path in paths:
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        total += sum(line["value"] for line in lines if line["name"] == "quartus_bytes_total")
+        seconds += max((line["seconds"] for line in lines), default=0)
+    return total / seconds if total and seconds else None
+
+
+@define
+class Summary:
+    files: int = 0
+    listed_bytes: int = 0
+    unique_files: int = 0
+    unique_bytes: int = 0
+    archived_files: int = 0
+    archived_bytes: int = 0
+    fetch_files: int = 0
+    fetch_bytes: int = 0
+    unresolved: int = 0
+    rate: Optional[float] = None
+    seconds: Optional[float] = None
+    by_edition_os: dict[str, int] = field(factory=dict)
+
+
+def summarize(plan: Plan, dls: list[Download], rate: Optional[float] = None) -> Summary:
+    s = Summary(files=len(dls), rate=rate)
+    s.listed_bytes = sum(dl.listed_size for dl in dls)
+    all_groups = groups(dls, plan.dedup)
+    s.unique_files = len(all_groups)
+    s.unique_bytes = sum(same[0].listed_size for same in all_groups)
+    todo = wanted(plan, dls)
+    s.fetch_files = len(todo)
+    s.fetch_bytes = sum(same[0].listed_size for same in todo)
+    s.archived_files = s.unique_files - s.fetch_files
+    s.archived_bytes = s.unique_bytes - s.fetch_bytes
+    s.unresolved = sum(all(dl.cdn_url is None for dl in same) for same in todo)
+    if rate:
+        s.seconds = s.fetch_bytes / rate
+    for same in todo:
+        key = f"{same[0].edition}/{same[0].operating_system}"
+        s.by_edition_os[key] = s.by_edition_os.get(key, 0) + same[0].listed_size
+    return s
+
+
+def duration_str(seconds: float) -> str:
+    hours, rem = divmod(int(seconds), 3600)
+    days, hours = divmod(hours, 24)
+    return f"{days}d {hours}h" if days else f"{hours}h {rem // 60}m"
+
+
+def print_summary(plan: Plan, s: Summary) -> None:
+    print(f"plan: {plan.expression or '(whole catalog)'}")
+    print(f"  {s.files} listings, {size_str(s.listed_bytes)} listed")
+    print(f"  {s.unique_files} distinct files, {size_str(s.unique_bytes)} after sha1 dedup")
+    if plan.root is not None:
+        print(f"  {s.archived_files} files, {size_str(s.archived_bytes)} already in {plan.root}")
+    print(f"  {s.fetch_files} files, {size_str(s.fetch_bytes)} to fetch")
+    print(f"  {s.unresolved} cdn urls to resolve")
+    for key, size in sorted(s.by_edition_os.items()):
+        print(f"    {key}: {size_str(size)}")
+    if s.seconds is not None:
+        mbps = s.rate * 8 / 1e6
+        print(f"  about {duration_str(s.seconds)} at {mbps:,.1f} Mbit/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plan a partial mirror of the catalog")
+    parser.add_argument("expression", nargs="?", default="", help="filter expression")
+    parser.add_argument("-c", "--catalog", default=catalog_path, help="catalog database")
+    parser.add_argument("-r", "--root", help="archive root, files already there aren't counted")
+    parser.add_argument(
+        "--no-dedup",
+        dest="dedup",
+        action="store_false",
+        help="fetch every listing instead of once per sha1",
+    )
+    parser.add_argument("-o", "--save", metavar="PATH", help="write the plan here")
+    parser.add_argument("--load", metavar="PATH", help="summarize a saved plan")
+    parser.add_argument("--rate-mbps", type=float, help="expected download rate")
+    parser.add_argument(
+        "--rate-from",
+        metavar="PATH",
+        action="append",
+        default=[],
+        help="measure the rate from earlier download runs' --metrics jsonl",
+    )
+    parser.add_argument("-l", "--list", action="store_true", help="print the planned filenames")
+    args = parser.parse_args()
+
+    rate = args.rate_mbps * 1e6 / 8 if args.rate_mbps else measured_rate(args.rate_from)
+    with Catalog(args.catalog) as catalog:
+        try:
+            if args.load is not None:
+                plan = Plan.load(args.load)
+            else:
+                plan = make_plan(catalog, args.expression, args.root, args.dedup)
+        except ValueError as e:
+            parser.error(str(e))
+        dls = plan.downloads(catalog)
+    if args.list:
+        for dl in dls:
+            print(os.path.relpath(archive_path(".", dl)))
+    print_summary(plan, summarize(plan, dls, rate))
+    if args.save is not None:
+        plan.save(args.save)
+        print(f"saved to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
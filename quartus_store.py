@@ -0,0 +1,78 @@
+import os
+
+from attrs import define
+
+
+@define
+class BlobStore:
+    # verified files stored once under root/blobs keyed by sha1, the human facing
+    # edition/os/version/filename tree is made of hardlinks into it. A blob may instead
+    # be kept only as a seekable zstd pack under root/packed, see quartus_pack, or as a
+    # recipe of deduplicated chunks shared across releases, see quartus_chunk.
+    root: str
+
+    def blob_path(self, sha1: str) -> str:
+        return os.path.join(self.root, "blobs", sha1[:2], sha1)
+
+    def packed_path(self, sha1: str) -> str:
+        return os.path.join(self.root, "packed", sha1[:2], sha1 + ".zst")
+
+    def recipe_path(self, sha1: str) -> str:
+        return os.path.join(self.root, "recipes", sha1[:2], sha1 + ".json")
+
+    def chunk_path(self, sha1: str) -> str:
+        return os.path.join(self.root, "chunks", sha1[:2], sha1 + ".zst")
+
+    def has(self, sha1: str) -> bool:
+        return os.path.exists(self.blob_path(sha1)) or self.is_packed(sha1) or self.is_chunked(sha1)
+
+    def is_packed(self, sha1: str) -> bool:
+        return os.path.exists(self.packed_path(sha1))
+
+    def is_chunked(self, sha1: str) -> bool:
+        return os.path.exists(self.recipe_path(sha1))
+
+    def unpack(self, sha1: str) -> str:
+        # zstandard and numpy are only needed once something has been packed or chunked
+        blob = self.blob_path(sha1)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if self.is_packed(sha1):
+            from quartus_pack import restore
+
+            return restore(self.packed_path(sha1), blob)
+        from quartus_chunk import assemble
+
+        return assemble(self, sha1, blob)
+
+    def link(self, sha1: str, path: str) -> None:
+        blob = self.blob_path(sha1)
+        if not os.path.exists(blob):
+            self.unpack(sha1)
+        if os.path.exists(path) and os.path.samefile(blob, path):
+            return
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+        tmp = path + ".link"
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            # tree on another filesystem or one without hardlinks
+            os.symlink(os.path.relpath(blob, dirname), tmp)
+        os.replace(tmp, path)
+
+    def ingest(self, path: str, sha1: str) -> str:
+        # path must already be verified to have this sha1
+        blob = self.blob_path(sha1)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            os.unlink(path)
+        else:
+            os.replace(path, blob)
+        self.link(sha1, path)
+        return blob
+
+    def sha1s(self) -> set[str]:
+        blobs = os.path.join(self.root, "blobs")
+        if not os.path.isdir(blobs):
+            return set()
+        return {name for d in os.scandir(blobs) if d.is_dir() for name in os.listdir(d.path)}
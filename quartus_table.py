@@ -0,0 +1,300 @@
+import datetime
+import itertools
+from array import array
+from typing import Any, Iterable, Iterator, Optional, Union
+
+from attrs import define, field
+
+from quartus_catalog import filter_columns, version_key
+from quartus_model import Download, Version
+
+# A column store for the catalog. Downloads repeat a handful of editions, OSes, packages,
+# tabs, versions and dates thousands of times, so those are categorical: one code per row
+# and each distinct value held once. sha1s are 20 raw bytes, ints live in arrays and the
+# long unique strings share one utf-8 buffer. Filters build a 0/1 byte per row with
+# bytes.translate on the code columns and AND the masks as big ints, so a filtered query
+# touches no python objects per row until the matches are materialized.
+
+ones = b"\x01"
+
+
+@define
+class Strings:
+    # strings packed end to end, row i is data[offsets[i]:offsets[i + 1]]. With optional
+    # an empty string reads back as None.
+    optional: bool = False
+    data: bytearray = field(factory=bytearray)
+    offsets: array = field(factory=lambda: array("Q", [0]))
+
+    def append(self, s: Optional[str]) -> None:
+        if s:
+            self.data += s.encode()
+        elif not self.optional and s is None:
+            raise ValueError("None in a required string column")
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, i: int) -> Optional[str]:
+        s = self.data[self.offsets[i] : self.offsets[i + 1]].decode()
+        return None if self.optional and not s else s
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def nbytes(self) -> int:
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+
+@define
+class Categorical:
+    # each distinct value once, rows hold its code. Codes are one byte until a 257th
+    # value turns up.
+    values: list = field(factory=list)
+    index: dict = field(factory=dict)
+    codes: array = field(factory=lambda: array("B"))
+
+    def append(self, val: Any) -> None:
+        code = self.index.get(val)
+        if code is None:
+            code = self.index[val] = len(self.values)
+            self.values.append(val)
+            if code == 256:
+                self.codes = array("H", self.codes)
+        self.codes.append(code)
+
+    def __getitem__(self, i: int) -> Any:
+        return self.values[self.codes[i]]
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def mask(self, allowed: Iterable[int]) -> bytes:
+        # 1 for rows whose code is allowed
+        allowed = set(allowed)
+        if self.codes.typecode == "B":
+            table = bytes(int(c in allowed) for c in range(256))
+            return self.codes.tobytes().translate(table)
+        flags = [int(c in allowed) for c in range(len(self.values))]
+        return bytes(flags[c] for c in self.codes)
+
+    def mask_values(self, vals: Iterable) -> bytes:
+        return self.mask(self.index[v] for v in vals if v in self.index)
+
+    def nbytes(self) -> int:
+        return self.codes.itemsize * len(self.codes)
+
+
+def and_masks(masks: list[bytes], n: int) -> bytes:
+    # bytes of 0 and 1 ANDed a machine word at a time
+    if not masks:
+        return ones * n
+    acc = int.from_bytes(masks[0], "big")
+    for m in masks[1:]:
+        acc &= int.from_bytes(m, "big")
+    return acc.to_bytes(n, "big")
+
+
+categorical_columns = ("version", "updated_date", "operating_system", "edition", "package", "tab")
+
+
+@define
+class DownloadTable:
+    filename: Strings = field(factory=Strings)
+    dist_url: Strings = field(factory=Strings)
+    cdn_url: Strings = field(factory=lambda: Strings(optional=True))
+    sha1: bytearray = field(factory=bytearray)
+    ident: array = field(factory=lambda: array("q"))
+    listed_size: array = field(factory=lambda: array("q"))
+    version: Categorical = field(factory=Categorical)
+    updated_date: Categorical = field(factory=Categorical)
+    operating_system: Categorical = field(factory=Categorical)
+    edition: Categorical = field(factory=Categorical)
+    package: Categorical = field(factory=Categorical)
+    tab: Categorical = field(factory=Categorical)
+    # packed sortable version per version category, for range filters
+    version_keys: list[int] = field(factory=list)
+
+    @classmethod
+    def from_downloads(cls, dls: Iterable[Download]) -> "DownloadTable":
+        table = cls()
+        for dl in dls:
+            table.append(
+                dl.filename,
+                dl.dist_url,
+                dl.cdn_url,
+                dl.sha1,
+                dl.version,
+                dl.ident,
+                dl.updated_date,
+                dl.listed_size,
+                dl.operating_system,
+                dl.edition,
+                dl.package,
+                dl.tab,
+            )
+        return table
+
+    @classmethod
+    def from_rows(cls, rows: Iterable) -> "DownloadTable":
+        # catalog rows straight in, a version or date string is parsed once per distinct value
+        table = cls()
+        versions: dict[str, Version] = {}
+        dates: dict[str, datetime.date] = {}
+        for row in rows:
+            ver = versions.get(row["version"])
+            if ver is None:
+                ver = versions[row["version"]] = Version(row["version"])
+            date = dates.get(row["updated_date"])
+            if date is None:
+                date = dates[row["updated_date"]] = datetime.date.fromisoformat(row["updated_date"])
+            table.append(
+                row["filename"],
+                row["dist_url"],
+                row["cdn_url"],
+                row["sha1"],
+                ver,
+                row["ident"],
+                date,
+                row["listed_size"],
+                row["operating_system"],
+                row["edition"],
+                row["package"],
+                row["tab"],
+            )
+        return table
+
+    def append(
+        self,
+        filename: str,
+        dist_url: str,
+        cdn_url: Optional[str],
+        sha1: str,
+        version: Version,
+        ident: int,
+        updated_date: datetime.date,
+        listed_size: int,
+        operating_system: str,
+        edition: str,
+        package: str,
+        tab: str,
+    ) -> None:
+        self.filename.append(filename)
+        self.dist_url.append(dist_url)
+        self.cdn_url.append(cdn_url)
+        self.sha1 += bytes.fromhex(sha1)
+        self.ident.append(ident)
+        self.listed_size.append(listed_size)
+        known = len(self.version.values)
+        self.version.append(version)
+        if len(self.version.values) > known:
+            self.version_keys.append(version_key(version))
+        self.updated_date.append(updated_date)
+        self.operating_system.append(operating_system)
+        self.edition.append(edition)
+        self.package.append(package)
+        self.tab.append(tab)
+
+    def __len__(self) -> int:
+        return len(self.ident)
+
+    def get(self, i: int, name: str) -> Any:
+        if name == "sha1":
+            return self.sha1[20 * i : 20 * i + 20].hex()
+        return getattr(self, name)[i]
+
+    def download(self, i: int) -> Download:
+        return Download(
+            filename=self.filename[i],
+            dist_url=self.dist_url[i],
+            cdn_url=self.cdn_url[i],
+            sha1=self.get(i, "sha1"),
+            version=self.version[i],
+            ident=self.ident[i],
+            updated_date=self.updated_date[i],
+            listed_size=self.listed_size[i],
+            operating_system=self.operating_system[i],
+            edition=self.edition[i],
+            package=self.package[i],
+            tab=self.tab[i],
+        )
+
+    def view(self, i: int) -> "DownloadView":
+        return DownloadView(self, i)
+
+    def __iter__(self) -> Iterator["DownloadView"]:
+        return (DownloadView(self, i) for i in range(len(self)))
+
+    def mask(
+        self,
+        min_version: Optional[Version] = None,
+        max_version: Optional[Version] = None,
+        resolved: Optional[bool] = None,
+        **filters: Union[str, int, Iterable],
+    ) -> bytes:
+        # the same filters as Catalog.query, one 0/1 byte per row
+        masks = []
+        for col, val in filters.items():
+            if col not in filter_columns:
+                raise ValueError(f"can't filter the catalog on '{col}'")
+            if isinstance(val, (str, int, Version)):
+                val = [val]
+            if col == "version":
+                # by version_key like Catalog.query, so 21.1 and 21.1.0 are the same release
+                keys = {version_key(Version(str(v))) for v in val}
+                masks.append(
+                    self.version.mask(c for c, k in enumerate(self.version_keys) if k in keys)
+                )
+            elif col in categorical_columns:
+                masks.append(getattr(self, col).mask_values(val))
+            elif col == "sha1":
+                want = {bytes.fromhex(v) for v in val}
+                sha1 = self.sha1
+                masks.append(bytes(sha1[j : j + 20] in want for j in range(0, len(sha1), 20)))
+            else:
+                want = set(val)
+                masks.append(bytes(self.get(i, col) in want for i in range(len(self))))
+        if min_version is not None or max_version is not None:
+            lo = version_key(min_version) if min_version is not None else None
+            hi = version_key(max_version) if max_version is not None else None
+            masks.append(self.version_range_mask(lo, hi))
+        if resolved is not None:
+            offsets = self.cdn_url.offsets
+            masks.append(bytes((offsets[i + 1] > offsets[i]) == resolved for i in range(len(self))))
+        return and_masks(masks, len(self))
+
+    def version_range_mask(self, lo: Optional[int], hi: Optional[int]) -> bytes:
+        # rows with lo <= version_key <= hi, an open end is None
+        lo = -1 if lo is None else lo
+        hi = float("inf") if hi is None else hi
+        return self.version.mask(c for c, k in enumerate(self.version_keys) if lo <= k <= hi)
+
+    def select(self, **filters) -> list[int]:
+        return list(itertools.compress(range(len(self)), self.mask(**filters)))
+
+    def query(self, **filters) -> list["DownloadView"]:
+        return [DownloadView(self, i) for i in self.select(**filters)]
+
+    def nbytes(self) -> int:
+        cols = (self.filename, self.dist_url, self.cdn_url, self.version, self.updated_date)
+        cols += (self.operating_system, self.edition, self.package, self.tab)
+        arrays = len(self.sha1) + 8 * (len(self.ident) + len(self.listed_size))
+        return arrays + sum(c.nbytes() for c in cols)
+
+
+class DownloadView:
+    # a row of a DownloadTable read as a Download, fields are decoded on access
+    __slots__ = ("table", "i")
+
+    def __init__(self, table: DownloadTable, i: int):
+        self.table = table
+        self.i = i
+
+    def __getattr__(self, name: str) -> Any:
+        if name not in Download.__match_args__:
+            raise AttributeError(name)
+        return self.table.get(self.i, name)
+
+    def download(self) -> Download:
+        return self.table.download(self.i)
+
+    def __repr__(self) -> str:
+        return f"DownloadView({self.table.download(self.i)!r})"
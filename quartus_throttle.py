@@ -0,0 +1,289 @@
+import email.utils
+import heapq
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+from urllib.parse import urlsplit
+
+import requests
+from attrs import define, field
+from requests.adapters import HTTPAdapter
+
+from quartus_metrics import metrics
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class Throttled(Exception):
+    # the server pushed back: 429, a 5xx or a bounce to the homepage
+    def __init__(self, msg: str, retry_after: Optional[float] = None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(val: Optional[str]) -> Optional[float]:
+    if not val:
+        return None
+    try:
+        return max(0.0, float(val))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(val).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttled(status: int, url: Optional[str] = None) -> bool:
+    # intel answers overload with a redirect to the homepage as often as with a status code
+    return status == 429 or status >= 500 or (url is not None and "homepage.html" in url)
+
+
+@define
+class TokenBucket:
+    rate: float
+    burst: float
+    tokens: Optional[float] = None
+    stamp: float = field(factory=time.monotonic)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def reserve(self, n: float = 1) -> float:
+        # tokens go negative so waiters are served in arrival order, returns the wait
+        with self.lock:
+            now = time.monotonic()
+            if self.tokens is None:
+                self.tokens = self.burst
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self, n: float = 1) -> None:
+        if (delay := self.reserve(n)) > 0:
+            time.sleep(delay)
+
+
+@define
+class HostLimiter:
+    # token bucket for the request rate plus an AIMD window on requests in flight. Until
+    # the first push back each healthy response adds one to both, doubling them about
+    # every window, after that they grow by about one window slot and rate_step per
+    # second. A throttled response halves both, at most once per cooldown so one burst of
+    # failures counts as one congestion event.
+    host: str
+    rate: float = 4
+    min_rate: float = 0.5
+    max_rate: float = 50
+    rate_step: float = 1
+    limit: float = 4
+    min_limit: float = 1
+    max_limit: float = 32
+    decrease: float = 0.5
+    cooldown: float = 2
+    bucket: Optional[TokenBucket] = None
+    in_flight: int = 0
+    blocked_until: float = 0
+    last_decrease: float = 0
+    slow_start: bool = True
+    sent: int = 0
+    throttled: int = 0
+    cond: threading.Condition = field(factory=threading.Condition)
+
+    def __attrs_post_init__(self) -> None:
+        if self.bucket is None:
+            self.bucket = TokenBucket(self.rate, max(1.0, self.rate))
+
+    def acquire(self) -> None:
+        with self.cond:
+            while True:
+                blocked = self.blocked_until - time.monotonic()
+                if blocked <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.cond.wait(blocked if blocked > 0 else None)
+            self.in_flight += 1
+        self.bucket.acquire()
+
+    def try_acquire(self) -> bool:
+        # for event loops, take a slot if one is free without waiting, the caller still
+        # owes the bucket a token
+        with self.cond:
+            if self.blocked_until > time.monotonic() or self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self) -> None:
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    @contextmanager
+    def request(self) -> Iterator["HostLimiter"]:
+        self.acquire()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def success(self) -> None:
+        with self.cond:
+            self.sent += 1
+            before = int(self.limit)
+            if self.slow_start:
+                self.limit = min(self.max_limit, self.limit + 1)
+                self.rate = min(self.max_rate, self.rate + 1)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.rate = min(self.max_rate, self.rate + self.rate_step / self.rate)
+            self.bucket.rate = self.rate
+            self.bucket.burst = max(1.0, self.rate)
+            if int(self.limit) > before:
+                self.cond.notify()
+
+    def backoff(self, retry_after: Optional[float] = None) -> None:
+        metrics.inc("quartus_throttled_total", host=self.host)
+        with self.cond:
+            now = time.monotonic()
+            self.sent += 1
+            self.throttled += 1
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            if now - self.last_decrease < self.cooldown:
+                return
+            self.last_decrease = now
+            self.slow_start = False
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.bucket.rate = self.rate
+            self.bucket.burst = max(1.0, self.rate)
+
+    def report(
+        self, status: int, url: Optional[str] = None, retry_after: Optional[str] = None
+    ) -> bool:
+        # url is where the response redirects or ended up, returns True if throttled
+        if is_throttled(status, url):
+            self.backoff(parse_retry_after(retry_after))
+            return True
+        self.success()
+        return False
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "requests": self.sent,
+                "throttled": self.throttled,
+                "limit": int(self.limit),
+                "rate": round(self.rate, 2),
+            }
+
+
+# starting points, the controllers find the sustainable rate from here
+host_defaults = {
+    "www.intel.com": {"rate": 4, "limit": 4},
+    "cdrdv2.intel.com": {"rate": 4, "limit": 4},
+    "downloads.intel.com": {"rate": 8, "limit": 8},
+}
+
+
+@define
+class Throttle:
+    # one limiter per host shared by every session and browser in the process
+    defaults: dict[str, dict] = field(factory=lambda: dict(host_defaults))
+    retry_base: float = 1
+    retry_max: float = 60
+    hosts: dict[str, HostLimiter] = field(factory=dict)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def host(self, host: str) -> HostLimiter:
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLimiter(host, **self.defaults.get(host, {}))
+            return self.hosts[host]
+
+    def for_url(self, url: str) -> HostLimiter:
+        return self.host(urlsplit(url).hostname or "")
+
+    def retry_delay(self, attempt: int, exc: Optional[BaseException] = None) -> float:
+        # the server's Retry-After if it sent one, else jittered exponential from retry_base
+        retry_after = getattr(exc, "retry_after", None)
+        resp = getattr(exc, "response", None)
+        if retry_after is None and resp is not None:
+            retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+        if retry_after is not None:
+            return retry_after
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1)
+
+    def stats(self) -> dict[str, dict]:
+        with self.lock:
+            hosts = dict(self.hosts)
+        return {host: limiter.stats() for host, limiter in hosts.items()}
+
+
+throttle = Throttle()
+
+
+class ThrottledAdapter(HTTPAdapter):
+    # requests transport that takes a slot and a token from the host's limiter for every
+    # request, including each hop of a redirect chain, and reports how it went
+    def __init__(self, throttle: Throttle = throttle, **kwargs):
+        super().__init__(**kwargs)
+        self.throttle = throttle
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        limiter = self.throttle.for_url(request.url)
+        with limiter.request():
+            start = time.perf_counter()
+            try:
+                resp = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                metrics.request(limiter.host, "error", time.perf_counter() - start)
+                limiter.backoff()
+                raise
+            metrics.request(limiter.host, resp.status_code, time.perf_counter() - start)
+            limiter.report(
+                resp.status_code, resp.headers.get("Location"), resp.headers.get("Retry-After")
+            )
+        return resp
+
+
+def throttled_map(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    jobs: int,
+    attempts: int = 5,
+    throttle: Throttle = throttle,
+    permanent: tuple[type[BaseException], ...] = (),
+) -> Iterator[tuple[T, Optional[R], Optional[BaseException]]]:
+    # runs fn over items on a thread pool and yields (item, result, error) as they finish.
+    # A failed item is put back on a timer instead of sleeping in its worker, so the
+    # other items keep the pool busy while it waits out its backoff. Errors in permanent
+    # aren't retried.
+    pending = [(0.0, seq, 1, item) for seq, item in enumerate(items)]
+    heapq.heapify(pending)
+    running: dict[Future, tuple[int, int, T]] = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            now = time.monotonic()
+            while pending and pending[0][0] <= now and len(running) < jobs:
+                _, seq, attempt, item = heapq.heappop(pending)
+                running[executor.submit(fn, item)] = (seq, attempt, item)
+            timeout = None
+            if pending and len(running) < jobs:
+                timeout = max(0.0, pending[0][0] - now)
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                seq, attempt, item = running.pop(future)
+                exc = future.exception()
+                if exc is None:
+                    yield item, future.result(), None
+                elif attempt < attempts and not isinstance(exc, permanent):
+                    metrics.inc("quartus_retries_total")
+                    ready_at = time.monotonic() + throttle.retry_delay(attempt, exc)
+                    heapq.heappush(pending, (ready_at, seq, attempt + 1, item))
+                else:
+                    yield item, None, exc
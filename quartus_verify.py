@@ -0,0 +1,203 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
+
+from attrs import asdict, define
+from rich import print
+
+from quartus_catalog import Catalog, add_query_args, catalog_path, query_args
+from quartus_metrics import add_metrics_args, metrics, metrics_args, rate_buckets
+from quartus_model import Download, archive_path, listed_size_bounds
+from quartus_store import BlobStore
+
+read_size = 16 * 1024 * 1024
+
+
+@define
+class VerifyResult:
+    path: str
+    filename: str
+    status: str
+    expected_sha1: str
+    listed_size: int
+    sha1: Optional[str] = None
+    size: Optional[int] = None
+    seconds: float = 0
+
+
+def hash_file(path: str) -> tuple[str, int, float]:
+    # runs in a worker process, one large reusable buffer per file and a sequential
+    # readahead hint so each worker streams at disk speed
+    start = time.monotonic()
+    sha1 = hashlib.sha1()
+    buf = bytearray(read_size)
+    view = memoryview(buf)
+    size = 0
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while n := f.readinto(buf):
+            sha1.update(view[:n])
+            size += n
+    return sha1.hexdigest(), size, time.monotonic() - start
+
+
+def hash_stored(root: str, sha1: str, how: str) -> tuple[str, int, float]:
+    # a blob dropped after packing or chunking, decompressed and hashed without writing it
+    # back out. zstandard and numpy are only needed once something has been packed or chunked
+    start = time.monotonic()
+    store = BlobStore(root)
+    h = hashlib.sha1()
+    size = 0
+    if how == "packed":
+        from quartus_pack import SeekableReader
+
+        with SeekableReader.open(store.packed_path(sha1)) as reader:
+            for i in range(len(reader.offsets) - 1):
+                data = reader.frame(i)
+                h.update(data)
+                size += len(data)
+    else:
+        from quartus_chunk import Recipe, iter_recipe
+
+        # the pool already runs a file per core
+        for data in iter_recipe(store, Recipe.load(store.recipe_path(sha1)), 1):
+            h.update(data)
+            size += len(data)
+    return h.hexdigest(), size, time.monotonic() - start
+
+
+def check_size(dl: Download, path: str, store: Optional[BlobStore]) -> Optional[VerifyResult]:
+    # cheap checks that don't need the file contents. A file dropped after packing or
+    # chunking comes back as packed or chunked, still to be hashed from the store.
+    result = VerifyResult(path, dl.filename, "missing", dl.sha1, dl.listed_size)
+    try:
+        result.size = os.stat(path).st_size
+    except FileNotFoundError:
+        if store is not None and store.is_packed(dl.sha1):
+            result.status = "packed"
+        elif store is not None and store.is_chunked(dl.sha1):
+            result.status = "chunked"
+        return result
+    lo, hi = listed_size_bounds(dl.listed_size)
+    if not lo <= result.size <= hi:
+        result.status = "size_mismatch"
+        return result
+    return None
+
+
+def verify_archive(
+    root: str, dls: list[Download], jobs: Optional[int] = None
+) -> list[VerifyResult]:
+    by_path = {archive_path(root, dl): dl for dl in dls}
+    store = BlobStore(root)
+    results = []
+    # tree entries hardlinked to the same blob are hashed once, as are those of a stored blob
+    by_inode = {}
+    by_stored = {}
+    for path, dl in by_path.items():
+        if (result := check_size(dl, path, store)) is None:
+            st = os.stat(path)
+            by_inode.setdefault((st.st_dev, st.st_ino), (st.st_size, []))[1].append((path, dl))
+        elif result.status in ("packed", "chunked"):
+            by_stored.setdefault((dl.sha1, result.status), (dl.listed_size, []))[1].append(
+                (path, dl)
+            )
+        else:
+            results.append(result)
+    # largest first so the biggest files aren't left running alone at the end
+    to_hash = sorted(by_inode.values(), key=lambda size_paths: size_paths[0], reverse=True)
+    to_unstore = sorted(by_stored.items(), key=lambda item: item[1][0], reverse=True)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(hash_file, paths[0][0]): ("ok", paths) for _, paths in to_hash}
+        for (sha1, how), (_, paths) in to_unstore:
+            futures[executor.submit(hash_stored, root, sha1, how)] = (how, paths)
+        for future in as_completed(futures):
+            passed, paths = futures[future]
+            try:
+                sha1, size, seconds = future.result()
+            except Exception as e:
+                # an i/o error, a missing chunk or a corrupt frame
+                for path, dl in paths:
+                    print(f"[red]{path}: unreadable: {e!r}[/red]")
+                    results.append(
+                        VerifyResult(path, dl.filename, "unreadable", dl.sha1, dl.listed_size)
+                    )
+                continue
+            metrics.inc("quartus_verify_bytes_total", size)
+            metrics.observe("quartus_verify_file_seconds", seconds)
+            if seconds:
+                metrics.observe("quartus_verify_bytes_per_second", size / seconds, rate_buckets)
+            for path, dl in paths:
+                status = passed if sha1 == dl.sha1 else "sha1_mismatch"
+                results.append(
+                    VerifyResult(
+                        path, dl.filename, status, dl.sha1, dl.listed_size, sha1, size, seconds
+                    )
+                )
+                if status != passed:
+                    print(f"[red]{path}: {status}[/red]")
+    return results
+
+
+def count_statuses(results: list[VerifyResult]) -> None:
+    for r in results:
+        metrics.inc("quartus_verify_files_total", status=r.status)
+
+
+def report(results: list[VerifyResult], seconds: float) -> dict:
+    statuses = {}
+    for r in results:
+        statuses[r.status] = statuses.get(r.status, 0) + 1
+    hashed_bytes = sum(r.size for r in results if r.sha1 is not None)
+    return {
+        "summary": {
+            "files": len(results),
+            "statuses": statuses,
+            "hashed_bytes": hashed_bytes,
+            "seconds": seconds,
+            "bytes_per_second": hashed_bytes / seconds if seconds else 0,
+        },
+        "files": [asdict(r) for r in sorted(results, key=lambda r: r.path)],
+    }
+
+
+def main(
+    catalog_path: str, root: str, jobs: Optional[int], report_path: Optional[str], filters: dict
+) -> int:
+    with Catalog(catalog_path) as catalog:
+        dls = catalog.query(**filters)
+    start = time.monotonic()
+    metrics.stage = "verify"
+    results = verify_archive(root, dls, jobs)
+    count_statuses(results)
+    rep = report(results, time.monotonic() - start)
+    if report_path is None:
+        json.dump(rep, sys.stdout, indent=1)
+    else:
+        with open(report_path, "w") as f:
+            json.dump(rep, f, indent=1)
+    print(rep["summary"], file=sys.stderr)
+    return 0 if rep["summary"]["statuses"].keys() <= {"ok", "packed", "chunked"} else 1
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Verify an archive against the catalog")
+    parser.add_argument("root", help="archive root directory")
+    parser.add_argument("-c", "--catalog", default=catalog_path, help="catalog database")
+    parser.add_argument("-j", "--jobs", type=int, help="hashing processes, default all cores")
+    parser.add_argument("-r", "--report", help="write the json report here instead of stdout")
+    add_query_args(parser)
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    metrics_args(args)
+    sys.exit(main(args.catalog, args.root, args.jobs, args.report, query_args(args)))
+
+
+if __name__ == "__main__":
+    cli()
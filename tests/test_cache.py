@@ -0,0 +1,43 @@
+import os
+import threading
+
+from quartus_cache import ResponseCache
+
+url = "https://www.intel.com/content/www/us/en/software-kit/1/download.html"
+
+
+def test_round_trip(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.put("GET", url, None, 200, {"ETag": '"1"'}, b"<html></html>")
+    cached = cache.get("GET", url)
+    assert (cached.status, cached.headers, cached.body) == (200, {"ETag": '"1"'}, b"<html></html>")
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_torn_entry_is_a_miss(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.put("GET", url, None, 200, {}, b"<html></html>")
+    path = cache.entry_path(cache.key("GET", url)) + ".json"
+    with open(path, "r+") as f:
+        f.truncate(os.path.getsize(path) // 2)
+    assert cache.get("GET", url) is None
+    with open(path, "w") as f:
+        f.write("{}")
+    assert cache.get("GET", url) is None
+    assert cache.misses == 2
+    assert cache.evict() == 1
+
+
+def test_concurrent_puts_leave_a_whole_entry(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    bodies = [bytes([i]) * 64 * 1024 for i in range(8)]
+    threads = [
+        threading.Thread(target=cache.put, args=("GET", url, None, 200, {}, body))
+        for body in bodies
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert cache.get("GET", url).body in bodies
+    assert not [n for _, _, names in os.walk(tmp_path) for n in names if n.endswith(".tmp")]
@@ -0,0 +1,88 @@
+import datetime
+import os
+import subprocess
+import sys
+
+import attrs
+import pytest
+
+from quartus_catalog import Catalog, download_fields
+from quartus_model import Download, Version, download_to_json
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+cli = os.path.join(root, "quartus_cli.py")
+
+# dispatching and answering a catalog query load none of these
+slow_modules = ("attr", "attrs", "quartus_model", "requests", "mechanize", "lxml", "aiohttp")
+
+# -X importtime doesn't see importlib.import_module, so the cli reports sys.modules on exit
+report = (
+    "import atexit, sys\n"
+    "atexit.register(lambda: sys.stderr.write('\\n'.join(sys.modules)))\n"
+    "sys.argv[0] = 'quartus_cli.py'\n"
+    "import quartus_cli\n"
+    "quartus_cli.main()\n"
+)
+
+
+def imported(*args: str) -> set[str]:
+    proc = subprocess.run(
+        [sys.executable, "-c", report, *args], cwd=root, check=True, capture_output=True
+    )
+    return set(proc.stderr.decode().splitlines())
+
+
+def slow(modules: set[str]) -> list[str]:
+    return sorted(m for m in modules if m.split(".")[0] in slow_modules)
+
+
+@pytest.fixture
+def catalog(tmp_path) -> str:
+    path = str(tmp_path / "quartus.sqlite")
+    dl = Download(
+        filename="Quartus-pro-21.1.0.169-linux-complete.tar",
+        dist_url="https://downloads.example.com/21.1/Quartus-pro-21.1.0.169-linux-complete.tar",
+        cdn_url=None,
+        sha1="0123456789abcdef0123456789abcdef01234567",
+        version=Version("21.1.0"),
+        ident=169,
+        updated_date=datetime.date(2021, 3, 29),
+        listed_size=32 * 1024**3,
+        operating_system="linux",
+        edition="pro",
+        package="complete",
+        tab="combined",
+    )
+    with Catalog(path) as c:
+        c.upsert([dl])
+    return path
+
+
+def test_help_imports_nothing_slow():
+    modules = imported("-h")
+    assert "quartus_catalog" not in modules
+    assert slow(modules) == []
+
+
+def test_query_imports_nothing_slow(catalog):
+    # the lookup quartus_bench.py startup times
+    modules = imported(
+        "query",
+        "-c",
+        catalog,
+        "-f",
+        "Quartus-pro-21.1.0.169-linux-complete.tar",
+        "--fields",
+        "sha1",
+    )
+    assert "quartus_catalog" in modules
+    assert slow(modules) == []
+
+
+def test_query_json_matches_download_to_json(catalog):
+    assert download_fields == tuple(attrs.fields_dict(Download))
+    out = subprocess.run(
+        [sys.executable, cli, "query", "-c", catalog], check=True, capture_output=True, text=True
+    ).stdout
+    with Catalog(catalog) as c:
+        assert out == "".join(download_to_json(dl) + "\n" for dl in c.query())
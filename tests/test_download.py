@@ -0,0 +1,121 @@
+import hashlib
+import random
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import quartus_download
+from quartus_download import SegmentedDownload
+
+blob = random.Random(0).randbytes(24 * 1024 * 1024)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # most bytes sent for one range, as servers that cap their responses do
+    cap = None
+
+    def log_message(self, *args):
+        pass
+
+    def headers_for_range(self) -> tuple[int, int]:
+        start, end = 0, len(blob)
+        if (rng := self.headers.get("Range")) is not None:
+            first, last = rng.removeprefix("bytes=").split("-")
+            start, end = int(first), int(last) + 1
+            if self.cap is not None:
+                end = min(end, start + self.cap)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(blob)}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        return start, end
+
+    def do_HEAD(self):
+        self.headers_for_range()
+
+    def do_GET(self):
+        start, end = self.headers_for_range()
+        view = memoryview(blob)
+        while start < end:
+            n = min(256 * 1024, end - start)
+            self.wfile.write(view[start : start + n])
+            start += n
+
+
+class CappedHandler(RangeHandler):
+    cap = 300 * 1024
+
+
+class EmptyHandler(RangeHandler):
+    cap = 0
+
+
+@contextmanager
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/blob"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(scope="module")
+def url():
+    with serve(RangeHandler) as url:
+        yield url
+
+
+def session() -> requests.Session:
+    s = requests.Session()
+    s.trust_env = False
+    return s
+
+
+@pytest.mark.parametrize("segments", [1, 4, 8])
+def test_segmented_download_hashes_from_memory(tmp_path, url, segments):
+    sd = SegmentedDownload(
+        url,
+        str(tmp_path / "blob"),
+        num_segments=segments,
+        piece_size=1024 * 1024,
+        min_split=256 * 1024,
+        session_factory=session,
+        expected_sha1=hashlib.sha1(blob).hexdigest(),
+    )
+    sd.run()
+    assert (tmp_path / "blob").read_bytes() == blob
+    assert sd.hasher.reread == 0
+
+
+def test_short_range_bodies_resume(tmp_path):
+    with serve(CappedHandler) as url:
+        sd = SegmentedDownload(
+            url,
+            str(tmp_path / "blob"),
+            num_segments=4,
+            piece_size=1024 * 1024,
+            session_factory=session,
+            expected_sha1=hashlib.sha1(blob).hexdigest(),
+            retries=1,
+        )
+        sd.run()
+    assert (tmp_path / "blob").read_bytes() == blob
+
+
+def test_empty_range_bodies_give_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(quartus_download.throttle, "retry_base", 0)
+    with serve(EmptyHandler) as url:
+        sd = SegmentedDownload(
+            url, str(tmp_path / "blob"), num_segments=1, session_factory=session, retries=2
+        )
+        with pytest.raises(ValueError, match="empty"):
+            sd.run()